@@ -0,0 +1,196 @@
+"""Measure trajectory compression on synthetic bus trajectories.
+
+Simulates --vehicles buses reporting every --interval seconds for --hours:
+each drives a route of straight runs joined by turns, dwells at stops, and
+reports with Gaussian GPS noise of --gps-noise-m meters. The reports are
+compressed poll by poll, as the poller does, at each --tolerances value.
+
+Prints JSON per tolerance with the compression ratio, compression
+throughput, the largest distance of a dropped point from the stored
+trajectory (checked independently of the compressor) and the report's
+per-vehicle distances (distance_engine) from the raw and from the stored
+points, against the true distance driven and the bound in trajectory.py.
+
+    $ python3 benchmarks/bench_compression.py --vehicles 2000 --tolerances 5 15 30
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from distance_engine import fold_positions, vehicle_totals  # noqa: E402
+from trajectory import EARTH_RADIUS_M, TrajectoryCompressor, segment_offsets_m  # noqa: E402
+from vehicle_batch import STRING_COLUMNS, VehicleBatch, intern_strings  # noqa: E402
+
+# Around Connaught Place, Delhi.
+ORIGIN = (28.63, 77.22)
+START_EPOCH = 1742270400
+
+
+def simulate(vehicles, hours, interval, gps_noise_m, seed=0):
+    """Reported (lat, lon) arrays of shape (polls, vehicles), and the true
+    distance each vehicle drove in km."""
+    rng = np.random.default_rng(seed)
+    polls = int(hours * 3600 / interval)
+    m_per_lat = math.radians(1) * EARTH_RADIUS_M
+    m_per_lon = m_per_lat * math.cos(math.radians(ORIGIN[0]))
+    lats = np.empty((polls, vehicles))
+    lons = np.empty((polls, vehicles))
+    driven_km = np.zeros(vehicles)
+
+    for v in range(vehicles):
+        x, y = rng.uniform(-10000, 10000, size=2)
+        heading = rng.uniform(0, 2 * math.pi)
+        # Meters left on the current straight run, and seconds left stopped.
+        run, dwell = rng.uniform(200, 1500), 0.0
+        speed = rng.uniform(5, 12)
+        for poll in range(polls):
+            lats[poll, v] = ORIGIN[0] + y / m_per_lat
+            lons[poll, v] = ORIGIN[1] + x / m_per_lon
+            if dwell > 0:
+                dwell -= interval
+                continue
+            step = min(speed * interval, run)
+            x += step * math.cos(heading)
+            y += step * math.sin(heading)
+            driven_km[v] += step / 1000
+            run -= step
+            if run <= 0:
+                # A stop, then a turn onto the next road.
+                dwell = rng.choice([0, 20, 40, 90, 300], p=[.3, .3, .2, .15, .05])
+                heading += rng.choice([-math.pi / 2, 0, math.pi / 2]) + \
+                    rng.normal(0, 0.1)
+                run = rng.uniform(200, 1500)
+                speed = rng.uniform(5, 12)
+
+    noise = rng.normal(0, gps_noise_m, size=(2, polls, vehicles))
+    lats += noise[0] / m_per_lat
+    lons += noise[1] / m_per_lon
+    return lats, lons, driven_km.tolist()
+
+
+def poll_batches(lats, lons, interval):
+    vehicles = lats.shape[1]
+    ids = intern_strings([f"DL1PC{v:05d}" for v in range(vehicles)])
+    strings = {name: np.full(vehicles, "", dtype=object)
+               for name in STRING_COLUMNS}
+    strings["vehicle_id"] = ids
+    for poll in range(len(lats)):
+        columns = dict(strings)
+        columns["latitude"] = lats[poll]
+        columns["longitude"] = lons[poll]
+        columns["raw_timestamp"] = np.full(
+            vehicles, START_EPOCH + poll * interval, dtype=np.int64)
+        yield VehicleBatch(columns)
+
+
+def max_dropped_deviation_m(raw, stored):
+    """Largest distance from a raw point to the stored trajectory between
+    the stored points around it, per vehicle, worst over all vehicles."""
+    stored_by_vehicle = {}
+    for vehicle_id, ts, lat, lon in stored:
+        stored_by_vehicle.setdefault(vehicle_id, []).append((ts, lat, lon))
+    worst = 0.0
+    for vehicle_id, points in raw.items():
+        kept = sorted(stored_by_vehicle[vehicle_id])
+        times = [ts for ts, _, _ in kept]
+        for ts, lat, lon in points:
+            i = np.searchsorted(times, ts)
+            if i < len(kept) and times[i] == ts:
+                continue
+            if i == 0 or i == len(kept):
+                # Never happens after a flush: first and last are stored.
+                return math.inf
+            (_, alat, alon), (_, blat, blon) = kept[i - 1], kept[i]
+            across, _ = segment_offsets_m((alat, alon), (blat, blon), (lat, lon))
+            worst = max(worst, across)
+    return worst
+
+
+def report_distances(vehicle_ids, timestamps, lats, lons):
+    state = fold_positions({}, vehicle_ids, timestamps, lats, lons)
+    return vehicle_totals(state)[1]
+
+
+def run(lats, lons, interval, tolerance_m, keepalive_seconds):
+    compressor = TrajectoryCompressor(tolerance_m, keepalive_seconds)
+    stored = []
+    seconds = 0.0
+    for batch in poll_batches(lats, lons, interval):
+        start = time.perf_counter()
+        kept = compressor.compress(batch)
+        seconds += time.perf_counter() - start
+        stored.append(kept)
+    stored.append(compressor.flush())
+    stored = VehicleBatch.concat(stored)
+    return compressor, stored, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, default=500)
+    parser.add_argument("--hours", type=float, default=2)
+    parser.add_argument("--interval", type=int, default=10,
+                        help="Seconds between reports of a vehicle.")
+    parser.add_argument("--gps-noise-m", type=float, default=3.0)
+    parser.add_argument("--tolerances", type=float, nargs="*", default=[5, 15, 30])
+    parser.add_argument("--keepalive-seconds", type=int, default=300)
+    args = parser.parse_args()
+
+    lats, lons, driven_km = simulate(args.vehicles, args.hours, args.interval,
+                                     args.gps_noise_m)
+    polls, vehicles = lats.shape
+    vehicle_ids = np.tile([f"DL1PC{v:05d}" for v in range(vehicles)], polls)
+    timestamps = np.repeat(START_EPOCH + np.arange(polls) * args.interval, vehicles)
+    raw_distances = report_distances(vehicle_ids, timestamps,
+                                     lats.ravel(), lons.ravel())
+    raw_points = {}
+    for vehicle_id, ts, lat, lon in zip(vehicle_ids.tolist(), timestamps.tolist(),
+                                        lats.ravel().tolist(), lons.ravel().tolist()):
+        raw_points.setdefault(vehicle_id, []).append((ts, lat, lon))
+
+    results = {"points": int(lats.size), "vehicles": vehicles,
+               "true_km": round(sum(driven_km), 1),
+               "raw_report_km": round(sum(raw_distances.values()), 1),
+               "tolerances": {}}
+    for tolerance_m in args.tolerances:
+        compressor, stored, seconds = run(lats, lons, args.interval,
+                                          tolerance_m, args.keepalive_seconds)
+        columns = stored.columns
+        distances = report_distances(
+            columns["vehicle_id"], columns["raw_timestamp"],
+            columns["latitude"], columns["longitude"])
+        dropped = {}
+        for vehicle_id in columns["vehicle_id"].tolist():
+            dropped[vehicle_id] = dropped.get(vehicle_id, 0) - 1
+        for vehicle_id in raw_points:
+            dropped[vehicle_id] += polls
+        # Per vehicle: compressed distance is never longer than the raw
+        # one and at most 4t (in km) shorter per dropped point.
+        within_bound = all(
+            -1e-6 <= raw_distances[v] - distances.get(v, 0.0) <=
+            4 * tolerance_m / 1000 * dropped[v] + 1e-6
+            for v in raw_distances)
+        results["tolerances"][tolerance_m] = {
+            "stored_points": len(stored),
+            "compression_ratio": round(lats.size / len(stored), 2),
+            "points_per_second": round(lats.size / seconds),
+            "max_dropped_deviation_m": round(max_dropped_deviation_m(
+                raw_points,
+                zip(columns["vehicle_id"].tolist(), columns["raw_timestamp"].tolist(),
+                    columns["latitude"].tolist(), columns["longitude"].tolist())), 2),
+            "report_km": round(sum(distances.values()), 1),
+            "report_km_vs_raw_pct": round(
+                100 * (sum(distances.values()) / sum(raw_distances.values()) - 1), 2),
+            "report_km_vs_true_pct": round(
+                100 * (sum(distances.values()) / sum(driven_km) - 1), 2),
+            "distance_within_bound": within_bound,
+        }
+        print(f"tolerance {tolerance_m}m: {results['tolerances'][tolerance_m]}",
+              file=sys.stderr)
+    print(json.dumps(results, indent=2))
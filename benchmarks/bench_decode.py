@@ -0,0 +1,127 @@
+"""Compare columnar VehicleBatch decoding with the dict-per-vehicle parse.
+
+For each feed, times decoding a serialized snapshot and converting it to
+what each sink writes (an arrow table, a pandas DataFrame and compact Mongo
+documents), once through the old parse_gtfs loop, which built an 11-key
+dict and formatted a display timestamp per vehicle, and once through
+vehicle_batch.decode_feed. Peak traced memory is measured separately, as
+tracemalloc slows everything down.
+
+    $ python3 benchmarks/bench_decode.py --scales 10000 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+import pyarrow as pa
+from google.transit import gtfs_realtime_pb2
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from bench_ingest import REPO_DIR, SNAPSHOTS, load_snapshot, synthetic_feed  # noqa: E402
+from schema import COMPACT, to_document  # noqa: E402
+from vehicle_batch import decode_feed  # noqa: E402
+
+
+def legacy_parse(data):
+    """parse_gtfs as it was before VehicleBatch, without the JSON dump."""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+    records = []
+    for entity in feed.entity:
+        if entity.HasField("vehicle"):
+            vehicle = entity.vehicle
+            records.append({
+                "entity_wrapper_id": entity.id,
+                "vehicle_id": vehicle.vehicle.id,
+                "route_id": vehicle.trip.route_id,
+                "vehicle_label": vehicle.vehicle.label,
+                "trip_id": vehicle.trip.trip_id,
+                "trip_start_time": vehicle.trip.start_time,
+                "trip_start_date": vehicle.trip.start_date,
+                "latitude": vehicle.position.latitude,
+                "longitude": vehicle.position.longitude,
+                "timestamp": "%s (%s)" % (time.strftime(
+                    '%H:%M:%S %d-%m-%Y', time.localtime(
+                        vehicle.timestamp)), vehicle.timestamp),
+                "raw_timestamp": vehicle.timestamp,
+            })
+    return records
+
+
+def batch_parse(data):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+    return decode_feed(feed)
+
+
+LEGACY_STAGES = {
+    "decode": legacy_parse,
+    "arrow": pa.Table.from_pylist,
+    "pandas": pd.DataFrame,
+    "documents": lambda records: [to_document(r, COMPACT) for r in records],
+}
+
+BATCH_STAGES = {
+    "decode": batch_parse,
+    "arrow": lambda batch: batch.to_arrow(),
+    "pandas": lambda batch: batch.to_pandas(),
+    "documents": lambda batch: batch.documents(COMPACT),
+}
+
+
+def run(stages, data, repeat):
+    """Best of repeat milliseconds per stage, and the peak traced MB of one
+    decode followed by every conversion."""
+    best = {}
+    for _ in range(repeat):
+        decoded = None
+        for stage, fn in stages.items():
+            start = time.perf_counter()
+            result = fn(data if stage == "decode" else decoded)
+            seconds = time.perf_counter() - start
+            if stage == "decode":
+                decoded = result
+            best[stage] = min(best.get(stage, seconds), seconds)
+    timings = {stage: round(seconds * 1000, 2) for stage, seconds in best.items()}
+    timings["total"] = round(sum(best.values()) * 1000, 2)
+
+    tracemalloc.start()
+    decoded = stages["decode"](data)
+    converted = [fn(decoded) for stage, fn in stages.items() if stage != "decode"]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del converted
+    return {"ms": timings, "peak_mb": round(peak / 1024 / 1024, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="*", default=[10000, 100000],
+                        help="Vehicle counts of the synthetic feeds.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    feeds = [(name, load_snapshot(os.path.join(REPO_DIR, name)))
+             for name in SNAPSHOTS]
+    feeds += [(f"synthetic_{vehicles}", synthetic_feed(feeds[0][1], vehicles))
+              for vehicles in args.scales]
+
+    results = {}
+    for name, feed in feeds:
+        data = feed.SerializeToString()
+        legacy = run(LEGACY_STAGES, data, args.repeat)
+        batch = run(BATCH_STAGES, data, args.repeat)
+        results[name] = {
+            "vehicles": len(feed.entity),
+            "dicts": legacy,
+            "batch": batch,
+            "speedup": {stage: round(legacy["ms"][stage] / batch["ms"][stage], 2)
+                        for stage in legacy["ms"]},
+        }
+        print(f"{name}: {results[name]['speedup']}", file=sys.stderr)
+    print(json.dumps(results, indent=2))
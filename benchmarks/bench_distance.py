@@ -0,0 +1,104 @@
+"""Compare distance_engine with the per-record geodesic loop report.py used.
+
+Generates a synthetic, shuffled multi-million point dataset of buses doing
+random walks around Delhi, times distance_engine.fold_positions on all of
+it, and times the old loop on a sample (it is far too slow to run on the
+full dataset) to extrapolate its cost.
+
+    $ python3 benchmarks/bench_distance.py --points 2000000 --vehicles 4000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from geopy.distance import geodesic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from distance_engine import fold_positions, vehicle_totals  # noqa: E402
+
+
+def synthetic_positions(points, vehicles, seed=0):
+    """Random walks with a 30s reporting interval, returned shuffled."""
+    rng = np.random.default_rng(seed)
+    per_vehicle = points // vehicles
+    vehicle_ids = np.repeat(
+        np.array([f"DL1PC{i:04d}" for i in range(vehicles)], dtype=object),
+        per_vehicle)
+    start = rng.integers(1742250000, 1742290000, size=vehicles)
+    timestamps = (np.repeat(start, per_vehicle) +
+                  np.tile(np.arange(per_vehicle) * 30, vehicles))
+    # ~0-150m per step, in degrees.
+    steps = rng.normal(0, 0.0008, size=(2, vehicles * per_vehicle))
+    origin = np.repeat(rng.uniform([28.4, 76.9], [28.9, 77.4],
+                                   size=(vehicles, 2)), per_vehicle, axis=0)
+    walks = np.cumsum(steps.reshape(2, vehicles, per_vehicle), axis=2)
+    lats = origin[:, 0] + walks[0].ravel()
+    lons = origin[:, 1] + walks[1].ravel()
+
+    order = rng.permutation(len(vehicle_ids))
+    return vehicle_ids[order], timestamps[order], lats[order], lons[order]
+
+
+def legacy_loop(vehicle_ids, timestamps, lats, lons):
+    """The loop report.py used before distance_engine, in input order."""
+    vehicle_counts = {}
+    vehicle_distances = {}
+    previous_positions = {}
+    for vid, lat, lon in zip(vehicle_ids, lats, lons):
+        vehicle_counts[vid] = vehicle_counts.get(vid, 0) + 1
+        if vid in previous_positions:
+            prev_lat, prev_lon = previous_positions[vid]
+            distance = geodesic((prev_lat, prev_lon), (lat, lon)).km
+            vehicle_distances[vid] = vehicle_distances.get(vid, 0) + distance
+        previous_positions[vid] = (lat, lon)
+    return vehicle_counts, vehicle_distances
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=2000000)
+    parser.add_argument("--vehicles", type=int, default=4000)
+    parser.add_argument("--legacy-sample", type=int, default=20000,
+                        help="Points the legacy loop is timed on.")
+    args = parser.parse_args()
+
+    vehicle_ids, timestamps, lats, lons = synthetic_positions(
+        args.points, args.vehicles)
+    points = len(vehicle_ids)
+
+    start = time.perf_counter()
+    state = fold_positions({}, vehicle_ids, timestamps, lats, lons)
+    engine_seconds = time.perf_counter() - start
+
+    sample = slice(0, min(args.legacy_sample, points))
+    start = time.perf_counter()
+    legacy_loop(vehicle_ids[sample], timestamps[sample], lats[sample],
+                lons[sample])
+    legacy_seconds = time.perf_counter() - start
+    legacy_estimate = legacy_seconds / (sample.stop or 1) * points
+
+    # Accuracy against the exact mode, on the same (time ordered) sample.
+    exact = fold_positions({}, vehicle_ids[sample], timestamps[sample],
+                           lats[sample], lons[sample], exact=True)
+    fast = fold_positions({}, vehicle_ids[sample], timestamps[sample],
+                          lats[sample], lons[sample])
+    _, exact_distances = vehicle_totals(exact)
+    _, fast_distances = vehicle_totals(fast)
+    exact_total = sum(exact_distances.values())
+    relative_error = abs(sum(fast_distances.values()) - exact_total) / \
+        exact_total if exact_total else 0.0
+
+    print(json.dumps({
+        "points": points,
+        "vehicles": len(state),
+        "engine_seconds": round(engine_seconds, 3),
+        "engine_points_per_second": round(points / engine_seconds),
+        "legacy_sample_points": sample.stop,
+        "legacy_sample_seconds": round(legacy_seconds, 3),
+        "legacy_estimated_seconds": round(legacy_estimate, 1),
+        "speedup": round(legacy_estimate / engine_seconds, 1),
+        "haversine_vs_geodesic_relative_error": relative_error,
+    }, indent=2))
@@ -0,0 +1,256 @@
+"""Benchmark the poller's ingestion stages on replayed and synthetic feeds.
+
+The checked-in last_feed.json and vehicles_odt.json snapshots, plus
+synthetic feeds scaled to --scales vehicles, are served from a local HTTP
+stand-in for the feed API. Every cycle the real fetcher code downloads a
+snapshot (with fresh header and vehicle timestamps, so nothing is skipped
+as unchanged), parses it and writes it to each sink: the xlsx and arrow
+file outputs, a scratch database on a local mongod, and a spool (see
+spool.py). The spooled polls are written to the database after the last
+cycle, in group commits of --commit-polls polls, to compare with the
+per-poll writes of db_insert_new.
+
+Prints JSON with per-stage p50/p95/p99 latencies, records per second and
+the peak RSS of the process, per scenario. Save it with --output and
+compare runs between versions to spot regressions.
+
+    $ mongod --dbpath /tmp/bench-db --port 27017 &
+    $ python3 benchmarks/bench_ingest.py --scales 10000 100000 --output ingest.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pymongo
+from google.protobuf import json_format
+from google.transit import gtfs_realtime_pb2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import gtfs_rt_fetcher  # noqa: E402
+import spool  # noqa: E402
+
+REPO_DIR = os.path.join(os.path.dirname(__file__), "..")
+SNAPSHOTS = ["last_feed.json", "vehicles_odt.json"]
+
+
+def load_snapshot(path):
+    """Parse a MessageToJson dump back into a FeedMessage."""
+    with open(path) as f:
+        return json_format.Parse(f.read(), gtfs_realtime_pb2.FeedMessage(),
+                                 ignore_unknown_fields=True)
+
+
+def synthetic_feed(template, vehicles, seed=0):
+    """Scale template to vehicles entities, cycling through its entities
+    with fresh vehicle ids and jittered positions."""
+    rng = np.random.default_rng(seed)
+    jitter = rng.normal(0, 0.01, size=(vehicles, 2))
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.CopyFrom(template.header)
+    entities = [e for e in template.entity if e.HasField("vehicle")]
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.CopyFrom(entities[i % len(entities)])
+        entity.id = entity.vehicle.vehicle.id = f"BENCH{i:06d}"
+        entity.vehicle.position.latitude += jitter[i, 0]
+        entity.vehicle.position.longitude += jitter[i, 1]
+    return feed
+
+
+def cycle_payloads(feed, cycles, interval=30):
+    """Serialize feed once per cycle, moving every timestamp forward by
+    interval each time, so the fetcher never sees an unchanged feed."""
+    payloads = []
+    for _ in range(cycles):
+        feed.header.timestamp += interval
+        for entity in feed.entity:
+            entity.vehicle.timestamp += interval
+        payloads.append(feed.SerializeToString())
+    return payloads
+
+
+class FeedServer:
+    """Serve a list of payloads, the next one on every GET."""
+
+    def __init__(self):
+        self.payloads = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.payloads.pop(0)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d/VehiclePositions.pb" % \
+            self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(ms, 95)), 2),
+            "p99_ms": round(float(np.percentile(ms, 99)), 2)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_scenario(server, feed, args, workdir):
+    """Run args.cycles fetch/parse/sink cycles of feed, return the stats."""
+    vehicles = len(feed.entity)
+    stages = {"fetch": [], "header": [], "parse": [], "arrow": [],
+              "spool_append": []}
+    slow = vehicles <= args.slow_sink_limit
+    if slow:
+        stages["xlsx"] = []
+    if args.mongo_uri:
+        stages["db_insert_new"] = []
+        if slow:
+            stages["db_upsert"] = []
+
+    output_file = os.path.join(workdir, "vehicles.xlsx")
+    gtfs_rt_fetcher.last_seen.clear()
+    gtfs_rt_fetcher.indexed_collections.clear()
+    gtfs_rt_fetcher.last_feed_timestamps.clear()
+    server.payloads = cycle_payloads(feed, args.cycles)
+    records = 0
+
+    group_commits = []
+
+    def commit(batch):
+        start = time.perf_counter()
+        if args.mongo_uri:
+            gtfs_rt_fetcher.insert_new_to_db(batch, args.mongo_uri,
+                                             args.db_name, "vehicles_spooled")
+        group_commits.append((len(batch), time.perf_counter() - start))
+    # Nothing is due until close, so the group commits do not compete
+    # with the other stages.
+    db_spool = spool.Spool(
+        os.path.join(workdir, "spool"), commit, commit_records=float("inf"),
+        commit_seconds=float("inf"),
+        max_group_records=vehicles * args.commit_polls).start()
+
+    for _ in range(args.cycles):
+        def timed(stage, fn, *fn_args):
+            start = time.perf_counter()
+            result = fn(*fn_args)
+            stages[stage].append(time.perf_counter() - start)
+            return result
+
+        data = timed("fetch", gtfs_rt_fetcher.fetch_data, None, server.url)
+        if not timed("header", gtfs_rt_fetcher.is_new_feed, data, server.url):
+            raise RuntimeError("The stand-in served an unchanged feed")
+        parsed = timed("parse", gtfs_rt_fetcher.parse_vehicle_batch, data)
+        records += len(parsed)
+        timed("arrow", gtfs_rt_fetcher.save_to_segment, parsed, output_file)
+        timed("spool_append", db_spool.append, parsed)
+        if "xlsx" in stages:
+            timed("xlsx", gtfs_rt_fetcher.save_to_excel, parsed, output_file)
+        if "db_insert_new" in stages:
+            timed("db_insert_new", gtfs_rt_fetcher.insert_new_to_db, parsed,
+                  args.mongo_uri, args.db_name, "vehicles_insert_new")
+        if "db_upsert" in stages:
+            timed("db_upsert", gtfs_rt_fetcher.save_to_db, parsed,
+                  args.mongo_uri, args.db_name, "vehicles_upsert")
+
+    total = sum(sum(seconds) for seconds in stages.values())
+    # The spooled collection starts empty, forget what db_insert_new saw.
+    gtfs_rt_fetcher.last_seen.clear()
+    db_spool.close(timeout=None)
+    result = {
+        "vehicles": vehicles,
+        "cycles": args.cycles,
+        "payload_kb": round(len(data) / 1024, 1),
+        "stages": {stage: percentiles(seconds)
+                   for stage, seconds in stages.items()},
+        "records_per_second": round(records / total),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if args.mongo_uri:
+        spooled = sum(rows for rows, _ in group_commits)
+        result["db_group_commit"] = {
+            "polls_per_commit": args.commit_polls,
+            "commits": len(group_commits),
+            "records_per_second": round(
+                spooled / sum(seconds for _, seconds in group_commits)),
+        }
+        result["db_insert_new_records_per_second"] = round(
+            records / sum(stages["db_insert_new"]))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="gearchange_bench")
+    parser.add_argument("--skip-db", action="store_true",
+                        help="Only benchmark the fetch, parse and file stages.")
+    parser.add_argument("--scales", type=int, nargs="*", default=[10000, 100000],
+                        help="Vehicle counts of the synthetic feeds.")
+    parser.add_argument("--cycles", type=int, default=20,
+                        help="Polls per scenario.")
+    parser.add_argument("--slow-sink-limit", type=int, default=20000,
+                        help="Skip the xlsx and upsert sinks, which rewrite or read back everything, on feeds with more vehicles than this.")
+    parser.add_argument("--commit-polls", type=int, default=10,
+                        help="Spooled polls written to the database per group commit.")
+    parser.add_argument("--output", default=None,
+                        help="Also write the results to this file.")
+    args = parser.parse_args()
+    if args.skip_db:
+        args.mongo_uri = None
+
+    scenarios = [(name, load_snapshot(os.path.join(REPO_DIR, name)))
+                 for name in SNAPSHOTS]
+    template = scenarios[0][1]
+    scenarios += [(f"synthetic_{vehicles}", synthetic_feed(template, vehicles))
+                  for vehicles in args.scales]
+
+    client = pymongo.MongoClient(args.mongo_uri) if args.mongo_uri else None
+    server = FeedServer()
+    results = {}
+    try:
+        for name, feed in scenarios:
+            workdir = tempfile.mkdtemp(prefix="bench_ingest_")
+            if client:
+                client.drop_database(args.db_name)
+            try:
+                # Keep stdout for the JSON results.
+                with contextlib.redirect_stdout(sys.stderr):
+                    results[name] = run_scenario(server, feed, args, workdir)
+            finally:
+                shutil.rmtree(workdir)
+            print(f"{name}: {results[name]}", file=sys.stderr)
+    finally:
+        server.close()
+        if client:
+            client.drop_database(args.db_name)
+
+    output = json.dumps({"python": sys.version.split()[0],
+                         "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
@@ -0,0 +1,109 @@
+"""Measure report.py's peak memory against a large seeded collection.
+
+Seeds a scratch database on a local mongod with synthetic positions, then
+runs the report's data stage (a full rebuild of its checkpoint state) under
+tracemalloc at two collection sizes. Peak memory should stay roughly flat
+as the number of points grows, because it is bounded by the number of
+vehicles. The old list(collection.find())
+approach is measured on the same data for comparison. Without a mongod,
+tests/test_report_memory.py checks the same bound on generated positions.
+
+    $ mongod --dbpath /tmp/bench-db --port 27017 &
+    $ python3 benchmarks/bench_report_memory.py --points 2000000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import report  # noqa: E402
+from schema import LEGACY, ensure_collection  # noqa: E402
+
+
+def seed(collection, points, vehicles, batch_size=50000, seed=0):
+    """Insert points random-walk positions spread over vehicles."""
+    rng = np.random.default_rng(seed)
+    per_vehicle = points // vehicles
+    start = 1742250000
+    batch = []
+    for v in range(vehicles):
+        lat, lon = rng.uniform([28.4, 76.9], [28.9, 77.4])
+        steps = np.cumsum(rng.normal(0, 0.0008, size=(per_vehicle, 2)),
+                          axis=0)
+        for i in range(per_vehicle):
+            ts = start + i * 30
+            batch.append({
+                "vehicle_id": f"DL1PC{v:04d}",
+                "route_id": str(v % 500),
+                "latitude": float(lat + steps[i, 0]),
+                "longitude": float(lon + steps[i, 1]),
+                "timestamp": "%s (%d)" % (time.strftime(
+                    '%H:%M:%S %d-%m-%Y', time.localtime(ts)), ts),
+                "raw_timestamp": ts,
+            })
+            if len(batch) >= batch_size:
+                collection.insert_many(batch, ordered=False)
+                batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_mb": round(peak / 1024 / 1024, 1),
+            "seconds": round(seconds, 2)}
+
+
+def report_data_stage(collection):
+    checkpoint = report.new_checkpoint(report.DEFAULT_MAX_SPEED_KMH, False)
+    # Everything was just seeded, nothing is left to settle.
+    report.update_checkpoint(collection, checkpoint, settle_seconds=0)
+
+
+def load_everything(collection):
+    list(collection.find(
+        {}, {"vehicle_id": 1, "latitude": 1, "longitude": 1, "timestamp": 1,
+             "_id": 0}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="gearchange_bench")
+    parser.add_argument("--points", type=int, default=2000000)
+    parser.add_argument("--vehicles", type=int, default=4000)
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the seeded database afterwards.")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    results = []
+    try:
+        for points in (args.points // 4, args.points):
+            client.drop_database(args.db_name)
+            collection = client[args.db_name]["vehicles"]
+            seed(collection, points, args.vehicles)
+            # Built outside the measurement, like on a long-running db.
+            ensure_collection(client[args.db_name], "vehicles", LEGACY)
+            results.append({
+                "points": points,
+                "vehicles": args.vehicles,
+                "report": measure(lambda: report_data_stage(collection)),
+                "list_find": measure(lambda: load_everything(collection)),
+            })
+    finally:
+        if not args.keep:
+            client.drop_database(args.db_name)
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,114 @@
+"""Compare fixed-interval and adaptive polling against a simulated feed.
+
+The feed refreshes every --period seconds at a --phase, each refresh is
+only published --publish-delay seconds after its header timestamp, and
+vehicles report up to --report-spread seconds before it. A fraction of
+fetches fail (--error-rate). Time is simulated, so hours of polling run in
+a second.
+
+Prints JSON per strategy: fetches, how many found a new snapshot, were
+unchanged or failed, refreshes never fetched, and the freshness (age of
+the newest vehicle report at fetch time) of the new snapshots.
+
+    $ python3 benchmarks/bench_schedule.py --period 30 --intervals 10 30 45
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import pipeline  # noqa: E402
+import scheduler  # noqa: E402
+
+
+class SimulatedTime:
+    """Stands in for the time module of the clocks."""
+
+    def __init__(self, now=1742270400.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+    def perf_counter(self):
+        return self.now
+
+
+def simulate(clock, args, clock_time, seed=0):
+    rng = np.random.default_rng(seed)
+    start = clock_time.now
+    last_header = None
+    fetched = set()
+    freshness = []
+    outcomes = {"new": 0, "unchanged": 0, "error": 0}
+    while clock_time.now < start + args.hours * 3600:
+        clock.wait()
+        fired = clock_time.now
+        clock_time.now += args.fetch_seconds
+        if rng.random() < args.error_rate:
+            outcome = "error"
+        else:
+            refreshes = (fired - args.publish_delay - args.phase) // args.period
+            header = args.phase + refreshes * args.period
+            outcome = "new" if header != last_header else "unchanged"
+        outcomes[outcome] += 1
+        if isinstance(clock, scheduler.AdaptiveClock):
+            clock.observe(outcome, header if outcome == "new" else None,
+                          clock_time.now)
+        if outcome != "new":
+            continue
+        last_header = header
+        fetched.add(header)
+        vehicles = header - rng.uniform(0, args.report_spread, size=100)
+        if isinstance(clock, scheduler.AdaptiveClock):
+            clock.observe_vehicles(vehicles.astype(np.int64))
+        freshness.append(clock_time.now - vehicles.max())
+
+    published = int(args.hours * 3600 // args.period)
+    freshness = np.array(freshness)
+    return {
+        "fetches": sum(outcomes.values()),
+        "outcomes": outcomes,
+        "missed_refreshes": max(0, published - len(fetched)),
+        "p50_freshness_seconds": round(float(np.percentile(freshness, 50)), 2),
+        "p95_freshness_seconds": round(float(np.percentile(freshness, 95)), 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--period", type=float, default=30)
+    parser.add_argument("--phase", type=float, default=7)
+    parser.add_argument("--publish-delay", type=float, default=4)
+    parser.add_argument("--report-spread", type=float, default=10)
+    parser.add_argument("--fetch-seconds", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--hours", type=float, default=6)
+    parser.add_argument("--intervals", type=float, nargs="*", default=[10, 30, 45],
+                        help="Fixed intervals to compare, also the adaptive clock's starting interval.")
+    parser.add_argument("--min-interval", type=float, default=2)
+    parser.add_argument("--max-interval", type=float, default=120)
+    args = parser.parse_args()
+
+    results = {}
+    for interval in args.intervals:
+        for name in ("fixed", "adaptive"):
+            clock_time = SimulatedTime()
+            pipeline.time = scheduler.time = clock_time
+            if name == "fixed":
+                clock = pipeline.FixedRateClock(interval)
+            else:
+                clock = scheduler.AdaptiveClock(
+                    "sim", interval, args.min_interval, args.max_interval)
+            result = simulate(clock, args, clock_time)
+            if name == "adaptive":
+                result["learned"] = clock.stats()
+            results[f"{name}_{interval:g}s"] = result
+            print(f"{name} {interval:g}s: {result}", file=sys.stderr)
+    print(json.dumps(results, indent=2))
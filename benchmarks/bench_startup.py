@@ -0,0 +1,156 @@
+"""Measure the import time and cold start of one-shot gtfs_rt_fetcher.py runs.
+
+Every run is a fresh interpreter doing what a cron job does: run
+gtfs_rt_fetcher.py --interval 0 for one fetch of the checked-in
+last_feed.json snapshot, served from a local stand-in for the feed API,
+and write it to the sinks of each --combos entry. Each combination is run
+twice: "lazy", as gtfs_rt_fetcher.py is, and "eager", which first imports
+everything the module used to import at load (pandas, pyarrow, pymongo,
+pytz, boto3, the protobuf JSON formatter, live_store, rollup,
+s3_uploader).
+
+Prints JSON per combination and mode with the median and min wall time of
+--runs runs, from process start to exit, and the heavy modules the run
+loaded. "import" is `import gtfs_rt_fetcher` alone.
+
+    $ python3 benchmarks/bench_startup.py --runs 10
+    $ python3 benchmarks/bench_startup.py --combos arrow db db+arrow --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_ingest import SNAPSHOTS, FeedServer, cycle_payloads, load_snapshot  # noqa: E402
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+FETCHER = os.path.join(REPO_DIR, "gtfs_rt_fetcher.py")
+
+HEAVY_MODULES = ["pandas", "pyarrow", "pymongo", "boto3", "pytz",
+                 "google.protobuf.json_format", "openpyxl"]
+EAGER_IMPORTS = ["pandas", "pyarrow", "pymongo", "pytz", "boto3",
+                 "google.protobuf.json_format", "live_store", "rollup",
+                 "s3_uploader"]
+
+# Runs in the child: optionally imports what the fetcher used to, points
+# its requests at the stand-in, runs it, and reports the modules loaded.
+RUNNER = """
+import importlib, json, sys
+repo, url, mode, target = sys.argv[1:5]
+sys.path.insert(0, repo)
+if mode == "eager":
+    for name in %r:
+        importlib.import_module(name)
+import requests
+get = requests.Session.get
+requests.Session.get = lambda self, _, **kwargs: get(self, url, **kwargs)
+try:
+    if target == "import":
+        import gtfs_rt_fetcher
+    else:
+        import runpy
+        sys.argv = [target] + sys.argv[5:]
+        runpy.run_path(target, run_name="__main__")
+finally:
+    print(json.dumps([name for name in %r if name in sys.modules]),
+          file=sys.stderr)
+""" % (EAGER_IMPORTS, HEAVY_MODULES)
+
+
+def combo_args(combo, workdir, mongo_uri):
+    """gtfs_rt_fetcher.py arguments writing to the sinks of combo, e.g.
+    "db+arrow"."""
+    args = ["--interval", "0", "--url-enum", "DTS",
+            "--api-key-env-var", "BENCH_API_KEY"]
+    sinks = combo.split("+")
+    if "db" in sinks:
+        args += ["--mongo-uri", mongo_uri, "--db-name", "gearchange_bench",
+                 "--db-mode", "insert-new"]
+    else:
+        args += ["--skip-db", "True"]
+    for output_format in ("arrow", "xlsx"):
+        if output_format in sinks:
+            args += ["--output-file", os.path.join(workdir, "vehicles.xlsx"),
+                     "--output-format", output_format]
+    if "archive" in sinks:
+        args += ["--archive-dir", os.path.join(workdir, "archive")]
+    return args
+
+
+def run_once(server, mode, target, args):
+    env = dict(os.environ, BENCH_API_KEY="bench")
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", RUNNER, REPO_DIR, server.url, mode, target] + args,
+        cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(f"{mode} {target} {args} failed:\n{process.stderr}")
+    return seconds, json.loads(process.stderr.strip().splitlines()[-1])
+
+
+def measure(server, mode, target, args, runs):
+    # One run first to warm the page cache, as a cron job finds it.
+    run_once(server, mode, target, args)
+    seconds = []
+    for _ in range(runs):
+        elapsed, modules = run_once(server, mode, target, args)
+        seconds.append(elapsed)
+    return {"median_seconds": round(float(np.median(seconds)), 3),
+            "min_seconds": round(min(seconds), 3),
+            "heavy_modules": modules}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--combos", nargs="*", default=["archive", "arrow", "xlsx"],
+                        help="Sink combinations, any of arrow, xlsx, db and archive joined by +.")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017",
+                        help="Database of the db combinations, dropped afterwards.")
+    parser.add_argument("--output", default=None,
+                        help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    feed = load_snapshot(os.path.join(REPO_DIR, SNAPSHOTS[0]))
+    server = FeedServer()
+    server.payloads = cycle_payloads(
+        feed, 2 * (args.runs + 1) * len(args.combos))
+    results = {}
+    try:
+        for mode in ("lazy", "eager"):
+            results.setdefault("import", {})[mode] = measure(
+                server, mode, "import", [], args.runs)
+        for combo in args.combos:
+            for mode in ("lazy", "eager"):
+                workdir = tempfile.mkdtemp(prefix="bench_startup_")
+                try:
+                    results.setdefault(combo, {})[mode] = measure(
+                        server, mode, FETCHER,
+                        combo_args(combo, workdir, args.mongo_uri), args.runs)
+                finally:
+                    shutil.rmtree(workdir)
+        for name, result in results.items():
+            result["speedup"] = round(result["eager"]["median_seconds"] /
+                                      result["lazy"]["median_seconds"], 2)
+            print(f"{name}: {result}", file=sys.stderr)
+    finally:
+        server.close()
+        if any("db" in combo.split("+") for combo in args.combos):
+            import pymongo
+            pymongo.MongoClient(args.mongo_uri).drop_database("gearchange_bench")
+
+    output = json.dumps({"python": sys.version.split()[0],
+                         "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
@@ -0,0 +1,144 @@
+"""Vectorized per-vehicle point counts and distances for report.py.
+
+Positions are sorted by (vehicle_id, raw_timestamp) before consecutive
+points are paired, so the result does not depend on the order documents
+come back from Mongo. Segment lengths are computed with the haversine
+formula on whole arrays at once, or with an exact WGS84 geodesic when
+exact=True.
+
+Results are folded into a state dict keyed by vehicle_id, so positions can
+be processed in chunks (e.g. one cursor batch or one day at a time) and the
+state can be saved and extended later. Each vehicle's state holds:
+
+    count, distance (km), first_seen, last_seen, last_lat, last_lon
+"""
+import numpy as np
+from geographiclib.geodesic import Geodesic
+
+# Mean earth radius, in km.
+EARTH_RADIUS_KM = 6371.0088
+
+# Segments implying a faster speed than this are treated as GPS jumps.
+DEFAULT_MAX_SPEED_KMH = 120
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between arrays of points."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def geodesic_km(lat1, lon1, lat2, lon2):
+    """WGS84 geodesic distance in km between arrays of points."""
+    inverse = Geodesic.WGS84.Inverse
+    return np.array([
+        inverse(a, b, c, d, Geodesic.DISTANCE)["s12"] / 1000
+        for a, b, c, d in zip(lat1, lon1, lat2, lon2)], dtype=np.float64)
+
+
+def is_jump(distance_km, seconds, max_speed_kmh):
+    """True for segments that are too fast to be real movement."""
+    if max_speed_kmh is None:
+        return np.zeros(len(distance_km), dtype=bool)
+    hours = np.asarray(seconds, dtype=np.float64) / 3600
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed = np.where(hours > 0, distance_km / hours,
+                         np.where(distance_km > 0, np.inf, 0))
+    return speed > max_speed_kmh
+
+
+def sort_positions(vehicle_ids, timestamps, lats, lons):
+    """Sort positions by (vehicle_id, timestamp).
+
+    @return: (vehicles, codes, timestamps, lats, lons), where vehicles are
+        the unique ids in sorted order and codes index into them.
+    """
+    vehicles, codes = np.unique(np.asarray(vehicle_ids, dtype=object),
+                                return_inverse=True)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.lexsort((timestamps, codes))
+    return (vehicles, codes[order], timestamps[order],
+            np.asarray(lats, dtype=np.float64)[order],
+            np.asarray(lons, dtype=np.float64)[order])
+
+
+def fold_positions(state, vehicle_ids, timestamps, lats, lons,
+                   max_speed_kmh=DEFAULT_MAX_SPEED_KMH, exact=False):
+    """Add a chunk of positions to the per-vehicle state.
+
+    The chunk does not need to be sorted, and a vehicle may span several
+    chunks as long as they are folded in time order: the segment from a
+    vehicle's last position in state to its first position in the chunk is
+    included, but chunks overlapping what state already holds for a
+    vehicle only add to its count.
+
+    @param state: dict of vehicle_id -> per-vehicle state, updated in place.
+    @param max_speed_kmh: Segments faster than this are dropped as GPS
+        jumps. None keeps every segment.
+    @param exact: Use WGS84 geodesics instead of haversine. Much slower.
+
+    @return: state
+    """
+    if len(vehicle_ids) == 0:
+        return state
+
+    vehicles, codes, ts, lat, lon = sort_positions(
+        vehicle_ids, timestamps, lats, lons)
+    distance_fn = geodesic_km if exact else haversine_km
+
+    same_vehicle = codes[1:] == codes[:-1]
+    segments = distance_fn(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    valid = same_vehicle & ~is_jump(segments, ts[1:] - ts[:-1], max_speed_kmh)
+
+    n = len(vehicles)
+    counts = np.bincount(codes, minlength=n)
+    # float even when no segment is valid, bincount returns ints then.
+    distances = np.bincount(codes[1:][valid], weights=segments[valid],
+                            minlength=n).astype(np.float64)
+    ends = np.cumsum(counts) - 1
+    starts = ends - counts + 1
+
+    # Bridge each vehicle's saved last position to its first one here.
+    bridged = [i for i, vid in enumerate(vehicles)
+               if vid in state and ts[starts[i]] >= state[vid]["last_seen"]]
+    if bridged:
+        prev = [state[vehicles[i]] for i in bridged]
+        first = starts[bridged]
+        bridge = distance_fn(
+            np.array([p["last_lat"] for p in prev]),
+            np.array([p["last_lon"] for p in prev]),
+            lat[first], lon[first])
+        bridge_seconds = ts[first] - np.array([p["last_seen"] for p in prev])
+        bridge[is_jump(bridge, bridge_seconds, max_speed_kmh)] = 0
+        distances[bridged] += bridge
+
+    for i, vid in enumerate(vehicles):
+        vid_state = state.get(vid)
+        if vid_state is None:
+            vid_state = state[vid] = {
+                "count": 0, "distance": 0.0,
+                "first_seen": int(ts[starts[i]]),
+                "last_seen": int(ts[ends[i]]),
+                "last_lat": float(lat[ends[i]]),
+                "last_lon": float(lon[ends[i]]),
+            }
+        vid_state["count"] += int(counts[i])
+        vid_state["distance"] += float(distances[i])
+        vid_state["first_seen"] = min(vid_state["first_seen"],
+                                      int(ts[starts[i]]))
+        if ts[ends[i]] >= vid_state["last_seen"]:
+            vid_state["last_seen"] = int(ts[ends[i]])
+            vid_state["last_lat"] = float(lat[ends[i]])
+            vid_state["last_lon"] = float(lon[ends[i]])
+    return state
+
+
+def vehicle_totals(state):
+    """Split state into the vehicle_counts and vehicle_distances dicts the
+    report is built from."""
+    counts = {vid: s["count"] for vid, s in state.items()}
+    distances = {vid: s["distance"] for vid, s in state.items()
+                 if s["count"] > 1}
+    return counts, distances
@@ -0,0 +1,114 @@
+"""Append-only archive of raw GTFS-RT feed snapshots.
+
+Snapshots are stored zlib-compressed, one after another, in hourly segment
+files named after the UTC hour they were fetched in (YYYYmmddHH.seg). Each
+segment has an index file (YYYYmmddHH.idx) of fixed-size entries:
+
+    fetched_at (int64 unix seconds), feed_timestamp (int64),
+    offset (uint64), length (uint32)
+
+so the snapshots of any time window are found by a binary search over the
+index instead of a scan of the segments. Every record in a segment is also
+prefixed with (fetched_at, feed_timestamp, length), which keeps segments
+readable on their own if an index is lost.
+"""
+import bisect
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+
+INDEX_ENTRY = struct.Struct("<qqQI")
+RECORD_HEADER = struct.Struct("<qqI")
+
+
+def parse_time_arg(value):
+    """Parse a 'YYYY-MM-DD[ HH:MM]' local time or unix seconds argument."""
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            pass
+    return int(value)
+
+
+def segment_name(fetched_at):
+    return datetime.fromtimestamp(fetched_at, timezone.utc).strftime('%Y%m%d%H')
+
+
+class FeedArchive:
+    """Archive of one feed's snapshots, in its own directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, data, fetched_at=None, feed_timestamp=0):
+        """Compress and store one snapshot, return its compressed size."""
+        fetched_at = int(time.time() if fetched_at is None else fetched_at)
+        name = segment_name(fetched_at)
+        compressed = zlib.compress(data)
+
+        segment = os.path.join(self.directory, name + ".seg")
+        with open(segment, "ab") as f:
+            offset = f.tell()
+            f.write(RECORD_HEADER.pack(
+                fetched_at, feed_timestamp, len(compressed)))
+            f.write(compressed)
+
+        index = os.path.join(self.directory, name + ".idx")
+        with open(index, "ab") as f:
+            # Drop a partial entry left by a crash mid-write, so every entry
+            # stays aligned.
+            partial = f.tell() % INDEX_ENTRY.size
+            if partial:
+                f.truncate(f.tell() - partial)
+                f.seek(0, os.SEEK_END)
+            f.write(INDEX_ENTRY.pack(fetched_at, feed_timestamp,
+                                     offset + RECORD_HEADER.size,
+                                     len(compressed)))
+        return len(compressed)
+
+    def segments(self, start=None, end=None):
+        """Segment names, in time order, that may hold snapshots fetched
+        between start and end."""
+        names = sorted(name[:-4] for name in os.listdir(self.directory)
+                       if name.endswith(".idx"))
+        first = segment_name(start) if start is not None else None
+        last = segment_name(end) if end is not None else None
+        return [name for name in names
+                if (first is None or name >= first) and
+                (last is None or name <= last)]
+
+    def _first_entry_at(self, f, entries, start):
+        """Binary search the index file f for the first entry with
+        fetched_at >= start."""
+        class Entries:
+            def __len__(self):
+                return entries
+
+            def __getitem__(self, i):
+                f.seek(i * INDEX_ENTRY.size)
+                return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+        return bisect.bisect_left(Entries(), start)
+
+    def read(self, start=None, end=None):
+        """Yield (fetched_at, feed_timestamp, data) for every snapshot
+        fetched between start and end (inclusive), oldest first."""
+        for name in self.segments(start, end):
+            index = os.path.join(self.directory, name + ".idx")
+            entries = os.path.getsize(index) // INDEX_ENTRY.size
+            with open(index, "rb") as idx, \
+                    open(os.path.join(self.directory, name + ".seg"), "rb") as seg:
+                i = 0 if start is None else \
+                    self._first_entry_at(idx, entries, start)
+                idx.seek(i * INDEX_ENTRY.size)
+                for _ in range(i, entries):
+                    fetched_at, feed_timestamp, offset, length = \
+                        INDEX_ENTRY.unpack(idx.read(INDEX_ENTRY.size))
+                    if end is not None and fetched_at > end:
+                        return
+                    seg.seek(offset)
+                    yield (fetched_at, feed_timestamp,
+                           zlib.decompress(seg.read(length)))
@@ -1,17 +1,24 @@
 import argparse
+import collections
+import heapq
 import time
 import requests
 import os
-import pandas as pd
 from google.transit import gtfs_realtime_pb2
-from google.protobuf.json_format import MessageToJson
 import json
 from dotenv import load_dotenv
-import pymongo
-from pymongo import MongoClient
 from datetime import datetime
-import pytz
-import boto3
+# pandas, pyarrow, pymongo, boto3 and the other dependencies of a single
+# sink are imported by the code of that sink, so a one-shot run from cron
+# only loads what its sinks need, see benchmarks/bench_startup.py.
+import metrics
+import scheduler
+import spool
+import trajectory
+from feed_archive import FeedArchive, parse_time_arg
+from pipeline import MISSED_TICKS, FixedRateClock, Pipeline
+from schema import LEGACY, SCHEMAS, TIMESERIES, ensure_collection, stored_reports
+from vehicle_batch import as_batch, decode_feed
 
 # Load all env vars from chatbot's .env - this file is not tracked by
 # git but created by the caller of this script and contains the API_KEY
@@ -23,43 +30,133 @@ DTS_API_URL = "https://delhi.transportstack.in/api/dataset/otd/get-file?agency=d
 
 OUTPUT_FILE = "vehicles.xlsx"
 
+# Columns that identify a unique position report in the output file.
+DEDUP_COLUMNS = ['vehicle_id', 'timestamp', 'latitude',
+                 'longitude', 'route_id', 'trip_id']
+
 OTD_API_URL = "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=%s"
 
+FEED_URLS = {"dts": DTS_API_URL, "otd": OTD_API_URL}
+
 FEED_FILE = "last_feed.json"
 
 DST_BUCKET_NAME = "climate-gearchange-2024"
 
+UPLOAD_QUEUE_DIR = "upload_queue"
+
+
+# MongoDB error code for a unique index violation.
+DUPLICATE_KEY_ERROR = 11000
+
+
+# (connect, read) timeouts in seconds for feed requests.
+FETCH_TIMEOUT = (5, 30)
+
 
 client = None
 
+session = None
+
+# Per url, the If-None-Match/If-Modified-Since headers to send next time.
+feed_validators = {}
+
+# Per url, header.timestamp of the last feed that was processed.
+last_feed_timestamps = {}
+
+# Per url, how the last fetch_data call went: "ok", "not_modified" or
+# "error", as it returns None for both of the latter.
+last_fetch_results = {}
+
+# A feed to poll: its FEED_URLS name, url, api key and interval in seconds.
+Feed = collections.namedtuple("Feed", ["name", "url", "api_key", "interval"])
+
+# Per vehicle_id, the raw_timestamps most recently passed on to the sinks
+# when polling several feeds, see drop_seen_reports.
+recent_reports = {}
+RECENT_REPORTS_PER_VEHICLE = 8
+
+# Poll cycles that were short-circuited because the feed had not changed.
+skipped_cycles = {"not_modified": 0, "same_header_timestamp": 0}
+
+# Metrics of every stage of a poll, served with --metrics-port.
+FETCH_SECONDS = metrics.Histogram(
+    "gtfs_fetch_seconds", "Time to download a feed, 304s and errors included.",
+    ["feed"])
+FETCHES = metrics.Counter(
+    "gtfs_fetches_total", "Feed requests by result.", ["feed", "result"])
+FEED_BYTES = metrics.Histogram(
+    "gtfs_feed_bytes", "Size of downloaded feeds.", ["feed"],
+    buckets=metrics.SIZE_BUCKETS)
+SKIPPED_CYCLES = metrics.Counter(
+    "gtfs_skipped_cycles_total", "Polls skipped because the feed had not changed.",
+    ["reason"])
+PARSE_SECONDS = metrics.Histogram(
+    "gtfs_parse_seconds", "Time to parse a feed into records.")
+FEED_ENTITIES = metrics.Histogram(
+    "gtfs_feed_entities", "Entities per parsed feed.",
+    buckets=metrics.COUNT_BUCKETS)
+DB_WRITE_SECONDS = metrics.Histogram(
+    "gtfs_db_write_seconds", "Time to write one poll's records to the db.",
+    ["mode"])
+DB_RECORDS = metrics.Counter(
+    "gtfs_db_records_total", "Records sent to the db, by outcome.",
+    ["mode", "result"])
+FILE_WRITE_SECONDS = metrics.Histogram(
+    "gtfs_file_write_seconds", "Time to write one poll's records to the output file.",
+    ["format"])
+FILE_ROWS = metrics.Gauge(
+    "gtfs_file_rows", "Rows in the output workbook after the last write.")
+ROTATE_SECONDS = metrics.Histogram(
+    "gtfs_rotate_seconds", "Time to rotate the output file, and upload it unless queued.")
+ROTATIONS = metrics.Counter(
+    "gtfs_rotations_total", "Output file rotations by result.", ["result"])
+CYCLE_SECONDS = metrics.Histogram(
+    "gtfs_cycle_seconds", "Time from the start of a serial poll until every sink is done.",
+    ["feed"])
+CYCLE_LAG_SECONDS = metrics.Histogram(
+    "gtfs_cycle_lag_seconds", "How late a serial poll started against its schedule.",
+    ["feed"])
+
+# Collections whose indexes have already been checked by this process.
+indexed_collections = set()
+
+# Last raw_timestamp seen per vehicle_id, used by insert_new_to_db to skip
+# position reports that were already written on a previous poll.
+last_seen = {}
+
 
 def get_mongo_collection(mongo_uri, db_name, collection_name):
     global client
     if client is None:
+        from pymongo import MongoClient
         client = MongoClient(mongo_uri)
     db = client[db_name]
     collection = db[collection_name]
     return collection
 
 
+def ensure_indexes(collection, schema=LEGACY):
+    """Create the indexes of the storage schema once per process."""
+    if collection.full_name in indexed_collections:
+        return
+
+    ensure_collection(collection.database, collection.name, schema)
+    indexed_collections.add(collection.full_name)
+
+
 def save_to_db(data, mongo_uri, db_name, collection_name):
-    collection = get_mongo_collection(mongo_uri, db_name, collection_name)
+    with DB_WRITE_SECONDS.time(mode="upsert"):
+        _save_to_db(data, mongo_uri, db_name, collection_name)
 
-    # Check if compound index exists before creating
-    index_exists = False
-    for index in collection.list_indexes():
-        if "vehicle_id_1_timestamp_1" in str(index["name"]):
-            index_exists = True
-            break
 
-    if not index_exists:
-        print("Creating compound index on vehicle_id and timestamp")
-        collection.create_index(
-            [("vehicle_id", 1), ("timestamp", 1)], unique=True)
+def _save_to_db(data, mongo_uri, db_name, collection_name):
+    import pymongo
+    collection = get_mongo_collection(mongo_uri, db_name, collection_name)
+    ensure_indexes(collection)
 
-    if data:
+    if len(data):
         operations = []
-        for record in data:
+        for record in as_batch(data).records():
             # Check if document already exists
             existing_doc = collection.find_one({
                 "vehicle_id": record["vehicle_id"],
@@ -94,53 +191,241 @@ def save_to_db(data, mongo_uri, db_name, collection_name):
             )
 
         result = collection.bulk_write(operations)
-        print(
+        DB_RECORDS.inc(result.upserted_count, mode="upsert", result="upserted")
+        DB_RECORDS.inc(result.matched_count, mode="upsert", result="matched")
+        DB_RECORDS.inc(result.modified_count, mode="upsert", result="modified")
+        metrics.log(
             f"MongoDB bulk write results: {result.upserted_count} new records inserted, "
-            f"{result.matched_count} records matched, {result.modified_count} existing records modified"
-        )
+            f"{result.matched_count} records matched, {result.modified_count} existing records modified",
+            event="db_write", mode="upsert", upserted=result.upserted_count,
+            matched=result.matched_count, modified=result.modified_count)
+
+
+def insert_new_to_db(data, mongo_uri, db_name, collection_name,
+                     schema=LEGACY, rollups=None):
+    """Insert only the position reports that changed since the last poll.
+
+    Unlike save_to_db, this never reads from the collection. Records whose
+    raw_timestamp matches the last one seen for the same vehicle are dropped
+    in-process, and whatever is left is sent as one unordered insert_many.
+    Reports that are already stored (e.g. after a restart, when the cache is
+    empty) are counted from the bulk write errors. A time-series collection
+    has no unique index to raise those, so there the reports the cache
+    cannot vouch for, of vehicles it does not know or older than their last
+    one (e.g. a spooled group written again after a crash), are looked up
+    in the collection first.
 
+    @param data: A VehicleBatch, or the list of records returned by
+        parse_gtfs.
+    @param schema: The storage layout documents are written in, see
+        schema.py.
+    @param rollups: A rollup.RollupWriter to add the inserted records to
+        the hourly rollups with, after the insert.
+    """
+    with DB_WRITE_SECONDS.time(mode="insert-new"):
+        _insert_new_to_db(data, mongo_uri, db_name, collection_name, schema,
+                          rollups)
+
+
+def _insert_new_to_db(data, mongo_uri, db_name, collection_name, schema,
+                      rollups=None):
+    import pymongo
+    collection = get_mongo_collection(mongo_uri, db_name, collection_name)
+    ensure_indexes(collection, schema)
+
+    batch = as_batch(data)
+    raw_timestamps = batch.columns["raw_timestamp"].tolist()
+    # Row index per report, so a report repeated within one feed, or in
+    # several polls of a spooled group, is only sent once.
+    new_records = {}
+    for i, key in enumerate(zip(batch.columns["vehicle_id"], raw_timestamps)):
+        if last_seen.get(key[0]) == key[1] or key in new_records:
+            continue
+        new_records[key] = i
 
-def fetch_data(api_key, url=DTS_API_URL):
+    stored = set()
+    if schema == TIMESERIES:
+        unsure = [key for key in new_records
+                  if key[0] not in last_seen or key[1] < last_seen[key[0]]]
+        if unsure:
+            stored = stored_reports(collection, unsure, schema)
+
+    skipped = len(batch) - len(new_records)
+    DB_RECORDS.inc(skipped, mode="insert-new", result="skipped")
+    duplicates = len(stored)
+    rows = [i for key, i in new_records.items() if key not in stored]
+    if not rows:
+        DB_RECORDS.inc(duplicates, mode="insert-new", result="duplicate")
+        for vehicle_id, raw_timestamp in new_records:
+            last_seen[vehicle_id] = raw_timestamp
+        print(f"MongoDB insert: no new records, {duplicates} already stored, {skipped} unchanged skipped")
+        return
+
+    # Fresh documents, insert_many adds an _id to every one it is given.
+    documents = batch.documents(schema, rows)
+    failed = set()
+    try:
+        result = collection.insert_many(documents, ordered=False)
+        inserted = len(result.inserted_ids)
+    except pymongo.errors.BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        other_errors = [
+            err for err in write_errors if err.get("code") != DUPLICATE_KEY_ERROR]
+        if other_errors:
+            raise
+        duplicates += len(write_errors)
+        inserted = e.details.get("nInserted", 0)
+        failed = {err["index"] for err in write_errors}
+
+    if rollups is not None:
+        # Only what was inserted, a duplicate is already in the rollups.
+        rollups.write(collection, batch,
+                      [row for i, row in enumerate(rows) if i not in failed])
+
+    # In row order, so each vehicle ends at its latest poll's report.
+    for vehicle_id, raw_timestamp in new_records:
+        last_seen[vehicle_id] = raw_timestamp
+
+    DB_RECORDS.inc(inserted, mode="insert-new", result="inserted")
+    DB_RECORDS.inc(duplicates, mode="insert-new", result="duplicate")
+    metrics.log(
+        f"MongoDB insert results: {inserted} new records inserted, "
+        f"{duplicates} already stored, {skipped} unchanged skipped",
+        event="db_write", mode="insert-new", inserted=inserted,
+        duplicates=duplicates, skipped=skipped)
+
+
+def get_http_session():
+    """Return the shared keep-alive session used for all feed requests."""
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=8)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
+
+
+def fetch_data(api_key, url=DTS_API_URL, timeout=FETCH_TIMEOUT):
+    """Fetch the raw feed from url.
+
+    Sends the ETag/Last-Modified of the previous response for the same url,
+    so an unchanged feed costs a 304 instead of a full download.
+
+    @param timeout: (connect, read) timeouts in seconds.
+
+    @return: The response body, or None on errors and unchanged feeds.
+    """
+    # Label metrics with the feed name, the OTD url carries the api key.
+    feed = next((name for name, feed_url in FEED_URLS.items()
+                 if feed_url == url), "other")
+    feed_url = url
     headers = {}
     if url == DTS_API_URL:
         headers = {"x-api-key": api_key}
     elif url == OTD_API_URL:
         url = url % api_key
-    response = requests.get(url, headers=headers)
+    headers.update(feed_validators.get(url, {}))
+
+    try:
+        with FETCH_SECONDS.time(feed=feed):
+            response = get_http_session().get(
+                url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        FETCHES.inc(feed=feed, result="error")
+        last_fetch_results[feed_url] = "error"
+        print(f"Error fetching data: {e}")
+        return None
+
+    FETCHES.inc(feed=feed, result=str(response.status_code))
+    if response.status_code == 304:
+        last_fetch_results[feed_url] = "not_modified"
+        skipped_cycles["not_modified"] += 1
+        SKIPPED_CYCLES.inc(reason="not_modified")
+        print(f"Feed not modified, skipping cycle. Skipped so far: {skipped_cycles}")
+        return None
     if response.status_code == 200:
+        validators = {}
+        if "ETag" in response.headers:
+            validators["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        feed_validators[url] = validators
+        last_fetch_results[feed_url] = "ok"
+        FEED_BYTES.observe(len(response.content), feed=feed)
         return response.content
     else:
+        last_fetch_results[feed_url] = "error"
         print(f"Error fetching data: {response.status_code} - {response.text}")
         return None
 
 
-def parse_gtfs(data):
+def feed_header_timestamp(data):
+    """Return header.timestamp of a serialized FeedMessage.
+
+    The header is field 1 and serializers write it first, so it is decoded
+    on its own without touching the (much larger) entity list. Falls back to
+    a full parse if the payload does not start with the header.
+    """
+    header = gtfs_realtime_pb2.FeedHeader()
+    # 0x0a is the tag of field 1 with the length-delimited wire type.
+    if data[:1] == b"\x0a":
+        length, shift, pos = 0, 0, 1
+        while pos < len(data):
+            byte = data[pos]
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                header.ParseFromString(data[pos:pos + length])
+                return header.timestamp
+            shift += 7
+
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(data)
-    records = []
-
-    with open(FEED_FILE, "w") as f:
-        f.write(MessageToJson(feed))
-
-    for entity in feed.entity:
-        if entity.HasField("vehicle"):
-            vehicle = entity.vehicle
-            records.append({
-                "entity_wrapper_id": entity.id,
-                "vehicle_id": vehicle.vehicle.id,
-                "route_id": vehicle.trip.route_id,
-                "vehicle_label": vehicle.vehicle.label,
-                "trip_id": vehicle.trip.trip_id,
-                "trip_start_time": vehicle.trip.start_time,
-                "trip_start_date": vehicle.trip.start_date,
-                "latitude": vehicle.position.latitude,
-                "longitude": vehicle.position.longitude,
-                "timestamp": "%s (%s)" % (time.strftime(
-                    '%H:%M:%S %d-%m-%Y', time.localtime(
-                        vehicle.timestamp)), vehicle.timestamp),
-                "raw_timestamp": vehicle.timestamp,
-            })
-    return records
+    return feed.header.timestamp
+
+
+def is_new_feed(data, url):
+    """Return False if data has the same header timestamp as the last feed
+    processed for url, so the cycle can be skipped."""
+    feed_timestamp = feed_header_timestamp(data)
+    if feed_timestamp and last_feed_timestamps.get(url) == feed_timestamp:
+        skipped_cycles["same_header_timestamp"] += 1
+        SKIPPED_CYCLES.inc(reason="same_header_timestamp")
+        print(
+            f"Feed header timestamp {feed_timestamp} unchanged, skipping cycle. Skipped so far: {skipped_cycles}")
+        return False
+    last_feed_timestamps[url] = feed_timestamp
+    return True
+
+
+def parse_vehicle_batch(data, feed_file=None):
+    """Return the vehicle positions of a serialized FeedMessage as a
+    VehicleBatch, see vehicle_batch.py.
+
+    @param feed_file: If given, the whole feed is also dumped there as JSON,
+        for debugging. This is slow on large feeds, see --dump-feed.
+    """
+    start = time.perf_counter()
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+
+    if feed_file:
+        from google.protobuf.json_format import MessageToJson
+        with open(feed_file, "w") as f:
+            f.write(MessageToJson(feed))
+
+    batch = decode_feed(feed)
+    PARSE_SECONDS.observe(time.perf_counter() - start)
+    FEED_ENTITIES.observe(len(feed.entity))
+    return batch
+
+
+def parse_gtfs(data, feed_file=None):
+    """Return the vehicle positions of a serialized FeedMessage as one
+    dict per vehicle."""
+    return parse_vehicle_batch(data, feed_file).records()
 
 
 def read_existing_excel(output_file):
@@ -152,6 +437,7 @@ def read_existing_excel(output_file):
         If the file is unreadable/corrupt, it deletes it and returns None.
         Otherwise, it returns the dataframe.
     """
+    import pandas as pd
     # Debug existing file
     file_size = os.path.getsize(output_file)
     print(f"Found existing file: {output_file}, size: {file_size} bytes")
@@ -176,13 +462,20 @@ def read_existing_excel(output_file):
 
 
 def save_to_excel(data, output_file):
+    with FILE_WRITE_SECONDS.time(format="xlsx"):
+        _save_to_excel(data, output_file)
+
+
+def _save_to_excel(data, output_file):
+    import pandas as pd
     print(f"Number of rows in data: {len(data)}")
-    new_df = pd.DataFrame(data)
+    new_df = as_batch(data).to_pandas()
 
     if not os.path.exists(output_file):
         print(f"Creating new file with {len(new_df)} records")
         with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
             new_df.to_excel(writer, sheet_name='GTFS-RT', index=False)
+        FILE_ROWS.set(len(new_df))
         print(f"New file created and closed: {output_file}")
         return
 
@@ -198,10 +491,7 @@ def save_to_excel(data, output_file):
 
         # Perform deduplication
         combined_df = combined_df.drop_duplicates(
-            subset=['vehicle_id', 'timestamp', 'latitude',
-                    'longitude', 'route_id', 'trip_id'],
-            keep='last'
-        )
+            subset=DEDUP_COLUMNS, keep='last')
 
         # Calculate and log the number of dropped records
         records_dropped = records_before - len(combined_df)
@@ -214,14 +504,107 @@ def save_to_excel(data, output_file):
     print(f"Writing {len(combined_df)} total records to Excel")
     with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
         combined_df.to_excel(writer, sheet_name='GTFS-RT', index=False)
+    FILE_ROWS.set(len(combined_df))
     print(f"Combined file saved and closed: {output_file}")
 
 
-def rotate_excel(output_file):
-    """Rename the excel file with IST timestamp"""
+def segment_dir(output_file):
+    """Directory holding the arrow segments that back output_file"""
+    return f"{output_file.rsplit('.', 1)[0]}_segments"
+
+
+def save_to_segment(data, output_file):
+    """Append one poll's records as a new Arrow IPC segment.
+
+    Each poll writes its own small file next to output_file, so the cost of
+    a poll does not depend on how much was written since the last rotation.
+    The segments are only merged into output_file by compact_segments.
+    They are zstd compressed, to about a third of their size.
+
+    @param data: A VehicleBatch, or the list of records returned by
+        parse_gtfs.
+    @param output_file: The Excel file the segments will be compacted into.
+    """
+    if not len(data):
+        print("No records to append")
+        return
+
+    import pyarrow as pa
+    directory = segment_dir(output_file)
+    os.makedirs(directory, exist_ok=True)
+
+    with FILE_WRITE_SECONDS.time(format="arrow"):
+        table = as_batch(data).to_arrow()
+        segment = os.path.join(directory, "%d.arrow" % time.time_ns())
+        # Write under a temporary name so a crash mid-write never leaves a
+        # truncated segment behind for compact_segments to trip over.
+        tmp_segment = segment + ".tmp"
+        with pa.OSFile(tmp_segment, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(
+                    compression="zstd")) as writer:
+                writer.write_table(table)
+        os.replace(tmp_segment, segment)
+    print(f"Appended {table.num_rows} records to segment: {segment}")
+
+
+def compact_segments(output_file):
+    """Merge all arrow segments of output_file into the Excel file.
+
+    This is the only point where the arrow output mode reads back what it
+    wrote, and it happens once per rotation instead of once per poll.
+    """
+    directory = segment_dir(output_file)
+    if not os.path.isdir(directory):
+        return
+
+    segments = sorted(
+        name for name in os.listdir(directory) if name.endswith(".arrow"))
+    if not segments:
+        return
+
+    import pandas as pd
+    import pyarrow as pa
+    tables = []
+    for name in segments:
+        with pa.memory_map(os.path.join(directory, name), "r") as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    combined_df = pa.concat_tables(tables, promote_options="default").to_pandas()
+
+    if os.path.exists(output_file):
+        existing_df = read_existing_excel(output_file)
+        if existing_df is not None:
+            combined_df = pd.concat(
+                [existing_df, combined_df], ignore_index=True)
+
+    records_before = len(combined_df)
+    combined_df = combined_df.drop_duplicates(
+        subset=DEDUP_COLUMNS, keep='last')
+    print(
+        f"Compacted {len(segments)} segments, dropped {records_before - len(combined_df)} duplicate records")
+
+    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+        combined_df.to_excel(writer, sheet_name='GTFS-RT', index=False)
+    FILE_ROWS.set(len(combined_df))
+    print(f"Wrote {len(combined_df)} records to {output_file}")
+
+    for name in segments:
+        os.remove(os.path.join(directory, name))
+
+
+def rotate_excel(output_file, uploader=None):
+    """Rename the excel file with IST timestamp and upload it to S3.
+
+    If an S3Uploader is given the upload happens in its background thread,
+    otherwise it happens inline before this function returns.
+    """
     if not os.path.exists(output_file):
         return
+    with ROTATE_SECONDS.time():
+        _rotate_excel(output_file, uploader)
+
 
+def _rotate_excel(output_file, uploader):
+    import pytz
     ist = pytz.timezone('Asia/Kolkata')
     # Modified format string to include separators and better ordering
     timestamp = datetime.now(ist).strftime('%Y%m%d_%H%M')
@@ -233,14 +616,22 @@ def rotate_excel(output_file):
         os.rename(output_file, new_filename)
         print(f"Rotated file to: {new_filename}")
 
+        if uploader is not None:
+            uploader.enqueue(new_filename)
+            ROTATIONS.inc(result="queued")
+            return
+
+        import boto3
         s3_client = boto3.client('s3')
         s3_key = os.path.basename(new_filename)
         s3_client.upload_file(new_filename, DST_BUCKET_NAME, s3_key)
 
         print(f"Uploaded {new_filename} to {DST_BUCKET_NAME}")
         os.remove(new_filename)
+        ROTATIONS.inc(result="uploaded")
         print(f"Deleted {new_filename}")
     except Exception as e:
+        ROTATIONS.inc(result="error")
         print(f"Error during file rotation: {e}")
 
 
@@ -255,45 +646,351 @@ def parse_time_to_minutes(time_str):
     raise ValueError("Time must be specified in 'm' (minutes) or 'h' (hours)")
 
 
-def main(
-        api_key, interval, output_file, url, mongo_uri, db_name, collection_name,
-        should_save_to_db, rotation_period):
-    if not should_save_to_db and output_file is None:
-        raise ValueError(
-            "Output file is required when saving to db is disabled.")
+def oldest_segment_time(output_file):
+    """Unix time the oldest arrow segment of output_file was written at, or
+    None if there are none."""
+    directory = segment_dir(output_file)
+    if not os.path.isdir(directory):
+        return None
+    segments = [name for name in os.listdir(directory) if name.endswith(".arrow")]
+    if not segments:
+        return None
+    # Segments are named after the time_ns they were written at.
+    return int(min(segments)[:-len(".arrow")]) / 1e9
+
 
+def file_sink(output_file, output_format, rotation_period, uploader=None):
+    """Return a sink that writes records to output_file and rotates it.
+
+    In the arrow format, the rotation period runs from the oldest segment
+    not yet compacted, so one-shot runs from cron rotate too."""
     last_rotation = time.time()
+    if output_format == "arrow":
+        last_rotation = oldest_segment_time(output_file) or last_rotation
     rotation_period_seconds = rotation_period * 60  # Convert to seconds
 
-    while True:
-        print("Fetching GTFS-RT data...")
-        data = fetch_data(api_key, url)
-        if data:
-            parsed_data = parse_gtfs(data)
-            if output_file:
-                save_to_excel(parsed_data, output_file)
-                # Check if it's time to rotate
-                if time.time() - last_rotation >= rotation_period_seconds:
-                    rotate_excel(output_file)
-                    last_rotation = time.time()
-            if should_save_to_db:
-                save_to_db(parsed_data, mongo_uri, db_name, collection_name)
-        if interval == 0:
-            break
-        time.sleep(interval)
+    def sink(records):
+        nonlocal last_rotation
+        if output_format == "arrow":
+            save_to_segment(records, output_file)
+        else:
+            save_to_excel(records, output_file)
+        # Check if it's time to rotate
+        if time.time() - last_rotation >= rotation_period_seconds:
+            if output_format == "arrow":
+                compact_segments(output_file)
+            rotate_excel(output_file, uploader)
+            last_rotation = time.time()
+            if uploader:
+                print(f"S3 upload stats: {uploader.stats()}")
+    return sink
+
+
+def db_sink(mongo_uri, db_name, collection_name, db_mode, schema=LEGACY,
+            rollups=False):
+    """Return a sink that writes records to the db with the given mode, and
+    to the hourly rollups too if rollups is set (insert-new only)."""
+    writer = None
+    if rollups:
+        import rollup
+        writer = rollup.RollupWriter()
+
+    def sink(records):
+        if db_mode == "insert-new":
+            insert_new_to_db(records, mongo_uri, db_name, collection_name,
+                             schema, writer)
+        else:
+            save_to_db(records, mongo_uri, db_name, collection_name)
+    return sink
+
+
+def parse_feed_spec(spec, default_interval, require_api_key=True):
+    """Parse a --feed value of the form NAME:API_KEY_ENV_VAR[:INTERVAL]."""
+    parts = spec.split(":")
+    if len(parts) not in (2, 3) or parts[0].lower() not in FEED_URLS:
+        raise ValueError(
+            f"Invalid feed {spec}, expected NAME:API_KEY_ENV_VAR[:INTERVAL] with NAME one of {', '.join(FEED_URLS)}")
+    name, env_var = parts[0].lower(), parts[1]
+    interval = int(parts[2]) if len(parts) == 3 else default_interval
+
+    api_key = os.getenv(env_var, default=None)
+    if api_key is None and require_api_key:
+        raise ValueError(
+            f"API_KEY env var is not set. Please set the {env_var} environment variable.")
+    return Feed(name, FEED_URLS[name], api_key, interval)
+
+
+def drop_seen_reports(batch):
+    """Drop reports whose (vehicle_id, raw_timestamp) was already passed on to
+    the sinks, e.g. because another feed reported the same position first."""
+    fresh = []
+    for i, (vehicle_id, raw_timestamp) in enumerate(zip(
+            batch.columns["vehicle_id"],
+            batch.columns["raw_timestamp"].tolist())):
+        seen = recent_reports.setdefault(
+            vehicle_id, collections.deque(maxlen=RECENT_REPORTS_PER_VEHICLE))
+        if raw_timestamp in seen:
+            continue
+        seen.append(raw_timestamp)
+        fresh.append(i)
+
+    if len(fresh) == len(batch):
+        return batch
+    print(
+        f"Dropped {len(batch) - len(fresh)} reports already seen in an earlier poll or another feed")
+    return batch.take(fresh)
+
+
+def main(
+        feeds, output_file, mongo_uri, db_name, collection_name,
+        should_save_to_db, rotation_period, db_mode="upsert",
+        output_format="xlsx", upload_queue_dir=UPLOAD_QUEUE_DIR,
+        pipelined=False, queue_size=2, fetch_timeout=FETCH_TIMEOUT,
+        schema=LEGACY, archive_dir=None, dump_feed=False, replay=None,
+        live_port=None, compress_tolerance_m=None,
+        keepalive_seconds=trajectory.DEFAULT_KEEPALIVE_SECONDS,
+        rollups=False, schedule="fixed",
+        min_interval=scheduler.DEFAULT_MIN_INTERVAL,
+        max_interval=scheduler.DEFAULT_MAX_INTERVAL, spool_dir=None,
+        commit_records=spool.DEFAULT_COMMIT_RECORDS,
+        commit_seconds=spool.DEFAULT_COMMIT_SECONDS):
+    """Poll feeds and write what they report to the file and/or db sinks.
+
+    @param feeds: List of Feed. A single feed is polled serially unless
+        pipelined is set. Several feeds are always polled concurrently, and
+        their records are tagged with a source field and deduplicated
+        before reaching the sinks.
+    @param archive_dir: If given, every new snapshot is appended to a
+        FeedArchive in a subdirectory per feed name. It can be the only
+        output, e.g. of one-shot runs from cron that are replayed into the
+        other sinks later.
+    @param dump_feed: Also dump every parsed feed to FEED_FILE as JSON.
+    @param replay: A (start, end) window in unix seconds, either may be
+        None. Instead of polling, the snapshots archived in archive_dir in
+        that window are parsed and written to the sinks as fast as they
+        can be read.
+    @param live_port: If given, the latest position of every vehicle is
+        kept in a LiveStore, queryable over HTTP on this port.
+    @param compress_tolerance_m: If given, only the points that change a
+        vehicle's trajectory by more than this many meters, or are
+        keepalive_seconds after its last stored one, reach the file and db
+        sinks, see trajectory.py. The live store still gets every point.
+    @param rollups: Also keep the hourly per-vehicle and per-route rollups
+        of the db collection up to date, see rollup.py.
+    @param schedule: "fixed" fetches every feed.interval seconds.
+        "adaptive" learns each feed's refresh period and times fetches for
+        just after its refreshes, between min_interval and max_interval
+        seconds apart, see scheduler.py. feed.interval is then only the
+        interval until the period is learned.
+    @param spool_dir: If given, records for the db are appended to a Spool
+        in this directory and written to the db from a background thread,
+        in groups of commit_records or every commit_seconds, see spool.py.
+    """
+    if not should_save_to_db and output_file is None and live_port is None \
+            and (archive_dir is None or replay is not None):
+        raise ValueError(
+            "Output file, live port or archive directory is required when saving to db is disabled.")
+    if should_save_to_db and schema != LEGACY and db_mode != "insert-new":
+        raise ValueError(
+            f"The {schema} schema is only written with --db-mode insert-new.")
+    if should_save_to_db and rollups and db_mode != "insert-new":
+        raise ValueError("Rollups are only written with --db-mode insert-new.")
+    if replay is not None and archive_dir is None:
+        raise ValueError("Replaying requires an archive directory.")
+    one_shot = all(feed.interval == 0 for feed in feeds)
+    if not one_shot and any(feed.interval == 0 for feed in feeds):
+        raise ValueError(
+            "Either every feed or none of them must use a 0 (single fetch) interval.")
+
+    uploader = None
+    # A one-shot run exits right after its poll, before a background
+    # upload would be done, so it uploads its rotations inline.
+    if output_file and upload_queue_dir and not one_shot:
+        from s3_uploader import S3Uploader
+        uploader = S3Uploader(DST_BUCKET_NAME, upload_queue_dir).start()
+
+    sinks = []
+    if output_file:
+        sinks.append(("file", file_sink(
+            output_file, output_format, rotation_period, uploader)))
+    db_spool = None
+    if should_save_to_db:
+        sink = db_sink(mongo_uri, db_name, collection_name, db_mode, schema,
+                       rollups)
+        if spool_dir:
+            sink = db_spool = spool.Spool(
+                spool_dir, sink, commit_records, commit_seconds).start()
+        sinks.append(("db", sink))
+    store = None
+    if live_port is not None:
+        import live_store
+        store = live_store.LiveStore()
+        live_store.serve(store, live_port)
+    compressor = None
+    if compress_tolerance_m is not None:
+        compressor = trajectory.TrajectoryCompressor(
+            compress_tolerance_m, keepalive_seconds)
+
+    archives = {}
+    if archive_dir:
+        archives = {feed.name: FeedArchive(os.path.join(archive_dir, feed.name))
+                    for feed in feeds}
+    feed_file = FEED_FILE if dump_feed else None
+    clocks = {}
+    if schedule == "adaptive" and not one_shot and replay is None:
+        clocks = {feed.name: scheduler.AdaptiveClock(
+            feed.name, feed.interval, min_interval, max_interval)
+            for feed in feeds}
+
+    def parse(name, data):
+        batch = parse_vehicle_batch(data, feed_file)
+        if name in clocks:
+            clocks[name].observe_vehicles(batch.columns["raw_timestamp"])
+        if len(feeds) > 1:
+            batch = drop_seen_reports(batch.with_source(name))
+        if store is not None:
+            store.update(batch)
+        if compressor is not None:
+            batch = compressor.compress(batch)
+            metrics.log(f"Storing {len(batch)} trajectory points",
+                        event="compress", stored=len(batch),
+                        **compressor.stats())
+        return batch
+
+    def finish():
+        """Write the points the compressor still holds back, and what is
+        spooled for the db."""
+        for name, clock in clocks.items():
+            print(f"{name} schedule stats: {clock.stats()}")
+        if compressor is not None:
+            records = compressor.flush()
+            if len(records):
+                for _, sink in sinks:
+                    sink(records)
+            print(f"Trajectory compression stats: {compressor.stats()}")
+        if db_spool is not None:
+            db_spool.close()
+
+    if replay is not None:
+        start, end = replay
+        # Merge the feeds' archives in fetch order, like they were polled.
+        snapshots = heapq.merge(
+            *[((fetched_at, name, data)
+               for fetched_at, _, data in archive.read(start, end))
+              for name, archive in archives.items()],
+            key=lambda snapshot: snapshot[0])
+        replayed = 0
+        for _, name, data in snapshots:
+            records = parse(name, data)
+            for _, sink in sinks:
+                sink(records)
+            replayed += 1
+        finish()
+        print(f"Replayed {replayed} archived snapshots")
+        return
+
+    def fetcher(feed):
+        def fetch():
+            print(f"Fetching GTFS-RT data from {feed.name}...")
+            data = fetch_data(feed.api_key, feed.url, fetch_timeout)
+            clock = clocks.get(feed.name)
+            if data and not is_new_feed(data, feed.url):
+                if clock is not None:
+                    clock.observe(scheduler.UNCHANGED)
+                return None
+            if clock is not None:
+                if data:
+                    clock.observe(scheduler.NEW,
+                                  refreshed_at=last_feed_timestamps[feed.url])
+                elif last_fetch_results.get(feed.url) == "not_modified":
+                    clock.observe(scheduler.UNCHANGED)
+                else:
+                    clock.observe(scheduler.ERROR)
+            if data and feed.name in archives:
+                archives[feed.name].append(
+                    data, feed_timestamp=last_feed_timestamps[feed.url])
+            return data
+        return fetch
+
+    if len(feeds) > 1 or pipelined:
+        runner = Pipeline(
+            [(feed.name, fetcher(feed), clocks.get(feed.name, feed.interval))
+             for feed in feeds],
+            parse, sinks, queue_size)
+        try:
+            runner.run(cycles=1 if one_shot else None)
+        finally:
+            print(f"Pipeline stats: {runner.stats()}")
+            finish()
+        return
+
+    feed = feeds[0]
+    fetch = fetcher(feed)
+    # Ticks on a fixed schedule like the pipeline's fetchers, so the time
+    # a cycle takes does not push the next one back.
+    adaptive = clocks.get(feed.name)
+    clock = adaptive if adaptive is not None else FixedRateClock(feed.interval)
+    try:
+        while True:
+            missed_ticks = clock.missed_ticks
+            scheduled = clock.wait()
+            started = time.time()
+            CYCLE_LAG_SECONDS.observe(started - scheduled, feed=feed.name)
+            MISSED_TICKS.inc(clock.missed_ticks - missed_ticks,
+                             fetcher=feed.name)
+            data = fetch()
+            # Archiving alone needs no parsing, see --archive-dir.
+            if data and (sinks or store is not None or adaptive is not None):
+                parsed_data = parse(feed.name, data)
+                for _, sink in sinks:
+                    sink(parsed_data)
+            cycle_seconds = time.time() - started
+            CYCLE_SECONDS.observe(cycle_seconds, feed=feed.name)
+            metrics.log(f"{feed.name} cycle took {cycle_seconds:.3f}s",
+                        event="cycle", feed=feed.name, seconds=cycle_seconds,
+                        new_feed=bool(data))
+            if feed.interval == 0:
+                break
+    finally:
+        finish()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Fetch and store GTFS-RT data for Delhi Buses.")
-    parser.add_argument("--api-key-env-var", required=True,
-                        help="API key env var, for authentication. This env var is set by the caller of this script, typically via a .env file.")
+    parser.add_argument("--api-key-env-var", required=False,
+                        help="API key env var, for authentication. This env var is set by the caller of this script, typically via a .env file. Required unless --feed is used.")
     parser.add_argument("--interval", type=int, required=False,
-                        help="Polling interval in seconds (0 for single fetch).", default=0)
+                        help="Polling interval in seconds (0 for single fetch, e.g. from cron with --output-format arrow).", default=0)
     parser.add_argument("--output-file", required=False,
                         help="Output Excel file to store data. If provided, data is stored here AND in the db, otherwise only in the db (see --save-to-db).", default=None)
+    parser.add_argument("--output-format", required=False,
+                        choices=["xlsx", "arrow"], default="xlsx",
+                        help="How records are written to --output-file. 'xlsx' rewrites the workbook on every poll, 'arrow' appends each poll to a compressed arrow segment and only builds the workbook on rotation.")
+    parser.add_argument("--schedule", required=False, choices=["fixed", "adaptive"],
+                        default="fixed",
+                        help="'fixed' fetches every --interval seconds. 'adaptive' learns each feed's refresh period from its header and vehicle timestamps and fetches just after it refreshes, starting at --interval, see scheduler.py.")
+    parser.add_argument("--min-interval", type=float, required=False,
+                        default=scheduler.DEFAULT_MIN_INTERVAL,
+                        help="With --schedule adaptive, never fetch a feed more often than this many seconds.")
+    parser.add_argument("--max-interval", type=float, required=False,
+                        default=scheduler.DEFAULT_MAX_INTERVAL,
+                        help="With --schedule adaptive, fetch a feed at least this often, in seconds, even while it backs off.")
+    parser.add_argument("--pipeline", required=False, action="store_true",
+                        help="Run fetch, parse and each sink as concurrent stages. Fetches fire every --interval seconds regardless of how long parsing and writing take.")
+    parser.add_argument("--queue-size", type=int, required=False, default=2,
+                        help="Snapshots each --pipeline stage can buffer before applying backpressure.")
+    parser.add_argument("--connect-timeout", type=float, required=False,
+                        help="Seconds to wait for the feed server to accept a connection.", default=FETCH_TIMEOUT[0])
+    parser.add_argument("--read-timeout", type=float, required=False,
+                        help="Seconds to wait for the feed server to send data.", default=FETCH_TIMEOUT[1])
+    parser.add_argument("--upload-queue-dir", required=False,
+                        help="Directory rotated files wait in until a background thread has uploaded them to S3. Files left here by a restart are uploaded on the next start. Pass an empty string to upload inline instead. Single fetch runs (--interval 0) always upload inline.",
+                        default=UPLOAD_QUEUE_DIR)
     parser.add_argument("--url-enum", required=False,
                         help="either DTS for Delhi Transport Stack or OTD for Open Transit Data url.")
+    parser.add_argument("--feed", required=False, action="append", default=[],
+                        help="Feed to poll, as NAME:API_KEY_ENV_VAR[:INTERVAL], e.g. DTS:DTS_API_KEY:30. Repeat to poll several feeds concurrently in one process. Overrides --url-enum and --api-key-env-var; INTERVAL defaults to --interval.")
 
     parser.add_argument("--mongo-uri", required=False,
                         help="MongoDB connection URI", default="mongodb://localhost:27017")
@@ -303,22 +1000,77 @@ if __name__ == "__main__":
                         help="MongoDB collection name", default="vehicles")
     parser.add_argument("--skip-db", required=False,
                         help="Skip saving to db?", type=bool, default=False)
+    parser.add_argument("--db-mode", required=False,
+                        choices=["upsert", "insert-new"], default="upsert",
+                        help="How records are written to the db. 'upsert' checks and upserts every record, 'insert-new' only inserts reports that changed since the last poll.")
+    parser.add_argument("--schema", required=False, choices=SCHEMAS, default=LEGACY,
+                        help="Layout of the documents written to the db. 'compact' and 'timeseries' store a BSON date, an integer epoch and the vehicle/route/trip fields under meta, see schema.py. They require --db-mode insert-new.")
+    parser.add_argument("--spool-dir", required=False, default=None,
+                        help="Append records for the db to a durable spool in this directory and write them to the db in groups from a background thread, so a slow or down mongod never blocks polling or loses data, see spool.py.")
+    parser.add_argument("--commit-records", type=int, required=False,
+                        default=spool.DEFAULT_COMMIT_RECORDS,
+                        help="With --spool-dir, write to the db once this many records are spooled.")
+    parser.add_argument("--commit-seconds", type=float, required=False,
+                        default=spool.DEFAULT_COMMIT_SECONDS,
+                        help="With --spool-dir, write to the db at least this often, in seconds.")
     parser.add_argument("--rotation-period", required=False,
                         help="Period for excel file rotation (e.g., '60m' or '1h')",
                         default="60m")
+    parser.add_argument("--archive-dir", required=False, default=None,
+                        help="Directory to append every new raw feed snapshot to, zlib-compressed in hourly segments per feed, see feed_archive.py. Can be the only output, e.g. of --interval 0 runs from cron, replayed with --replay later.")
+    parser.add_argument("--dump-feed", required=False, action="store_true",
+                        help=f"Dump every parsed feed to {FEED_FILE} as JSON, for debugging.")
+    parser.add_argument("--replay", required=False, action="store_true",
+                        help="Instead of polling, write the snapshots archived in --archive-dir to the sinks, as fast as they can be read. No API key is needed.")
+    parser.add_argument("--replay-start", required=False, default=None,
+                        help="Only replay snapshots fetched at or after this time, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds.")
+    parser.add_argument("--replay-end", required=False, default=None,
+                        help="Only replay snapshots fetched at or before this time, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds.")
+    parser.add_argument("--metrics-port", type=int, required=False, default=None,
+                        help="Serve Prometheus metrics of every poll stage on http://0.0.0.0:PORT/metrics.")
+    parser.add_argument("--log-format", required=False, choices=["text", "json"],
+                        default="text", help="'json' writes every log line as a JSON object, with structured fields for fetches, db writes and cycles.")
+    parser.add_argument("--live-port", type=int, required=False, default=None,
+                        help="Keep the latest position of every vehicle in memory and serve nearest, bounding box and route queries on http://0.0.0.0:PORT/, see live_store.py.")
+    parser.add_argument("--compress-tolerance-m", type=float, required=False, default=None,
+                        help="Only store the points that move a vehicle's trajectory by more than this many meters (e.g. 15), see trajectory.py. Off by default.")
+    parser.add_argument("--keepalive-seconds", type=int, required=False,
+                        default=trajectory.DEFAULT_KEEPALIVE_SECONDS,
+                        help="With --compress-tolerance-m, still store a point of every reporting vehicle at least this often.")
+    parser.add_argument("--rollups", required=False, action="store_true",
+                        help="Keep hourly per-vehicle and per-route rollups next to the collection, for report.py --from-rollups. Requires --db-mode insert-new, see rollup.py.")
     args = parser.parse_args()
 
-    api_key = os.getenv(args.api_key_env_var, default=None)
-    if api_key is None:
-        raise ValueError(
-            f"API_KEY env var is not set. Please set the {args.api_key_env_var} environment variable.")
+    if args.log_format == "json":
+        metrics.use_json_logs()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    if args.feed:
+        feeds = [parse_feed_spec(spec, args.interval, not args.replay)
+                 for spec in args.feed]
+    else:
+        if args.api_key_env_var is None and not args.replay:
+            raise ValueError("Either --api-key-env-var or --feed is required.")
+        url_enum = "otd" if (args.url_enum or "").lower() == "otd" else "dts"
+        feeds = [parse_feed_spec(
+            f"{url_enum}:{args.api_key_env_var or ''}", args.interval,
+            not args.replay)]
+
+    replay = None
+    if args.replay:
+        replay = tuple(parse_time_arg(value) if value else None
+                       for value in (args.replay_start, args.replay_end))
 
     # Convert rotation period to minutes
     rotation_period = parse_time_to_minutes(args.rotation_period)
 
-    if args.url_enum.lower() == "otd":
-        main(api_key, args.interval, args.output_file, OTD_API_URL,
-             args.mongo_uri, args.db_name, args.collection_name, not args.skip_db, rotation_period)
-    else:
-        main(api_key, args.interval, args.output_file, DTS_API_URL,
-             args.mongo_uri, args.db_name, args.collection_name, not args.skip_db, rotation_period)
+    main(feeds, args.output_file, args.mongo_uri, args.db_name,
+         args.collection_name, not args.skip_db, rotation_period,
+         args.db_mode, args.output_format, args.upload_queue_dir,
+         args.pipeline, args.queue_size,
+         (args.connect_timeout, args.read_timeout), args.schema,
+         args.archive_dir, args.dump_feed, replay, args.live_port,
+         args.compress_tolerance_m, args.keepalive_seconds, args.rollups,
+         args.schedule, args.min_interval, args.max_interval,
+         args.spool_dir, args.commit_records, args.commit_seconds)
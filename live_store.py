@@ -0,0 +1,300 @@
+"""In-memory table of the latest position of every vehicle, with a query API.
+
+The poller updates a LiveStore from every parsed batch (see --live-port in
+gtfs_rt_fetcher.py). Positions are indexed by a fixed grid of
+cell_degrees x cell_degrees cells and by route, so the HTTP API answers
+from memory, without touching Mongo:
+
+    GET /vehicles/<vehicle_id>
+    GET /routes/<route_id>
+    GET /nearest?lat=28.63&lon=77.22&k=5[&max_km=2]
+    GET /bbox?min_lat=28.6&min_lon=77.2&max_lat=28.7&max_lon=77.3
+
+Every response is a JSON object with the matching vehicles, their count
+and the time the query took.
+"""
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+import metrics
+from distance_engine import haversine_km
+from schema import latest_plausible_epoch
+from vehicle_batch import as_batch
+
+# Fields kept per vehicle, besides its position.
+FIELDS = ["vehicle_id", "route_id", "trip_id", "vehicle_label",
+          "raw_timestamp"]
+
+# ~1.1km of latitude per cell.
+DEFAULT_CELL_DEGREES = 0.01
+
+# Vehicles not heard from for this long, in feed time, are dropped.
+DEFAULT_MAX_AGE_SECONDS = 30 * 60
+
+KM_PER_DEGREE = 111.19
+
+# Rings nearest walks before measuring every vehicle instead.
+MAX_RINGS = 64
+
+LIVE_VEHICLES = metrics.Gauge(
+    "live_store_vehicles", "Vehicles in the live position table.")
+FUTURE_REPORTS = metrics.Counter(
+    "live_store_future_reports_total", "Reports ignored for a vehicle clock ahead of the feed.")
+QUERY_SECONDS = metrics.Histogram(
+    "live_store_query_seconds", "Time to answer a live position query.",
+    ["query"])
+
+
+class LiveStore:
+    """Latest position per vehicle_id, indexed by grid cell and route."""
+
+    def __init__(self, cell_degrees=DEFAULT_CELL_DEGREES,
+                 max_age_seconds=DEFAULT_MAX_AGE_SECONDS):
+        self.cell_degrees = cell_degrees
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.vehicles = {}
+        self.cells = {}
+        self.routes = {}
+        # Feed time, in unix seconds, that max_age_seconds is measured from.
+        self.latest = 0
+        # (min row, max row, min col, max col) of the occupied cells.
+        self.extent = None
+
+    def cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees),
+                math.floor(lon / self.cell_degrees))
+
+    def update(self, data):
+        """Apply a VehicleBatch, or parse_gtfs records. Older reports than
+        the one stored for a vehicle are ignored, and so are reports from
+        a clock ahead of the feed (see latest_plausible_epoch), which would
+        otherwise pin their vehicle until the clock catches up."""
+        batch = as_batch(data)
+        columns = {name: batch.columns[name].tolist()
+                   for name in FIELDS + ["latitude", "longitude"]
+                   if name in batch.columns}
+        names = list(columns)
+        latest_plausible = latest_plausible_epoch(batch.columns["raw_timestamp"])
+        with self.lock:
+            for values in zip(*columns.values()):
+                position = dict(zip(names, values))
+                vehicle_id = position["vehicle_id"]
+                if position["raw_timestamp"] > latest_plausible:
+                    FUTURE_REPORTS.inc()
+                    continue
+                current = self.vehicles.get(vehicle_id)
+                if current and current["raw_timestamp"] > position["raw_timestamp"]:
+                    continue
+                if current:
+                    self._unindex(current)
+                self.vehicles[vehicle_id] = position
+                self.cells.setdefault(
+                    self.cell(position["latitude"], position["longitude"]),
+                    set()).add(vehicle_id)
+                self.routes.setdefault(position.get("route_id"),
+                                       set()).add(vehicle_id)
+            if len(batch):
+                # Feeds carry the odd vehicle clock decades off, so the
+                # feed's time is the batch's median, not its maximum.
+                self.latest = max(self.latest, int(np.median(
+                    batch.columns["raw_timestamp"])))
+            self._expire()
+            rows = [cell[0] for cell in self.cells]
+            cols = [cell[1] for cell in self.cells]
+            self.extent = (min(rows), max(rows), min(cols), max(cols)) \
+                if self.cells else None
+            LIVE_VEHICLES.set(len(self.vehicles))
+
+    def _unindex(self, position):
+        for index, key in (
+                (self.cells, self.cell(position["latitude"], position["longitude"])),
+                (self.routes, position.get("route_id"))):
+            members = index[key]
+            members.discard(position["vehicle_id"])
+            if not members:
+                del index[key]
+
+    def _expire(self):
+        if not self.max_age_seconds:
+            return
+        oldest = self.latest - self.max_age_seconds
+        for vehicle_id in [vehicle_id for vehicle_id, position
+                           in self.vehicles.items()
+                           if position["raw_timestamp"] < oldest]:
+            self._unindex(self.vehicles.pop(vehicle_id))
+
+    def get(self, vehicle_id):
+        with self.lock:
+            return self.vehicles.get(vehicle_id)
+
+    def route(self, route_id):
+        with self.lock:
+            return [self.vehicles[v] for v in self.routes.get(route_id, ())]
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Vehicles inside the box, edges included."""
+        (min_row, min_col), (max_row, max_col) = \
+            self.cell(min_lat, min_lon), self.cell(max_lat, max_lon)
+        found = []
+        with self.lock:
+            # Walk whichever is smaller, the cells under the box or the
+            # cells that hold vehicles.
+            if (max_row - min_row + 1) * (max_col - min_col + 1) < len(self.cells):
+                cells = ((row, col) for row in range(min_row, max_row + 1)
+                         for col in range(min_col, max_col + 1))
+            else:
+                cells = (cell for cell in self.cells
+                         if min_row <= cell[0] <= max_row and
+                         min_col <= cell[1] <= max_col)
+            for cell in cells:
+                for vehicle_id in self.cells.get(cell, ()):
+                    position = self.vehicles[vehicle_id]
+                    if min_lat <= position["latitude"] <= max_lat and \
+                            min_lon <= position["longitude"] <= max_lon:
+                        found.append(position)
+        return found
+
+    def nearest(self, lat, lon, k=5, max_km=None):
+        """The k vehicles closest to (lat, lon), nearest first, each with
+        a distance_km field.
+
+        Searches rings of grid cells around the point's cell, from the
+        first one reaching the occupied cells, until the k-th closest
+        candidate is nearer than anything outside the rings can be. Once a
+        ring would hold more cells than there are vehicles, or after
+        MAX_RINGS rings, e.g. for a point far from every vehicle, the
+        distance to every vehicle is measured instead.
+        """
+        row, col = self.cell(lat, lon)
+        candidates = []
+        distances = np.empty(0)
+        with self.lock:
+            if not self.extent:
+                return []
+            min_row, max_row, min_col, max_col = self.extent
+            max_ring = max(abs(row - min_row), abs(row - max_row),
+                           abs(col - min_col), abs(col - max_col))
+            # Rings closer than the occupied cells are empty.
+            first_ring = max(0, min_row - row, row - max_row,
+                             min_col - col, col - max_col)
+            ring = first_ring
+            while ring <= max_ring:
+                if ring - first_ring >= MAX_RINGS or \
+                        8 * ring > len(self.vehicles):
+                    candidates = list(self.vehicles.values())
+                    distances = _distances(candidates, lat, lon)
+                    break
+                found = [self.vehicles[v]
+                         for cell in _ring_cells(row, col, ring)
+                         for v in self.cells.get(cell, ())]
+                if found:
+                    candidates.extend(found)
+                    distances = np.concatenate(
+                        [distances, _distances(found, lat, lon)])
+                # Points outside the rings are at least ring cells away.
+                outside_km = ring * self.cell_degrees * KM_PER_DEGREE * \
+                    math.cos(math.radians(min(89.0, abs(lat) + (ring + 1) * self.cell_degrees)))
+                if max_km is not None and outside_km > max_km:
+                    break
+                if len(candidates) >= k and \
+                        np.partition(distances, k - 1)[k - 1] <= outside_km:
+                    break
+                ring += 1
+
+        order = np.argsort(distances, kind="stable")[:k]
+        return [dict(candidates[i], distance_km=round(float(distances[i]), 4))
+                for i in order
+                if max_km is None or distances[i] <= max_km]
+
+    def __len__(self):
+        return len(self.vehicles)
+
+
+def _ring_cells(row, col, ring):
+    """The cells at Chebyshev distance ring from (row, col)."""
+    if ring == 0:
+        yield row, col
+        return
+    for c in range(col - ring, col + ring + 1):
+        yield row - ring, c
+        yield row + ring, c
+    for r in range(row - ring + 1, row + ring):
+        yield r, col - ring
+        yield r, col + ring
+
+
+def _distances(positions, lat, lon):
+    lats = np.fromiter((p["latitude"] for p in positions), np.float64,
+                       len(positions))
+    lons = np.fromiter((p["longitude"] for p in positions), np.float64,
+                       len(positions))
+    return haversine_km(lat, lon, lats, lons)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    store = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        start = time.perf_counter()
+        try:
+            query, vehicles = self._query(parts, params)
+        except (KeyError, ValueError) as e:
+            self._reply(400, {"error": f"Bad query {self.path}: {e}"})
+            return
+        if query is None:
+            self._reply(404, {"error": f"Unknown path {url.path}"})
+            return
+        seconds = time.perf_counter() - start
+        QUERY_SECONDS.observe(seconds, query=query)
+        self._reply(200, {"count": len(vehicles), "vehicles": vehicles,
+                          "took_ms": round(seconds * 1000, 3)})
+
+    def _query(self, parts, params):
+        store = self.store
+        if len(parts) == 2 and parts[0] == "vehicles":
+            position = store.get(parts[1])
+            return "vehicle", [position] if position else []
+        if len(parts) == 2 and parts[0] == "routes":
+            return "route", store.route(parts[1])
+        if parts == ["nearest"]:
+            max_km = params.get("max_km")
+            return "nearest", store.nearest(
+                float(params["lat"]), float(params["lon"]),
+                int(params.get("k", 5)),
+                float(max_km) if max_km is not None else None)
+        if parts == ["bbox"]:
+            return "bbox", store.bbox(
+                float(params["min_lat"]), float(params["min_lon"]),
+                float(params["max_lat"]), float(params["max_lon"]))
+        return None, None
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(store, port, host="0.0.0.0"):
+    """Serve the query API for store on port from a daemon thread."""
+    handler = type("Handler", (_Handler,), {"store": store})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="live-store",
+                     daemon=True).start()
+    print(f"Serving live positions on http://{host}:{server.server_address[1]}/")
+    return server
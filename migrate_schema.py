@@ -0,0 +1,94 @@
+"""Copy a legacy vehicles collection into the compact or timeseries layout.
+
+Documents are streamed from the source in _id order and inserted in
+unordered batches. Progress (the last migrated _id) is saved in the
+target database after every batch, so an interrupted migration picks up
+where it stopped when run again. A compact target skips documents it
+already holds; a timeseries target has no unique index, so a crash
+between a batch and its progress update duplicates that one batch.
+
+    $ python3 migrate_schema.py --source-collection vehicles \
+        --target-collection vehicles_ts --schema timeseries
+"""
+import argparse
+
+import pymongo
+
+from schema import COMPACT, TIMESERIES, ensure_collection, to_document
+
+# MongoDB error code for a unique index violation.
+DUPLICATE_KEY_ERROR = 11000
+
+PROGRESS_COLLECTION = "schema_migrations"
+
+
+def migrate(db, source_name, target_name, schema, batch_size=10000):
+    source = db[source_name]
+    target = ensure_collection(db, target_name, schema)
+    progress = db[PROGRESS_COLLECTION]
+    progress_id = f"{source_name}->{target_name}"
+
+    query = {}
+    saved = progress.find_one({"_id": progress_id})
+    if saved:
+        query = {"_id": {"$gt": saved["last_id"]}}
+        print(f"Resuming migration after _id {saved['last_id']}, "
+              f"{saved['migrated']} documents already migrated")
+    migrated = saved["migrated"] if saved else 0
+
+    cursor = source.find(query, batch_size=batch_size).sort("_id", 1)
+    batch = []
+    last_id = None
+    for doc in cursor:
+        last_id = doc.pop("_id")
+        batch.append(to_document(doc, schema))
+        if len(batch) >= batch_size:
+            migrated += insert_batch(target, batch)
+            progress.replace_one(
+                {"_id": progress_id},
+                {"last_id": last_id, "migrated": migrated}, upsert=True)
+            print(f"Migrated {migrated} documents")
+            batch = []
+    if batch:
+        migrated += insert_batch(target, batch)
+        progress.replace_one(
+            {"_id": progress_id},
+            {"last_id": last_id, "migrated": migrated}, upsert=True)
+
+    print(f"Migration of {source_name} to {target_name} ({schema}) done, "
+          f"{migrated} documents migrated")
+    return migrated
+
+
+def insert_batch(collection, documents):
+    """Insert documents, skipping the ones the target already holds."""
+    try:
+        return len(collection.insert_many(
+            documents, ordered=False).inserted_ids)
+    except pymongo.errors.BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != DUPLICATE_KEY_ERROR for err in write_errors):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy a legacy vehicles collection into a typed layout.")
+    parser.add_argument("--mongo-uri", required=False,
+                        help="MongoDB connection URI", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", required=False,
+                        help="MongoDB database name", default="gearchange")
+    parser.add_argument("--source-collection", required=False,
+                        help="Legacy collection to read", default="vehicles")
+    parser.add_argument("--target-collection", required=True,
+                        help="Collection to write, created if missing")
+    parser.add_argument("--schema", required=False, choices=[COMPACT, TIMESERIES],
+                        default=TIMESERIES, help="Layout of the target collection")
+    parser.add_argument("--batch-size", type=int, required=False, default=10000,
+                        help="Documents inserted per round trip")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    migrate(client[args.db_name], args.source_collection,
+            args.target_collection, args.schema, args.batch_size)
@@ -1,22 +1,363 @@
+"""Export the vehicles collection to xlsx, csv or parquet files.
+
+Documents are streamed from a batched cursor straight into the output, so
+neither the collection nor a sheet is ever held in memory as a whole.
+Optional filters narrow the export to a time range and/or routes.
+
+Outputs can be split per day (one file per local calendar day) and by row
+count (xlsx sheets hold at most 1,048,576 rows), and day partitions can be
+exported by several worker processes at once.
+
+With --snapshot-dir, positions are read from a Parquet snapshot (see
+snapshot.py) instead of Mongo, with its columns, and only the date
+partitions in the requested range are read.
+
+    $ python3 mongo_to_excel.py
+    $ python3 mongo_to_excel.py --format parquet --partition day --workers 4 \\
+        --start 2025-03-01 --end 2025-03-08 --route 534 --route 544
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pymongo
-import pandas as pd
+from openpyxl import Workbook
+
+from feed_archive import parse_time_arg
+from schema import FIELDS, LEGACY, META_FIELDS, SCHEMAS, get_field, time_query
+from snapshot import SCHEMA as SNAPSHOT_SCHEMA, read_rows, time_bounds
+from vehicle_batch import RECORD_COLUMNS
+
+# Documents fetched from Mongo per round trip.
+BATCH_SIZE = 10000
+
+# Data rows an xlsx sheet can hold below its header.
+XLSX_MAX_ROWS = 1048575
+
+# Rows buffered per parquet row group.
+PARQUET_ROW_GROUP = 50000
+
+FORMATS = ["xlsx", "csv", "parquet"]
+
+# Arrow types of the parquet columns that are not strings.
+PARQUET_TYPES = {
+    "latitude": pa.float64(), "longitude": pa.float64(),
+    "lat": pa.float64(), "lon": pa.float64(),
+    "raw_timestamp": pa.int64(), "epoch": pa.int64(),
+    "ts": pa.timestamp("ms", tz="UTC"),
+}
+
+client = None
 
-# Connect to MongoDB
-client = pymongo.MongoClient("mongodb://localhost:27017/")
-db = client["gearchange"]
-collection = db["vehicles"]
 
-# Fetch all vehicle data
-data = list(collection.find())
+def get_collection(mongo_uri, db_name, collection_name):
+    global client
+    if client is None:
+        client = pymongo.MongoClient(mongo_uri)
+    return client[db_name][collection_name]
 
-# Convert ObjectId to string
-for doc in data:
+
+def flatten(doc, schema):
+    """Return doc as a flat dict, with the _id as a string.
+
+    Typed layouts keep vehicle, route and trip fields under meta, those
+    become columns of their own.
+    """
+    # Convert ObjectId to string
     doc["_id"] = str(doc["_id"])
+    if schema != LEGACY:
+        doc.update(doc.pop("meta", {}))
+    return doc
+
+
+def export_columns(schema, snapshot=False):
+    """The columns of an export, in order: every field documents of the
+    layout can have, whichever of them a given document has."""
+    if snapshot:
+        return SNAPSHOT_SCHEMA.names
+    if schema == LEGACY:
+        return ["_id"] + RECORD_COLUMNS + ["source"]
+    return ["_id", "ts", "epoch", "lat", "lon"] + META_FIELDS
+
+
+def parquet_schema(columns):
+    return pa.schema([(column, PARQUET_TYPES.get(column, pa.string()))
+                      for column in columns])
+
+
+class PartWriter:
+    """Writes rows to a file, starting a new part every max_rows rows.
+
+    xlsx parts are sheets of one workbook if sheets is set, csv and
+    parquet parts are always separate files (output, output_part2, ...).
+
+    @param columns: The columns of every part, see export_columns. A row
+        without one of them gets an empty cell, fields of a row that are
+        not among them are left out, with a warning.
+    """
+
+    def __init__(self, output, output_format, columns, max_rows=None,
+                 sheets=True):
+        self.output = output
+        self.output_format = output_format
+        self.columns = list(columns)
+        # Columns and the fields already warned about.
+        self.known = set(columns)
+        self.max_rows = max_rows
+        self.sheets = sheets and output_format == "xlsx"
+        self.parts = 0
+        self.part_rows = 0
+        self.rows = 0
+        self.files = []
+        self.workbook = None
+        self.file = None
+        self.buffer = []
+
+    def _part_path(self):
+        if self.parts == 1 or self.sheets:
+            return self.output
+        base, ext = os.path.splitext(self.output)
+        return f"{base}_part{self.parts}{ext}"
+
+    def _open_part(self):
+        self.parts += 1
+        self.part_rows = 0
+        if self.output_format == "xlsx":
+            if self.workbook is None or not self.sheets:
+                self._close_file()
+                self.workbook = Workbook(write_only=True)
+                self.files.append(self._part_path())
+            self.sheet = self.workbook.create_sheet(f"Sheet{self.parts}")
+            self.sheet.append(self.columns)
+        elif self.output_format == "csv":
+            self._close_file()
+            self.files.append(self._part_path())
+            self.file = open(self.files[-1], "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.columns)
+        else:
+            self._close_file()
+            self.files.append(self._part_path())
+            self.buffer = []
+            self.file = None
+
+    def write(self, row):
+        """Write one flattened document."""
+        unknown = row.keys() - self.known
+        if unknown:
+            print(f"Leaving out fields not in the export's columns: {', '.join(sorted(unknown))}")
+            self.known |= unknown
+        if self.parts == 0 or (self.max_rows and self.part_rows >= self.max_rows):
+            self._open_part()
+
+        if self.output_format == "xlsx":
+            self.sheet.append([row.get(column) for column in self.columns])
+        elif self.output_format == "csv":
+            self.writer.writerow([row.get(column) for column in self.columns])
+        else:
+            self.buffer.append(row)
+            if len(self.buffer) >= PARQUET_ROW_GROUP:
+                self._flush_parquet()
+        self.part_rows += 1
+        self.rows += 1
+
+    def _flush_parquet(self):
+        if not self.buffer:
+            return
+        if self.file is None:
+            self.file = pq.ParquetWriter(self.files[-1],
+                                         parquet_schema(self.columns))
+        self.file.write_table(
+            pa.Table.from_pylist(self.buffer, schema=self.file.schema))
+        self.buffer = []
+
+    def _close_file(self):
+        if self.output_format == "xlsx":
+            if self.workbook is not None:
+                self.workbook.save(self.files[-1])
+                self.workbook = None
+        elif self.output_format == "parquet":
+            self._flush_parquet()
+            if self.file is not None:
+                self.file.close()
+        elif self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def close(self):
+        self._close_file()
+        return self.files
+
+
+def build_query(schema, start=None, end=None, routes=None):
+    """Query for documents at or after start and before end (unix seconds),
+    on any of routes."""
+    query = {}
+    if start is not None or end is not None:
+        query = time_query(schema, gte=start, lt=end)
+    if routes:
+        query[FIELDS[schema]["route_id"]] = {"$in": routes}
+    return query
+
+
+def day_partitions(collection, query, schema):
+    """(start, end) unix seconds of every local calendar day between the
+    first and last document matching query."""
+    time_field = FIELDS[schema]["time"]
+    epoch_field = FIELDS[schema]["epoch"]
+    if time_field not in query:
+        # Legacy documents without a raw_timestamp sort first otherwise.
+        query = dict(query, **time_query(schema))
+    bounds = []
+    for direction in (pymongo.ASCENDING, pymongo.DESCENDING):
+        doc = collection.find_one(query, {epoch_field: 1},
+                                  sort=[(time_field, direction)])
+        if doc is None:
+            return []
+        bounds.append(int(get_field(doc, epoch_field)))
+    return local_days(*bounds)
+
+
+def local_days(first, last):
+    """(start, end) unix seconds of every local calendar day from the one
+    holding first to the one holding last."""
+    day = datetime.fromtimestamp(first).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    partitions = []
+    while day.timestamp() <= last:
+        next_day = (day + timedelta(days=1)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        partitions.append((int(day.timestamp()), int(next_day.timestamp())))
+        day = next_day
+    return partitions
+
+
+def export_partition(task):
+    """Export the documents of one partition, return the files written and
+    the number of rows. Runs in a worker process with --workers."""
+    collection = None
+    if not task["snapshot_dir"]:
+        collection = get_collection(
+            task["mongo_uri"], task["db_name"], task["collection_name"])
+    writer = PartWriter(task["output"], task["output_format"],
+                        export_columns(task["schema"],
+                                       bool(task["snapshot_dir"])),
+                        task["max_rows"], task["sheets"])
+    if task["snapshot_dir"]:
+        end = task["end"]
+        rows = read_rows(task["snapshot_dir"], task["start"],
+                         end - 1 if end is not None else None, task["routes"])
+    else:
+        cursor = collection.find(task["query"], batch_size=BATCH_SIZE)
+        rows = (flatten(doc, task["schema"]) for doc in cursor)
+    for row in rows:
+        writer.write(row)
+    files = writer.close()
+    print(f"Exported {writer.rows} documents to {', '.join(files) or 'nothing'}")
+    return files, writer.rows
+
+
+def export(mongo_uri, db_name, collection_name, output, output_format="xlsx",
+           schema=LEGACY, start=None, end=None, routes=None, partition=None,
+           max_rows=None, sheets=True, workers=1, snapshot_dir=None):
+    """Export the matching documents, return the files written.
+
+    @param partition: None for one output, or "day" for one per local day,
+        named after it (db_20250318.xlsx).
+    @param max_rows: Rows per sheet or file before starting a new one.
+        Defaults to what fits in a sheet for xlsx, unlimited otherwise.
+    @param sheets: Split xlsx parts into sheets of one workbook rather than
+        separate files.
+    @param workers: Processes exporting day partitions concurrently.
+    @param snapshot_dir: Read from the Parquet snapshot in this directory
+        instead of the collection.
+    """
+    if max_rows is None and output_format == "xlsx":
+        max_rows = XLSX_MAX_ROWS
+    query = build_query(schema, start, end, routes)
+    task = {"mongo_uri": mongo_uri, "db_name": db_name,
+            "collection_name": collection_name, "output": output,
+            "output_format": output_format, "schema": schema,
+            "query": query, "max_rows": max_rows, "sheets": sheets,
+            "snapshot_dir": snapshot_dir, "start": start, "end": end,
+            "routes": routes}
+
+    if partition != "day":
+        files, rows = export_partition(task)
+        return files
+
+    if snapshot_dir:
+        bounds = time_bounds(snapshot_dir, start,
+                             end - 1 if end is not None else None)
+        days = local_days(*bounds) if bounds else []
+    else:
+        collection = get_collection(mongo_uri, db_name, collection_name)
+        days = day_partitions(collection, query, schema)
+    base, ext = os.path.splitext(output)
+    tasks = []
+    for day_start, day_end in days:
+        day_start, day_end = max(day_start, start or day_start), \
+            min(day_end, end or day_end)
+        day_query = dict(query)
+        day_query.update(time_query(schema, gte=day_start, lt=day_end))
+        day = datetime.fromtimestamp(day_start).strftime('%Y%m%d')
+        tasks.append(dict(task, query=day_query, start=day_start, end=day_end,
+                          output=f"{base}_{day}{ext}"))
+    print(f"Exporting {len(tasks)} day partitions with {workers} workers")
+
+    if workers > 1:
+        # Forked workers must not share the parent's client.
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            results = pool.map(export_partition, tasks)
+    else:
+        results = [export_partition(task) for task in tasks]
+
+    files = [path for partition_files, _ in results for path in partition_files]
+    print(f"Exported {sum(rows for _, rows in results)} documents to {len(files)} files")
+    return files
 
-# Convert to DataFrame
-df = pd.DataFrame(data)
 
-# Save to Excel
-df.to_excel("db.xlsx", index=False)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the vehicles collection to xlsx, csv or parquet.")
+    parser.add_argument("--mongo-uri", required=False,
+                        help="MongoDB connection URI", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", required=False,
+                        help="MongoDB database name", default="gearchange")
+    parser.add_argument("--collection-name", required=False,
+                        help="MongoDB collection name", default="vehicles")
+    parser.add_argument("--schema", required=False, choices=SCHEMAS, default=LEGACY,
+                        help="Layout of the collection's documents, see schema.py. Typed layouts are exported with their meta fields as columns.")
+    parser.add_argument("--format", required=False, choices=FORMATS, default="xlsx",
+                        help="Output file format.")
+    parser.add_argument("--output", required=False, default=None,
+                        help="Output file, db.<format> by default. Partitions and parts are named after it.")
+    parser.add_argument("--start", required=False, default=None,
+                        help="Only export positions at or after this time, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds.")
+    parser.add_argument("--end", required=False, default=None,
+                        help="Only export positions before this time, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds.")
+    parser.add_argument("--route", required=False, action="append", default=[],
+                        help="Only export positions on this route_id. Repeat for several routes.")
+    parser.add_argument("--partition", required=False, choices=["none", "day"], default="none",
+                        help="'day' writes one output per local calendar day.")
+    parser.add_argument("--max-rows", type=int, required=False, default=None,
+                        help=f"Rows per sheet (xlsx) or file before starting a new one. Defaults to {XLSX_MAX_ROWS} for xlsx, unlimited otherwise.")
+    parser.add_argument("--split-files", required=False, action="store_true",
+                        help="Split xlsx parts into separate files instead of sheets.")
+    parser.add_argument("--workers", type=int, required=False, default=1,
+                        help="Processes exporting day partitions in parallel.")
+    parser.add_argument("--snapshot-dir", required=False, default=None,
+                        help="Export from the Parquet snapshot in this directory (see snapshot.py) instead of Mongo, no mongod needed.")
+    args = parser.parse_args()
 
-print("Data exported to db.xlsx")
+    export(args.mongo_uri, args.db_name, args.collection_name,
+           args.output or f"db.{args.format}", args.format, args.schema,
+           parse_time_arg(args.start) if args.start else None,
+           parse_time_arg(args.end) if args.end else None,
+           args.route, None if args.partition == "none" else args.partition,
+           args.max_rows, not args.split_files, args.workers,
+           args.snapshot_dir)
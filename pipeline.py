@@ -0,0 +1,235 @@
+import collections
+import queue
+import threading
+import time
+
+import metrics
+
+# Put on a stage's input queue to tell it to finish and exit.
+STOP = object()
+
+FIRE_LAG_SECONDS = metrics.Histogram(
+    "pipeline_fire_lag_seconds", "How late a fetch fired after its scheduled tick.",
+    ["fetcher"])
+MISSED_TICKS = metrics.Counter(
+    "pipeline_missed_ticks_total", "Ticks skipped because a fetch overran its interval.",
+    ["fetcher"])
+DROPPED_SNAPSHOTS = metrics.Counter(
+    "pipeline_dropped_snapshots_total", "Snapshots dropped because the parse stage was full.",
+    ["fetcher"])
+STAGE_SECONDS = metrics.Histogram(
+    "pipeline_stage_seconds", "Time a stage spent on one item.", ["stage"])
+STAGE_ERRORS = metrics.Counter(
+    "pipeline_stage_errors_total", "Items a stage failed on.", ["stage"])
+QUEUE_DEPTH = metrics.Gauge(
+    "pipeline_queue_depth", "Items waiting in a stage's input queue.", ["stage"])
+SINK_LATENCY_SECONDS = metrics.Histogram(
+    "pipeline_sink_latency_seconds", "Time from a snapshot's scheduled fetch until a sink is done with it.",
+    ["sink"])
+
+
+class FixedRateClock:
+    """Schedules ticks at start + n * interval.
+
+    The schedule does not depend on how long a cycle takes, so slow cycles
+    never push later ones back. If a cycle overruns by more than a full
+    interval the ticks it missed are skipped rather than fired in a burst.
+    """
+
+    def __init__(self, interval, start=None):
+        self.interval = interval
+        self.next_tick = time.time() if start is None else start
+        self.missed_ticks = 0
+
+    def wait(self):
+        """Sleep until the next tick and return its scheduled time."""
+        now = time.time()
+        if self.interval > 0 and now - self.next_tick >= self.interval:
+            missed = int((now - self.next_tick) // self.interval)
+            self.missed_ticks += missed
+            self.next_tick += missed * self.interval
+        if self.next_tick > now:
+            time.sleep(self.next_tick - now)
+        scheduled = self.next_tick
+        self.next_tick += self.interval
+        return scheduled
+
+
+class Stage:
+    """A worker thread applying fn to every item of a bounded input queue."""
+
+    def __init__(self, name, fn, queue_size):
+        self.name = name
+        self.fn = fn
+        self.input = queue.Queue(maxsize=queue_size)
+        self.errors = 0
+        self.thread = threading.Thread(target=self._run, name=name,
+                                       daemon=True)
+
+    def _run(self):
+        while True:
+            item = self.input.get()
+            if item is STOP:
+                return
+            QUEUE_DEPTH.set(self.input.qsize(), stage=self.name)
+            try:
+                with STAGE_SECONDS.time(stage=self.name):
+                    self.fn(item)
+            except Exception as e:
+                self.errors += 1
+                STAGE_ERRORS.inc(stage=self.name)
+                print(f"Error in {self.name} stage: {e}")
+
+
+class Fetcher:
+    """Polls one feed on its own clock from a dedicated thread."""
+
+    def __init__(self, name, fetch, clock):
+        self.name = name
+        self.fetch = fetch
+        self.clock = clock
+        self.cycles = 0
+        self.dropped = 0
+        # Per cycle: (scheduled, fire lag, fetch seconds).
+        self.cycle_stats = collections.deque(maxlen=1000)
+        self.thread = None
+
+
+class Pipeline:
+    """Runs fetch, parse and every sink as separate concurrent stages.
+
+    Each feed is fetched from its own thread, driven by its own clock (a
+    FixedRateClock unless given otherwise). Fetched payloads of all feeds go
+    to a single parse stage, which hands the parsed records to one stage per
+    sink. All queues between stages are bounded: a slow sink blocks the
+    parse stage once its queue is full, and when the parse queue is full
+    too a fetcher drops its snapshot (and counts it) instead of falling
+    behind its schedule.
+
+    @param fetchers: List of (name, fetch, interval) triples. fetch returns
+        the raw payload, or None on error. interval may also be a clock.
+    @param parse: Callable taking (name, payload) and returning the
+        records, e.g. a VehicleBatch.
+    @param sinks: List of (name, callable) pairs, each called with the
+        parsed records.
+    """
+
+    def __init__(self, fetchers, parse, sinks, queue_size=2):
+        self.fetchers = []
+        for name, fetch, interval in fetchers:
+            clock = interval if hasattr(interval, "wait") \
+                else FixedRateClock(interval)
+            self.fetchers.append(Fetcher(name, fetch, clock))
+        self.parse = parse
+        self.sinks = [Stage(f"sink-{name}", self._timed_sink(name, fn),
+                            queue_size) for name, fn in sinks]
+        self.parser = Stage("parse", self._parse_and_dispatch, queue_size)
+
+        # Per sink: seconds from the scheduled fetch until the sink is done.
+        self.sink_latency = {name: collections.deque(maxlen=1000)
+                             for name, _ in sinks}
+
+    def _timed_sink(self, name, fn):
+        def run(item):
+            scheduled, records = item
+            fn(records)
+            latency = time.time() - scheduled
+            self.sink_latency[name].append(latency)
+            SINK_LATENCY_SECONDS.observe(latency, sink=name)
+        return run
+
+    def _parse_and_dispatch(self, item):
+        name, scheduled, data = item
+        records = self.parse(name, data)
+        for sink in self.sinks:
+            sink.input.put((scheduled, records))
+
+    def _poll(self, fetcher, cycles):
+        while cycles is None or fetcher.cycles < cycles:
+            missed_ticks = fetcher.clock.missed_ticks
+            scheduled = fetcher.clock.wait()
+            fired = time.time()
+            FIRE_LAG_SECONDS.observe(fired - scheduled, fetcher=fetcher.name)
+            MISSED_TICKS.inc(fetcher.clock.missed_ticks - missed_ticks,
+                             fetcher=fetcher.name)
+            try:
+                data = fetcher.fetch()
+            except Exception as e:
+                print(f"Error fetching {fetcher.name}: {e}")
+                data = None
+            fetch_seconds = time.time() - fired
+            fetcher.cycles += 1
+            fetcher.cycle_stats.append(
+                (scheduled, fired - scheduled, fetch_seconds))
+
+            if data:
+                try:
+                    self.parser.input.put_nowait(
+                        (fetcher.name, scheduled, data))
+                except queue.Full:
+                    fetcher.dropped += 1
+                    DROPPED_SNAPSHOTS.inc(fetcher=fetcher.name)
+                    print(
+                        f"Parse stage is behind, dropping this {fetcher.name} snapshot")
+
+            depths = self.queue_depths()
+            for stage, depth in depths.items():
+                QUEUE_DEPTH.set(depth, stage=stage)
+            metrics.log(
+                f"{fetcher.name} cycle {fetcher.cycles}: fired "
+                f"{fired - scheduled:.3f}s late, fetch took "
+                f"{fetch_seconds:.3f}s, queued: {depths}",
+                event="cycle", feed=fetcher.name, cycle=fetcher.cycles,
+                fire_lag=fired - scheduled, fetch_seconds=fetch_seconds,
+                queued=depths)
+
+    def run(self, cycles=None):
+        """Poll every feed cycles times, forever if cycles is None."""
+        for stage in [self.parser] + self.sinks:
+            stage.thread.start()
+        for fetcher in self.fetchers:
+            fetcher.thread = threading.Thread(
+                target=self._poll, args=(fetcher, cycles),
+                name=f"fetch-{fetcher.name}", daemon=True)
+            fetcher.thread.start()
+
+        try:
+            for fetcher in self.fetchers:
+                # join with a timeout so KeyboardInterrupt is not blocked.
+                while fetcher.thread.is_alive():
+                    fetcher.thread.join(1)
+        finally:
+            # Drain in order so every fetched snapshot reaches the sinks.
+            self.parser.input.put(STOP)
+            self.parser.thread.join()
+            for sink in self.sinks:
+                sink.input.put(STOP)
+            for sink in self.sinks:
+                sink.thread.join()
+
+    def queue_depths(self):
+        depths = {"parse": self.parser.input.qsize()}
+        for sink in self.sinks:
+            depths[sink.name] = sink.input.qsize()
+        return depths
+
+    def stats(self):
+        """Summary of schedule lag and sink latency over recent cycles."""
+        summary = {
+            "stage_errors": {stage.name: stage.errors
+                             for stage in [self.parser] + self.sinks},
+        }
+        for fetcher in self.fetchers:
+            lags = sorted(lag for _, lag, _ in fetcher.cycle_stats)
+            summary[fetcher.name] = {
+                "cycles": fetcher.cycles,
+                "dropped": fetcher.dropped,
+                "missed_ticks": fetcher.clock.missed_ticks,
+                "max_fire_lag_seconds": lags[-1] if lags else None,
+                "p50_fire_lag_seconds": lags[len(lags) // 2] if lags else None,
+            }
+        for name, latencies in self.sink_latency.items():
+            latencies = sorted(latencies)
+            summary[f"{name}_p50_latency_seconds"] = \
+                latencies[len(latencies) // 2] if latencies else None
+        return summary
@@ -1,51 +1,321 @@
+import argparse
+import hashlib
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pymongo
+from bson import ObjectId
+import matplotlib
+# Charts are only ever rendered to PNG buffers, also in worker processes.
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
-from geopy.distance import geodesic
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
-from datetime import datetime
-
-# Connect to MongoDB
-client = pymongo.MongoClient("mongodb://localhost:27017/")
-db = client["gearchange"]
-collection = db["vehicles"]
-
-# Fetch all vehicle data
-vehicles = list(collection.find(
-    {}, {"vehicle_id": 1, "latitude": 1, "longitude": 1, "timestamp": 1, "_id": 0}))
-
-# Count data points per vehicle
-vehicle_counts = {}
-vehicle_distances = {}
-previous_positions = {}
-timestamps = []
-
-for record in vehicles:
-    vid = record["vehicle_id"]
-    lat = record["latitude"]
-    lon = record["longitude"]
-    # Extract Unix timestamp from parentheses
-    unix_timestamp = int(record["timestamp"].split('(')[1].rstrip(')'))
-    timestamps.append(unix_timestamp)
-
-    vehicle_counts[vid] = vehicle_counts.get(vid, 0) + 1
-
-    if vid in previous_positions:
-        prev_lat, prev_lon = previous_positions[vid]
-        distance = geodesic((prev_lat, prev_lon), (lat, lon)).km
-        vehicle_distances[vid] = vehicle_distances.get(vid, 0) + distance
-
-    previous_positions[vid] = (lat, lon)
-
-# Compute duration range with formatted timestamps
-start_time = datetime.fromtimestamp(
-    timestamps[0]).strftime('%H:%M:%S %d-%m-%Y')
-end_time = datetime.fromtimestamp(timestamps[-1]).strftime('%H:%M:%S %d-%m-%Y')
-duration = f"Duration: {start_time} ({timestamps[0]}) to {end_time} ({timestamps[-1]})"
-
-# Remove 99th percentile outliers
-if vehicle_distances:
+from datetime import datetime, timedelta, timezone
+from distance_engine import DEFAULT_MAX_SPEED_KMH, fold_positions, vehicle_totals
+from feed_archive import parse_time_arg
+from rollup import HOUR_SECONDS, rollup_collections
+from snapshot import DEFAULT_SETTLE_SECONDS, load_watermark, read_chunks, to_numpy
+from schema import (FIELDS, LEGACY, MAX_CLOCK_SKEW_SECONDS, SCHEMAS,
+                    TIMESERIES, get_field, time_query)
+
+# Width of the time buckets the timestamp histogram is counted in, by Mongo.
+# The charts group these into DISPLAY_BINS bars, and the box plot quartiles
+# are read off them, so they never need the raw timestamps.
+BUCKET_SECONDS = 300
+DISPLAY_BINS = 50
+
+# Positions folded into the distance state at a time.
+BATCH_SIZE = 10000
+
+CHECKPOINT_FILE = "report_checkpoint.json"
+
+CHART_CACHE_DIR = "report_chart_cache"
+
+CHART_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def time_buckets(collection, query, bucket_seconds=BUCKET_SECONDS,
+                 schema=LEGACY):
+    """Count points per fixed-width time bucket, in Mongo.
+
+    @return: dict of bucket start (unix seconds) -> number of points.
+    """
+    epoch = "$" + FIELDS[schema]["epoch"]
+    bucket = {"$subtract": [epoch, {"$mod": [epoch, bucket_seconds]}]}
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": bucket, "count": {"$sum": 1}}},
+    ]
+    return {int(doc["_id"]): doc["count"]
+            for doc in collection.aggregate(pipeline, allowDiskUse=True)}
+
+
+def stream_positions(collection, state, query, batch_size=BATCH_SIZE,
+                     max_speed_kmh=DEFAULT_MAX_SPEED_KMH, exact=False,
+                     schema=LEGACY):
+    """Fold positions matching query into the per-vehicle state.
+
+    Positions are streamed sorted by (vehicle_id, time) with only the
+    fields the distances need, and folded batch_size at a time, so memory
+    is bounded by the number of vehicles rather than points.
+    """
+    fields = FIELDS[schema]
+    paths = [fields[name] for name in
+             ("vehicle_id", "epoch", "latitude", "longitude")]
+    projection = dict.fromkeys(paths, 1)
+    projection["_id"] = 0
+    cursor = collection.find(
+        query, projection, batch_size=batch_size, allow_disk_use=True,
+    ).sort([(fields["vehicle_id"], 1), (fields["time"], 1)])
+
+    vehicle_ids, timestamps, latitudes, longitudes = [], [], [], []
+
+    def fold():
+        fold_positions(state, vehicle_ids, timestamps, latitudes, longitudes,
+                       max_speed_kmh=max_speed_kmh, exact=exact)
+        for column in (vehicle_ids, timestamps, latitudes, longitudes):
+            column.clear()
+
+    columns = (vehicle_ids, timestamps, latitudes, longitudes)
+    for record in cursor:
+        for column, path in zip(columns, paths):
+            column.append(get_field(record, path))
+        if len(vehicle_ids) >= batch_size:
+            fold()
+    fold()
+    return state
+
+
+def watermark_field(schema, snapshot=False):
+    """What update_checkpoint tracks progress by: _id, or the time field on
+    time-series collections, which have no _id index. Snapshots always
+    have _ids."""
+    return "time" if schema == TIMESERIES and not snapshot else "_id"
+
+
+def new_checkpoint(max_speed_kmh, exact, collection_name="vehicles",
+                   schema=LEGACY, watermark="_id"):
+    return {
+        "params": {"max_speed_kmh": max_speed_kmh, "exact": exact,
+                   "bucket_seconds": BUCKET_SECONDS,
+                   "collection": collection_name, "schema": schema,
+                   "watermark": watermark},
+        # Last _id already folded into the state, as a hex string, or the
+        # last unix time with a "time" watermark.
+        "watermark": None,
+        "vehicles": {},
+        "time_buckets": {},
+    }
+
+
+def load_checkpoint(checkpoint_file, max_speed_kmh, exact,
+                    collection_name="vehicles", schema=LEGACY, watermark="_id"):
+    """Load the saved report state, or a fresh one if there is none or it
+    was computed with different parameters."""
+    checkpoint = new_checkpoint(max_speed_kmh, exact, collection_name, schema,
+                                watermark)
+    if not os.path.exists(checkpoint_file):
+        return checkpoint
+
+    with open(checkpoint_file) as f:
+        saved = json.load(f)
+    if saved.get("params") != checkpoint["params"]:
+        print(
+            f"Checkpoint {checkpoint_file} was built with {saved.get('params')}, rebuilding with {checkpoint['params']}")
+        return checkpoint
+    saved["time_buckets"] = {int(k): v for k, v in saved["time_buckets"].items()}
+    print(
+        f"Loaded checkpoint {checkpoint_file} with watermark {saved['watermark']}")
+    return saved
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    # Written to a temporary file first, a crash mid-write must not corrupt
+    # the only copy of the accumulated state.
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+    print(
+        f"Saved checkpoint {checkpoint_file} with watermark {checkpoint['watermark']}")
+
+
+def update_checkpoint(collection, checkpoint, batch_size=BATCH_SIZE,
+                      start=None, end=None,
+                      settle_seconds=DEFAULT_SETTLE_SECONDS):
+    """Fold every record inserted since the checkpoint's watermark into it.
+
+    The watermark is the last _id folded in, so records are picked up in
+    insertion order whatever their timestamps: a report that arrives late
+    is still counted, and one from a vehicle clock years ahead does not
+    hold back later runs. Records stamped more than MAX_CLOCK_SKEW_SECONDS
+    past now are left out, and records inserted less than settle_seconds
+    ago are left for the next run, as in snapshot.py.
+
+    Time-series collections have no _id index, so there the watermark is
+    the last time folded in, read off the (vehicle, time) index: records
+    stamped after it and more than settle_seconds ago are folded in, and
+    a report arriving later than that is left out.
+
+    The queries need the indexes schema.ensure_collection creates.
+
+    @param start, end: Optional unix time bounds (inclusive) of the
+        records to fold in, for reports on a time window.
+    """
+    params = checkpoint["params"]
+    schema = params["schema"]
+    if params["watermark"] == "time":
+        upto = int(time.time()) - settle_seconds
+        if end is not None:
+            upto = min(upto, end)
+        if checkpoint["watermark"] is not None and \
+                upto <= checkpoint["watermark"]:
+            return checkpoint
+        query = time_query(schema, gt=checkpoint["watermark"], gte=start,
+                           lte=upto)
+        fold_query(collection, checkpoint, query, batch_size)
+        checkpoint["watermark"] = upto
+        return checkpoint
+
+    latest_time = int(time.time()) + MAX_CLOCK_SKEW_SECONDS
+    query = time_query(schema, gte=start, lte=min(
+        end if end is not None else latest_time, latest_time))
+    settled = ObjectId.from_datetime(
+        datetime.now(timezone.utc) - timedelta(seconds=settle_seconds))
+    query["_id"] = {"$lt": settled}
+    if checkpoint["watermark"] is not None:
+        query["_id"]["$gt"] = ObjectId(checkpoint["watermark"])
+    latest = collection.find_one(query, {"_id": 1}, sort=[("_id", -1)])
+    if latest is None:
+        return checkpoint
+
+    # Bounded by the last _id, so both passes below see the same records
+    # even while the poller keeps inserting.
+    query["_id"] = dict(query["_id"], **{"$lte": latest["_id"]})
+    del query["_id"]["$lt"]
+
+    fold_query(collection, checkpoint, query, batch_size)
+    checkpoint["watermark"] = str(latest["_id"])
+    return checkpoint
+
+
+def fold_query(collection, checkpoint, query, batch_size=BATCH_SIZE):
+    """Fold the records matching query into the checkpoint's state."""
+    params = checkpoint["params"]
+    schema = params["schema"]
+    stream_positions(collection, checkpoint["vehicles"], query, batch_size,
+                     params["max_speed_kmh"], params["exact"], schema)
+    buckets = checkpoint["time_buckets"]
+    for bucket, count in time_buckets(
+            collection, query, params["bucket_seconds"], schema).items():
+        buckets[bucket] = buckets.get(bucket, 0) + count
+
+
+def update_checkpoint_from_snapshot(directory, checkpoint, start=None,
+                                    end=None):
+    """update_checkpoint, reading the Parquet snapshot in directory (see
+    snapshot.py) instead of Mongo. The watermark is the snapshot's own,
+    the last _id it exported, and only the files exported since the
+    checkpoint's are read, an hour of positions at a time."""
+    params = checkpoint["params"]
+    watermark = load_watermark(directory)
+    if watermark is None or watermark["last_id"] == checkpoint["watermark"]:
+        return checkpoint
+    # Snapshots written before they left out bogus clocks may hold some.
+    latest_time = int(time.time()) + MAX_CLOCK_SKEW_SECONDS
+    end = min(end if end is not None else latest_time, latest_time)
+    buckets = checkpoint["time_buckets"]
+    bucket_seconds = params["bucket_seconds"]
+    columns = ["vehicle_id", "raw_timestamp", "latitude", "longitude"]
+    for table in read_chunks(directory, start, end, columns,
+                             checkpoint["watermark"], watermark["last_id"]):
+        vehicle_ids, timestamps, latitudes, longitudes = (
+            to_numpy(table[name]) for name in columns)
+        fold_positions(checkpoint["vehicles"], vehicle_ids, timestamps,
+                       latitudes, longitudes, params["max_speed_kmh"],
+                       params["exact"])
+        starts, counts = np.unique(timestamps - timestamps % bucket_seconds,
+                                   return_counts=True)
+        for bucket, count in zip(starts.tolist(), counts.tolist()):
+            buckets[bucket] = buckets.get(bucket, 0) + count
+    checkpoint["watermark"] = watermark["last_id"]
+    return checkpoint
+
+
+def rollup_checkpoint(vehicle_hours, start=None, end=None):
+    """The report state of the hours from start to end (unix seconds,
+    inclusive), summed up in Mongo from the hourly rollups (see rollup.py)
+    instead of read from raw points.
+
+    Hours are whole, a window starting or ending mid-hour includes all of
+    that hour, and the time histogram has hourly buckets.
+    """
+    hours = {}
+    if start is not None:
+        hours["$gte"] = start - start % HOUR_SECONDS
+    if end is not None:
+        hours["$lte"] = end
+    match = {"$match": {"hour": hours} if hours else {}}
+    vehicles = {}
+    for doc in vehicle_hours.aggregate([match, {"$group": {
+            "_id": "$vehicle_id",
+            "count": {"$sum": "$count"},
+            "distance": {"$sum": "$distance_km"},
+            "first_seen": {"$min": "$first.epoch"},
+            "last_seen": {"$max": "$last.epoch"}}}], allowDiskUse=True):
+        vehicles[doc.pop("_id")] = doc
+    buckets = {int(doc["_id"]): doc["count"] for doc in vehicle_hours.aggregate(
+        [match, {"$group": {"_id": "$hour", "count": {"$sum": "$count"}}}],
+        allowDiskUse=True)}
+    print(f"Read the rollups of {len(vehicles)} vehicles over {len(buckets)} hours")
+    return {"params": {"bucket_seconds": HOUR_SECONDS,
+                       "collection": vehicle_hours.name},
+            "vehicles": vehicles, "time_buckets": buckets}
+
+
+def bucket_histogram(buckets, bucket_seconds):
+    """Turn sparse time buckets into contiguous (edges, counts) arrays."""
+    first, last = min(buckets), max(buckets)
+    n = (last - first) // bucket_seconds + 1
+    counts = np.zeros(n, dtype=np.int64)
+    for bucket, count in buckets.items():
+        counts[(bucket - first) // bucket_seconds] = count
+    edges = first + np.arange(n + 1) * bucket_seconds
+    return edges, counts
+
+
+def histogram_quantile(edges, counts, q):
+    """Approximate the q-th quantile of the values behind a histogram."""
+    cumulative = np.cumsum(counts)
+    target = q * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target))
+    before = cumulative[i - 1] if i > 0 else 0
+    fraction = (target - before) / counts[i] if counts[i] else 0
+    return edges[i] + fraction * (edges[i + 1] - edges[i])
+
+
+def histogram_box_stats(edges, counts, start, end):
+    """Box plot stats, in the format of Axes.bxp, read off a histogram."""
+    q1, median, q3 = (histogram_quantile(edges, counts, q)
+                      for q in (0.25, 0.5, 0.75))
+    iqr = q3 - q1
+    return {"q1": q1, "med": median, "q3": q3,
+            "whislo": max(start, q1 - 1.5 * iqr),
+            "whishi": min(end, q3 + 1.5 * iqr),
+            "fliers": []}
+
+
+def drop_distance_outliers(vehicle_distances):
+    """Remove 99th percentile outliers"""
+    if not vehicle_distances:
+        return vehicle_distances
     threshold = np.percentile(list(vehicle_distances.values()), 99)
     outlier_vehicles = {k: v for k,
                         v in vehicle_distances.items() if v > threshold}
@@ -56,46 +326,74 @@ if vehicle_distances:
     for vid, dist in outlier_vehicles.items():
         print(
             f"Excluding vehicle {vid} with distance: {dist} km (Above 99th percentile)")
+    return vehicle_distances
+
+
+def print_timestamp_stats(start, end, total_points):
+    print("\nTimestamp Statistics:")
+    print(f"Earliest data point: {datetime.fromtimestamp(start)}")
+    print(f"Latest data point: {datetime.fromtimestamp(end)}")
+    print(
+        f"Total timespan: {datetime.fromtimestamp(end) - datetime.fromtimestamp(start)}")
+    print(f"Total number of data points: {total_points}")
+
+
+def draw_vehicle_count_histogram(data):
+    plt.figure(figsize=(10, 5))
+    plt.hist(data["counts"], bins=50, edgecolor='black')
+    plt.xlabel("Data Points Logged")
+    plt.ylabel("Number of Vehicles")
+    plt.title(f"Histogram of Data Points Logged per Vehicle\n{data['duration']}")
+    plt.grid(True)
+    plt.tight_layout()
+
+
+def draw_distance_distribution(data):
+    plt.figure(figsize=(10, 5))
+    plt.boxplot(data["distances"], vert=False)
+    plt.xlabel("Distance Travelled (km)")
+    plt.title(
+        f"Distribution of Distance Travelled per Vehicle (Excluding 99th Percentile Outliers)\n{data['duration']}")
+    plt.grid(True)
+
+
+def draw_distance_histogram(data):
+    plt.figure(figsize=(10, 5))
+    # Creates bins from 0 to 200 in steps of 20
+    bins = np.arange(0, 201, 20)
+    plt.hist(data["distances"], bins=bins, edgecolor='black')
+    plt.xlabel("Distance Travelled (km)")
+    plt.ylabel("Number of Vehicles")
+    plt.title(f"Histogram of Vehicle Distances (0-200km)\n{data['duration']}")
+    plt.grid(True)
+
+
+def draw_low_vehicles(data):
+    plt.figure(figsize=(10, 5))
+    plt.bar(data["vehicles"], data["values"])
+    plt.xlabel("Vehicle ID")
+    plt.ylabel(data["ylabel"])
+    plt.title(data["title"])
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+
 
-# Find min/max vehicles for distance and count
-min_dist_vehicle = min(
-    vehicle_distances, key=vehicle_distances.get, default=None)
-max_dist_vehicle = max(
-    vehicle_distances, key=vehicle_distances.get, default=None)
-min_count_vehicle = min(vehicle_counts, key=vehicle_counts.get, default=None)
-max_count_vehicle = max(vehicle_counts, key=vehicle_counts.get, default=None)
-
-# Print min/max vehicle details
-print(
-    f"Vehicle with min distance: {min_dist_vehicle}, Distance: {vehicle_distances.get(min_dist_vehicle, 0)} km")
-print(
-    f"Vehicle with max distance: {max_dist_vehicle}, Distance: {vehicle_distances.get(max_dist_vehicle, 0)} km")
-print(
-    f"Vehicle with min count: {min_count_vehicle}, Count: {vehicle_counts.get(min_count_vehicle, 0)}")
-print(
-    f"Vehicle with max count: {max_count_vehicle}, Count: {vehicle_counts.get(max_count_vehicle, 0)}")
-
-# After collecting timestamps in the main loop, add these plots:
-if timestamps:
-    # Convert timestamps to datetime for better readability
-    datetime_stamps = [datetime.fromtimestamp(ts) for ts in timestamps]
-
-    # Plot timestamp distribution
+def draw_timestamp_distribution(data):
+    display_edges = [datetime.fromtimestamp(e) for e in data["edges"]]
     plt.figure(figsize=(12, 6))
-    plt.hist(datetime_stamps, bins=50, edgecolor='black')
+    plt.hist(display_edges[:-1], bins=display_edges,
+             weights=data["counts"], edgecolor='black')
     plt.xlabel("Time")
     plt.ylabel("Number of Data Points")
     plt.title("Distribution of Data Points Over Time")
     plt.xticks(rotation=45)
     plt.grid(True)
     plt.tight_layout()
-    plt.savefig("timestamp_distribution.png")
-    plt.close()
 
-    # Box plot for timestamps - convert to numeric values first
-    numeric_timestamps = np.array(timestamps)  # Use original Unix timestamps
+
+def draw_timestamp_boxplot(data):
     fig, ax = plt.subplots(figsize=(12, 4))
-    bp = ax.boxplot(numeric_timestamps, vert=False)
+    ax.bxp([data["stats"]], vert=False)
 
     # Format x-axis ticks to show dates
     def format_date(x, p):
@@ -107,66 +405,153 @@ if timestamps:
     plt.grid(True)
     plt.xticks(rotation=45)
     plt.tight_layout()
-    plt.savefig("timestamp_boxplot.png")
-    plt.close()
 
-    # Print timestamp statistics
-    print("\nTimestamp Statistics:")
-    print(f"Earliest data point: {min(datetime_stamps)}")
-    print(f"Latest data point: {max(datetime_stamps)}")
-    print(f"Total timespan: {max(datetime_stamps) - min(datetime_stamps)}")
-    print(f"Total number of data points: {len(timestamps)}")
-
-# Plot distance distribution
-if vehicle_distances:
-    distances = list(vehicle_distances.values())
-    plt.figure(figsize=(10, 5))
-    plt.boxplot(distances, vert=False)
-    plt.xlabel("Distance Travelled (km)")
-    plt.title(
-        f"Distribution of Distance Travelled per Vehicle (Excluding 99th Percentile Outliers)\n{duration}")
-    plt.grid(True)
-    plt.savefig("distance_distribution.png")
 
-    # Add histogram of vehicle distances
-    plt.figure(figsize=(10, 5))
-    # Creates bins from 0 to 200 in steps of 20
-    bins = np.arange(0, 201, 20)
-    plt.hist(distances, bins=bins, edgecolor='black')
-    plt.xlabel("Distance Travelled (km)")
-    plt.ylabel("Number of Vehicles")
-    plt.title(f"Histogram of Vehicle Distances (0-200km)\n{duration}")
-    plt.grid(True)
-    plt.savefig("distance_histogram.png")
-
-# Plot 10 lowest vehicles by count
-low_count_vehicles = sorted(vehicle_counts.items(), key=lambda x: x[1])[:10]
-plt.figure(figsize=(10, 5))
-plt.bar([x[0] for x in low_count_vehicles], [x[1] for x in low_count_vehicles])
-plt.xlabel("Vehicle ID")
-plt.ylabel("Data Points Logged")
-plt.title("10 Lowest Vehicles by Count")
-plt.xticks(rotation=45, ha='right')
-plt.tight_layout()
-plt.savefig("low_count_vehicles.png")
-
-# Plot 10 lowest vehicles by distance
-low_distance_vehicles = sorted(
-    vehicle_distances.items(), key=lambda x: x[1])[:10]
-plt.figure(figsize=(10, 5))
-plt.bar([x[0] for x in low_distance_vehicles], [x[1]
-        for x in low_distance_vehicles])
-plt.xlabel("Vehicle ID")
-plt.ylabel("Distance Travelled (km)")
-plt.title("10 Lowest Vehicles by Distance")
-plt.xticks(rotation=45, ha='right')
-plt.tight_layout()
-plt.savefig("low_distance_vehicles.png")
+# Chart name: (PDF page caption, draw function), in PDF page order.
+CHARTS = {
+    "vehicle_count_histogram": ("Histogram of Data Points Logged per Vehicle",
+                                draw_vehicle_count_histogram),
+    "distance_distribution": ("Distribution of Distance Travelled per Vehicle (Excluding 99th Percentile Outliers)",
+                              draw_distance_distribution),
+    "low_count_vehicles": ("10 Lowest Vehicles by Count", draw_low_vehicles),
+    "low_distance_vehicles": ("10 Lowest Vehicles by Distance",
+                              draw_low_vehicles),
+    "distance_histogram": ("Histogram of Vehicle Distances (0-200km)",
+                           draw_distance_histogram),
+    "timestamp_distribution": ("Distribution of Data Points Over Time",
+                               draw_timestamp_distribution),
+    "timestamp_boxplot": ("Distribution of Timestamps (Box Plot)",
+                          draw_timestamp_boxplot),
+}
+
+
+def chart_data(edges, counts, start, end, vehicle_counts, vehicle_distances,
+               duration):
+    """The input of every chart to draw, as {name: JSON-able data}.
+
+    The distance charts are left out when no vehicle has a distance.
+    """
+    # Group the Mongo time buckets into the bars shown on the chart
+    display_counts, display_edges = np.histogram(
+        edges[:-1], bins=np.linspace(edges[0], edges[-1], DISPLAY_BINS + 1),
+        weights=counts)
+    box_stats = histogram_box_stats(edges, counts, start, end)
+
+    charts = {
+        "vehicle_count_histogram": {
+            "counts": sorted(vehicle_counts.values()), "duration": duration},
+    }
+    if vehicle_distances:
+        distances = sorted(vehicle_distances.values())
+        charts["distance_distribution"] = {
+            "distances": distances, "duration": duration}
+        charts["distance_histogram"] = {
+            "distances": distances, "duration": duration}
+    else:
+        print("No vehicle has a distance, leaving out the distance charts")
+
+    for name, values, ylabel, title in (
+            ("low_count_vehicles", vehicle_counts, "Data Points Logged",
+             "10 Lowest Vehicles by Count"),
+            ("low_distance_vehicles", vehicle_distances,
+             "Distance Travelled (km)", "10 Lowest Vehicles by Distance")):
+        if not values:
+            continue
+        lowest = sorted(values.items(), key=lambda x: x[1])[:10]
+        charts[name] = {"vehicles": [x[0] for x in lowest],
+                        "values": [x[1] for x in lowest],
+                        "ylabel": ylabel, "title": title}
+
+    charts["timestamp_distribution"] = {
+        "edges": display_edges.tolist(), "counts": display_counts.tolist()}
+    charts["timestamp_boxplot"] = {
+        "stats": {k: float(v) if k != "fliers" else v
+                  for k, v in box_stats.items()}}
+    return charts
+
+
+def chart_key(name, data):
+    """Content hash of a chart: its data and the code that draws it."""
+    digest = hashlib.sha256()
+    digest.update(inspect.getsource(CHARTS[name][1]).encode())
+    digest.update(json.dumps([name, data], sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def render_chart(name, data):
+    """Draw a chart and return it as PNG bytes."""
+    CHARTS[name][1](data)
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format="png")
+    plt.close("all")
+    return buffer.getvalue()
+
+
+def render_charts(charts, workers=CHART_WORKERS, cache_dir=None):
+    """Render charts, {name: data}, into {name: PNG bytes}.
+
+    Charts are drawn concurrently in worker processes. With a cache_dir,
+    a chart whose data and drawing code hash to a cached PNG is not drawn
+    again.
+    """
+    rendered = {}
+    keys = {name: chart_key(name, data) for name, data in charts.items()}
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, key in keys.items():
+            path = os.path.join(cache_dir, f"{name}-{key}.png")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    rendered[name] = f.read()
+
+    todo = [name for name in charts if name not in rendered]
+    print(f"Rendering {len(todo)} charts, {len(rendered)} unchanged from cache")
+    if workers > 1 and len(todo) > 1:
+        # Not forked from this process, which would copy its MongoClient's
+        # threads and sockets mid-use. The fork server imports matplotlib
+        # once, so workers still start with it imported instead of
+        # spending longer importing it than drawing.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["__main__", "matplotlib.pyplot"])
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)),
+                                 mp_context=context) as pool:
+            pngs = pool.map(render_chart, todo, [charts[n] for n in todo])
+            rendered.update(zip(todo, pngs))
+    else:
+        for name in todo:
+            rendered[name] = render_chart(name, charts[name])
+    missing = [name for name in charts if not rendered.get(name)]
+    if missing:
+        raise RuntimeError(f"Charts were not rendered: {', '.join(missing)}")
+
+    if cache_dir:
+        for name in todo:
+            # Only the latest version of each chart is kept.
+            for old in os.listdir(cache_dir):
+                if old.startswith(f"{name}-"):
+                    os.remove(os.path.join(cache_dir, old))
+            path = os.path.join(cache_dir, f"{name}-{keys[name]}.png")
+            with open(path + ".tmp", "wb") as f:
+                f.write(rendered[name])
+            os.replace(path + ".tmp", path)
+    return rendered
 
 # Generate PDF Report with ReportLab
 
 
-def create_pdf_report(pdf_filename):
+def create_pdf_report(pdf_filename, duration, charts):
+    """Write one page per chart, in CHARTS order. Charts left out of
+    charts, e.g. the distance charts when no vehicle has a distance, get a
+    page saying there was no data for them.
+
+    @param charts: {name: PNG bytes} of the charts to include, as returned
+        by render_charts. Names not in CHARTS, and rendered charts that are
+        not valid images, raise instead of producing a partial report.
+    """
+    unknown = set(charts) - set(CHARTS)
+    if unknown:
+        raise ValueError(f"No PDF page for charts: {', '.join(sorted(unknown))}")
+
     pdf = canvas.Canvas(pdf_filename, pagesize=letter)
     width, height = letter
 
@@ -178,63 +563,140 @@ def create_pdf_report(pdf_filename):
     pdf.setFont("Helvetica", 12)
     pdf.drawString(left_margin, height - 70, duration)
 
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100,
-                   "Histogram of Data Points Logged per Vehicle")
-    pdf.drawImage("histogram.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100,
-                   "Distribution of Distance Travelled per Vehicle (Excluding 99th Percentile Outliers)")
-    pdf.drawImage("distance_distribution.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100, "10 Lowest Vehicles by Count")
-    pdf.drawImage("low_count_vehicles.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100, "10 Lowest Vehicles by Distance")
-    pdf.drawImage("low_distance_vehicles.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    # Add new histogram page
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100,
-                   "Histogram of Vehicle Distances (0-200km)")
-    pdf.drawImage("distance_histogram.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    # Add timestamp distribution page
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100,
-                   "Distribution of Data Points Over Time")
-    pdf.drawImage("timestamp_distribution.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
-
-    # Add timestamp box plot page
-    pdf.setFont("Helvetica", 12)
-    pdf.drawString(left_margin, height - 100,
-                   "Distribution of Timestamps (Box Plot)")
-    pdf.drawImage("timestamp_boxplot.png", left_margin,
-                  height - 400, width=500, height=250)
-    pdf.showPage()
+    for name, (caption, _) in CHARTS.items():
+        pdf.setFont("Helvetica", 12)
+        pdf.drawString(left_margin, height - 100, caption)
+        if name not in charts:
+            pdf.drawString(left_margin, height - 130,
+                           "No data for this chart in the reported range.")
+            pdf.showPage()
+            continue
+        if not charts[name]:
+            raise ValueError(f"Chart {name} was rendered empty")
+        pdf.drawImage(ImageReader(io.BytesIO(charts[name])), left_margin,
+                      height - 400, width=500, height=250)
+        pdf.showPage()
 
     pdf.save()
 
 
-create_pdf_report("report.pdf")
-print("Report generated: report.pdf")
-
-
-print(f"Number of vehicles: {len(vehicle_counts.keys())}")
-# pprint.pprint(vehicle_counts)
-# pprint.pprint(vehicle_distances)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate the vehicle data analysis report.")
+    parser.add_argument("--mongo-uri", required=False,
+                        help="MongoDB connection URI", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", required=False,
+                        help="MongoDB database name", default="gearchange")
+    parser.add_argument("--collection-name", required=False,
+                        help="MongoDB collection name", default="vehicles")
+    parser.add_argument("--schema", required=False, choices=SCHEMAS, default=LEGACY,
+                        help="Layout of the collection's documents, see schema.py.")
+    parser.add_argument("--start", required=False, default=None,
+                        help="Only report on records from this time on, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds. Window reports do not use the checkpoint.")
+    parser.add_argument("--end", required=False, default=None,
+                        help="Only report on records up to this time, see --start.")
+    parser.add_argument("--max-speed-kmh", type=float, required=False,
+                        help="Segments faster than this are treated as GPS jumps and left out of distances. 0 keeps every segment.",
+                        default=DEFAULT_MAX_SPEED_KMH)
+    parser.add_argument("--exact-geodesic", required=False, action="store_true",
+                        help="Measure segments with WGS84 geodesics instead of haversine. Much slower.")
+    parser.add_argument("--batch-size", type=int, required=False, default=BATCH_SIZE,
+                        help="Positions read from Mongo and folded into the distances at a time.")
+    parser.add_argument("--checkpoint", required=False, default=CHECKPOINT_FILE,
+                        help="File the report state is saved to, so the next run only reads records inserted after the ones this run read.")
+    parser.add_argument("--full-rebuild", required=False, action="store_true",
+                        help="Ignore the checkpoint and recompute the report from all records.")
+    parser.add_argument("--chart-workers", type=int, required=False, default=CHART_WORKERS,
+                        help="Processes rendering charts concurrently. 1 renders them in this process.")
+    parser.add_argument("--chart-cache", required=False, default=CHART_CACHE_DIR,
+                        help="Directory of rendered charts, keyed by a hash of their data, so unchanged charts are not drawn again. Pass an empty string to disable.")
+    parser.add_argument("--snapshot-dir", required=False, default=None,
+                        help="Read positions from the Parquet snapshot in this directory (see snapshot.py) instead of Mongo, no mongod needed.")
+    parser.add_argument("--from-rollups", required=False, action="store_true",
+                        help="Build the report from the hourly rollups the poller keeps with --rollups (see rollup.py), in whole hours, instead of from raw points. Distances use the rollups' max speed. The checkpoint is not used.")
+    args = parser.parse_args()
+
+    # Connect to MongoDB
+    client = pymongo.MongoClient(args.mongo_uri)
+    db = client[args.db_name]
+    collection = db[args.collection_name]
+
+    # Only records newer than the checkpoint are read from Mongo
+    max_speed_kmh = args.max_speed_kmh or None
+    window = args.start is not None or args.end is not None
+    # Checkpoints of a snapshot are kept apart from those of the collection.
+    source = args.snapshot_dir or args.collection_name
+    if args.from_rollups:
+        checkpoint = rollup_checkpoint(
+            rollup_collections(collection)[0],
+            parse_time_arg(args.start) if args.start else None,
+            parse_time_arg(args.end) if args.end else None)
+    elif args.full_rebuild or window:
+        checkpoint = new_checkpoint(
+            max_speed_kmh, args.exact_geodesic, source, args.schema,
+            watermark_field(args.schema, bool(args.snapshot_dir)))
+    else:
+        checkpoint = load_checkpoint(
+            args.checkpoint, max_speed_kmh, args.exact_geodesic, source,
+            args.schema, watermark_field(args.schema, bool(args.snapshot_dir)))
+    if args.snapshot_dir and not args.from_rollups:
+        update_checkpoint_from_snapshot(
+            args.snapshot_dir, checkpoint,
+            parse_time_arg(args.start) if args.start else None,
+            parse_time_arg(args.end) if args.end else None)
+    elif not args.from_rollups:
+        update_checkpoint(
+            collection, checkpoint, args.batch_size,
+            parse_time_arg(args.start) if args.start else None,
+            parse_time_arg(args.end) if args.end else None)
+    if not checkpoint["vehicles"]:
+        raise ValueError("No vehicle data to report on.")
+    if not window and not args.from_rollups:
+        save_checkpoint(args.checkpoint, checkpoint)
+
+    vehicle_counts, vehicle_distances = vehicle_totals(checkpoint["vehicles"])
+    start = min(s["first_seen"] for s in checkpoint["vehicles"].values())
+    end = max(s["last_seen"] for s in checkpoint["vehicles"].values())
+    total_points = sum(vehicle_counts.values())
+
+    # Compute duration range with formatted timestamps
+    start_time = datetime.fromtimestamp(start).strftime('%H:%M:%S %d-%m-%Y')
+    end_time = datetime.fromtimestamp(end).strftime('%H:%M:%S %d-%m-%Y')
+    duration = f"Duration: {start_time} ({start}) to {end_time} ({end})"
+
+    vehicle_distances = drop_distance_outliers(vehicle_distances)
+
+    # Find min/max vehicles for distance and count
+    min_dist_vehicle = min(
+        vehicle_distances, key=vehicle_distances.get, default=None)
+    max_dist_vehicle = max(
+        vehicle_distances, key=vehicle_distances.get, default=None)
+    min_count_vehicle = min(
+        vehicle_counts, key=vehicle_counts.get, default=None)
+    max_count_vehicle = max(
+        vehicle_counts, key=vehicle_counts.get, default=None)
+
+    # Print min/max vehicle details
+    print(
+        f"Vehicle with min distance: {min_dist_vehicle}, Distance: {vehicle_distances.get(min_dist_vehicle, 0)} km")
+    print(
+        f"Vehicle with max distance: {max_dist_vehicle}, Distance: {vehicle_distances.get(max_dist_vehicle, 0)} km")
+    print(
+        f"Vehicle with min count: {min_count_vehicle}, Count: {vehicle_counts.get(min_count_vehicle, 0)}")
+    print(
+        f"Vehicle with max count: {max_count_vehicle}, Count: {vehicle_counts.get(max_count_vehicle, 0)}")
+
+    edges, counts = bucket_histogram(
+        checkpoint["time_buckets"], checkpoint["params"]["bucket_seconds"])
+    print_timestamp_stats(start, end, total_points)
+    charts = render_charts(
+        chart_data(edges, counts, start, end, vehicle_counts,
+                   vehicle_distances, duration),
+        args.chart_workers, args.chart_cache)
+
+    create_pdf_report("report.pdf", duration, charts)
+    print("Report generated: report.pdf")
+
+    print(f"Number of vehicles: {len(vehicle_counts.keys())}")
+    # pprint.pprint(vehicle_counts)
+    # pprint.pprint(vehicle_distances)
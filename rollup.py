@@ -0,0 +1,294 @@
+"""Hourly per-vehicle and per-route rollups, kept up to date at ingest.
+
+Next to a vehicles collection, two rollup collections hold one document
+per vehicle or route and hour (UTC-aligned unix seconds):
+
+    <collection>_vehicle_hours: {vehicle_id, hour, count, distance_km,
+                                 first: {epoch, lat, lon}, last: {...}}
+    <collection>_route_hours:   {route_id, hour, count, distance_km,
+                                 first, last, vehicle_ids}
+
+count is the number of stored points, distance_km the haversine length of
+the segments ending in that hour (GPS jumps left out as in
+distance_engine), first/last the earliest and latest point, so
+first.epoch/last.epoch are the min/max timestamps. Documents are upserted
+with $inc, $min and $max, so updates commute and several pollers or a
+rebuild can add to the same hour.
+
+The poller (--rollups) updates them for the points each insert-new write
+actually inserted, right after the raw insert_many. report.py
+--from-rollups builds the report from them alone. Rollups of points
+stored before they were enabled are built with:
+
+    $ python3 rollup.py --start 2025-03-01 --end 2025-04-01
+"""
+import argparse
+
+import numpy as np
+import pymongo
+
+import metrics
+from distance_engine import DEFAULT_MAX_SPEED_KMH, haversine_km, is_jump
+from feed_archive import parse_time_arg
+from schema import FIELDS, LEGACY, SCHEMAS, get_field, time_query
+
+HOUR_SECONDS = 3600
+
+VEHICLE_HOURS_SUFFIX = "_vehicle_hours"
+ROUTE_HOURS_SUFFIX = "_route_hours"
+
+# Hours of rollups read back on start, to continue each vehicle's distance
+# from its last stored position.
+SEED_HOURS = 2
+
+# Raw documents read per round trip by rebuild.
+BATCH_SIZE = 10000
+
+ROLLUP_WRITE_SECONDS = metrics.Histogram(
+    "rollup_write_seconds", "Time to update the hourly rollups of one write.")
+ROLLUP_POINTS = metrics.Counter(
+    "rollup_points_total", "Points added to the hourly rollups.")
+
+
+def rollup_collections(collection):
+    """The (vehicle hours, route hours) collections of a vehicles collection."""
+    db = collection.database
+    return (db[collection.name + VEHICLE_HOURS_SUFFIX],
+            db[collection.name + ROUTE_HOURS_SUFFIX])
+
+
+def ensure_rollup_indexes(vehicle_hours, route_hours):
+    vehicle_hours.create_index([("vehicle_id", 1), ("hour", 1)], unique=True)
+    vehicle_hours.create_index([("hour", 1)])
+    route_hours.create_index([("route_id", 1), ("hour", 1)], unique=True)
+    route_hours.create_index([("hour", 1)])
+
+
+def _merge(rollups, key, epoch, lat, lon, distance):
+    rollup = rollups.get(key)
+    point = {"epoch": epoch, "lat": lat, "lon": lon}
+    if rollup is None:
+        rollups[key] = {"count": 1, "distance_km": distance,
+                        "first": point, "last": point}
+        return
+    rollup["count"] += 1
+    rollup["distance_km"] += distance
+    if epoch < rollup["first"]["epoch"]:
+        rollup["first"] = point
+    if epoch >= rollup["last"]["epoch"]:
+        rollup["last"] = point
+
+
+class RollupWriter:
+    """Folds stored points into hourly rollups and writes them to Mongo.
+
+    Each vehicle's distance continues from the last point it folded in,
+    across writes. A point older than that one (an out-of-order report,
+    or the report after a bogus future timestamp) restarts the vehicle's
+    trajectory from itself without adding distance.
+    """
+
+    def __init__(self, max_speed_kmh=DEFAULT_MAX_SPEED_KMH):
+        self.max_speed_kmh = max_speed_kmh
+        # vehicle_id -> (epoch, lat, lon) of its last folded point.
+        self.last_positions = {}
+        self.seeded = set()
+
+    def seed(self, vehicle_hours, now):
+        """Continue from the last positions stored in the rollups of the
+        SEED_HOURS before now, e.g. after a restart."""
+        since = now - now % HOUR_SECONDS - SEED_HOURS * HOUR_SECONDS
+        for doc in vehicle_hours.find({"hour": {"$gte": since}},
+                                      {"vehicle_id": 1, "last": 1}):
+            last = doc["last"]
+            current = self.last_positions.get(doc["vehicle_id"])
+            if current is None or last["epoch"] > current[0]:
+                self.last_positions[doc["vehicle_id"]] = (
+                    last["epoch"], last["lat"], last["lon"])
+        print(f"Seeded rollups with the last position of {len(self.last_positions)} vehicles")
+
+    def fold(self, vehicle_ids, route_ids, epochs, lats, lons):
+        """Fold points into ({(vehicle_id, hour): rollup},
+        {(route_id, hour): rollup}), see the module docstring."""
+        vehicle_ids = np.asarray(vehicle_ids, dtype=object)
+        epochs = np.asarray(epochs, dtype=np.int64)
+        order = np.lexsort((epochs, vehicle_ids))
+        vehicle_ids = vehicle_ids[order].tolist()
+        route_ids = np.asarray(route_ids, dtype=object)[order].tolist()
+        epochs = epochs[order].tolist()
+        lats = np.asarray(lats, dtype=np.float64)[order].tolist()
+        lons = np.asarray(lons, dtype=np.float64)[order].tolist()
+
+        # Previous position of every point, its vehicle's last one for the
+        # first point of each vehicle.
+        previous = []
+        last_positions = self.last_positions
+        for i, vehicle_id in enumerate(vehicle_ids):
+            if i and vehicle_ids[i - 1] == vehicle_id:
+                previous.append((epochs[i - 1], lats[i - 1], lons[i - 1]))
+            else:
+                previous.append(last_positions.get(
+                    vehicle_id, (epochs[i], lats[i], lons[i])))
+            last_positions[vehicle_id] = (epochs[i], lats[i], lons[i])
+        previous = np.array(previous, dtype=np.float64).reshape(-1, 3)
+        seconds = np.asarray(epochs, dtype=np.float64) - previous[:, 0]
+        distances = haversine_km(previous[:, 1], previous[:, 2], lats, lons)
+        distances[(seconds <= 0) |
+                  is_jump(distances, seconds, self.max_speed_kmh)] = 0
+        distances = distances.tolist()
+
+        vehicle_rollups, route_rollups, route_vehicles = {}, {}, {}
+        for vehicle_id, route_id, epoch, lat, lon, distance in zip(
+                vehicle_ids, route_ids, epochs, lats, lons, distances):
+            hour = epoch - epoch % HOUR_SECONDS
+            _merge(vehicle_rollups, (vehicle_id, hour), epoch, lat, lon, distance)
+            _merge(route_rollups, (route_id, hour), epoch, lat, lon, distance)
+            route_vehicles.setdefault((route_id, hour), set()).add(vehicle_id)
+        for key, vehicles in route_vehicles.items():
+            route_rollups[key]["vehicle_ids"] = sorted(vehicles)
+        return vehicle_rollups, route_rollups
+
+    def write(self, collection, batch, indices):
+        """Add the rows at indices of a VehicleBatch, the ones just
+        inserted into collection, to its rollups."""
+        if not len(indices):
+            return
+        with ROLLUP_WRITE_SECONDS.time():
+            vehicle_hours, route_hours = rollup_collections(collection)
+            if collection.full_name not in self.seeded:
+                ensure_rollup_indexes(vehicle_hours, route_hours)
+                self.seed(vehicle_hours, int(np.median(
+                    batch.columns["raw_timestamp"])))
+                self.seeded.add(collection.full_name)
+            indices = np.asarray(indices, dtype=np.intp)
+            rollups = self.fold(
+                *[batch.columns[name][indices] for name in
+                  ("vehicle_id", "route_id", "raw_timestamp", "latitude",
+                   "longitude")])
+            write_rollups(vehicle_hours, route_hours, *rollups)
+        ROLLUP_POINTS.inc(len(indices))
+
+
+def _update(rollup):
+    update = {
+        "$inc": {"count": rollup["count"],
+                 "distance_km": rollup["distance_km"]},
+        # Embedded documents compare field by field in order, so epoch
+        # decides, and first/last move as a whole.
+        "$min": {"first": rollup["first"]},
+        "$max": {"last": rollup["last"]},
+    }
+    if "vehicle_ids" in rollup:
+        update["$addToSet"] = {"vehicle_ids": {"$each": rollup["vehicle_ids"]}}
+    return update
+
+
+def write_rollups(vehicle_hours, route_hours, vehicle_rollups, route_rollups):
+    """Upsert folded rollups into the rollup collections."""
+    for target, key_field, rollups in (
+            (vehicle_hours, "vehicle_id", vehicle_rollups),
+            (route_hours, "route_id", route_rollups)):
+        if rollups:
+            target.bulk_write([
+                pymongo.UpdateOne({key_field: key, "hour": hour},
+                                  _update(rollup), upsert=True)
+                for (key, hour), rollup in rollups.items()], ordered=False)
+
+
+def rebuild(collection, schema=LEGACY, start=None, end=None,
+            batch_size=BATCH_SIZE, max_speed_kmh=DEFAULT_MAX_SPEED_KMH):
+    """Recompute the rollups of the hours from start to end (unix seconds,
+    rounded out to whole hours) from the raw points in collection.
+
+    Rollups of the hours the poller is still writing to would count its
+    points twice, rebuild past hours only. Documents missing the vehicle,
+    time or position are skipped and counted, a missing route is kept as
+    None like at ingest.
+
+    @return: Number of points folded in.
+    """
+    vehicle_hours, route_hours = rollup_collections(collection)
+    ensure_rollup_indexes(vehicle_hours, route_hours)
+    if start is not None:
+        start -= start % HOUR_SECONDS
+    if end is not None:
+        end += -end % HOUR_SECONDS
+    hours = {}
+    if start is not None:
+        hours["$gte"] = start
+    if end is not None:
+        hours["$lt"] = end
+    for target in (vehicle_hours, route_hours):
+        deleted = target.delete_many({"hour": hours} if hours else {})
+        print(f"Deleted {deleted.deleted_count} rollups from {target.name}")
+
+    fields = FIELDS[schema]
+    paths = [fields[name] for name in
+             ("vehicle_id", "route_id", "epoch", "latitude", "longitude")]
+    projection = dict.fromkeys(paths, 1)
+    projection["_id"] = 0
+    # end is exclusive, whole hours.
+    query = time_query(schema, gte=start,
+                       lte=end - 1 if end is not None else None)
+    # Sorted by time, so every chunk continues each vehicle's trajectory.
+    cursor = collection.find(query, projection, batch_size=batch_size) \
+        .sort([(fields["time"], 1)])
+
+    writer = RollupWriter(max_speed_kmh)
+    columns = [[] for _ in paths]
+    points = 0
+    incomplete = 0
+
+    def flush():
+        if columns[0]:
+            write_rollups(vehicle_hours, route_hours, *writer.fold(*columns))
+        for column in columns:
+            column.clear()
+
+    for doc in cursor:
+        values = []
+        for path in paths:
+            try:
+                values.append(get_field(doc, path))
+            except KeyError:
+                values.append(None)
+        vehicle_id, _, epoch, lat, lon = values
+        if None in (vehicle_id, epoch, lat, lon):
+            incomplete += 1
+            continue
+        for column, value in zip(columns, values):
+            column.append(value)
+        points += 1
+        if len(columns[0]) >= batch_size:
+            flush()
+    flush()
+    if incomplete:
+        print(f"Skipped {incomplete} documents without a vehicle, time or position")
+    print(f"Rebuilt rollups from {points} points")
+    return points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the hourly rollups of a vehicles collection from its raw points.")
+    parser.add_argument("--mongo-uri", required=False,
+                        help="MongoDB connection URI", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", required=False,
+                        help="MongoDB database name", default="gearchange")
+    parser.add_argument("--collection-name", required=False,
+                        help="MongoDB collection name", default="vehicles")
+    parser.add_argument("--schema", required=False, choices=SCHEMAS, default=LEGACY,
+                        help="Layout of the collection's documents, see schema.py.")
+    parser.add_argument("--start", required=False, default=None,
+                        help="Rebuild the hours from this time on, as 'YYYY-MM-DD[ HH:MM]' local time or unix seconds. Everything if not given.")
+    parser.add_argument("--end", required=False, default=None,
+                        help="Rebuild the hours before this time, see --start.")
+    parser.add_argument("--max-speed-kmh", type=float, required=False, default=DEFAULT_MAX_SPEED_KMH,
+                        help="Segments faster than this are treated as GPS jumps and left out of distances. 0 keeps every segment.")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    rebuild(client[args.db_name][args.collection_name], args.schema,
+            parse_time_arg(args.start) if args.start else None,
+            parse_time_arg(args.end) if args.end else None,
+            max_speed_kmh=args.max_speed_kmh or None)
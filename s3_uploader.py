@@ -0,0 +1,175 @@
+import collections
+import heapq
+import os
+import shutil
+import threading
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+import metrics
+
+MB = 1024 * 1024
+
+S3_QUEUE_DEPTH = metrics.Gauge(
+    "s3_upload_queue_depth", "Files waiting for or in the middle of an upload.")
+S3_UPLOAD_SECONDS = metrics.Histogram(
+    "s3_upload_seconds", "Time to upload one file.")
+S3_UPLOADS = metrics.Counter(
+    "s3_uploads_total", "Upload attempts, by result.", ["result"])
+
+
+class S3Uploader:
+    """Uploads files to an S3 bucket from a background thread.
+
+    Files handed to enqueue are moved into queue_dir, which acts as a durable
+    queue: a file is only deleted from it once its upload succeeded. Anything
+    left there by a failed upload or a restart is picked up again when the
+    next uploader is created on the same directory.
+
+    A failed upload is retried after backoff_seconds, doubling per attempt,
+    and after max_retries attempts only every max_backoff_seconds. Meanwhile
+    the thread goes on with the other files, each pending file has its own
+    next attempt time.
+
+    The S3 endpoint can be pointed at a local stand-in (e.g. minio or moto)
+    with endpoint_url or the AWS_ENDPOINT_URL environment variable.
+    """
+
+    def __init__(self, bucket, queue_dir, endpoint_url=None, max_retries=5,
+                 backoff_seconds=2, max_backoff_seconds=300,
+                 multipart_threshold=8 * MB, max_concurrency=4):
+        self.bucket = bucket
+        self.queue_dir = queue_dir
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        # One client for the lifetime of the uploader, boto3 clients are
+        # thread safe and reuse their connection pool across uploads.
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=max_concurrency,
+            use_threads=True)
+
+        self.condition = threading.Condition()
+        # (next attempt time, order queued, name, failed attempts) per file.
+        self.pending = []
+        self.queued = 0
+        self.in_flight = 0
+        self.uploaded = 0
+        self.failures = 0
+        self.last_latency = None
+        self.latencies = collections.deque(maxlen=100)
+
+        os.makedirs(queue_dir, exist_ok=True)
+        leftover = sorted(os.listdir(queue_dir))
+        for name in leftover:
+            self._schedule(name, time.time(), 0)
+        if leftover:
+            print(f"Resuming {len(leftover)} pending uploads from {queue_dir}")
+
+        self.thread = threading.Thread(
+            target=self._run, name="s3-uploader", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def enqueue(self, path):
+        """Move path into the queue directory and schedule its upload."""
+        name = os.path.basename(path)
+        shutil.move(path, os.path.join(self.queue_dir, name))
+        self._schedule(name, time.time(), 0)
+        print(f"Queued {name} for upload, queue depth: {self.queue_depth()}")
+
+    def _schedule(self, name, at, attempts):
+        with self.condition:
+            self.queued += 1
+            heapq.heappush(self.pending, (at, self.queued, name, attempts))
+            S3_QUEUE_DEPTH.set(self.queue_depth())
+            self.condition.notify()
+
+    def queue_depth(self):
+        """Number of files waiting for or in the middle of an upload."""
+        with self.condition:
+            return len(self.pending) + self.in_flight
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": self.queue_depth(),
+            "uploaded": self.uploaded,
+            "failures": self.failures,
+            "last_latency_seconds": self.last_latency,
+            "p50_latency_seconds":
+                latencies[len(latencies) // 2] if latencies else None,
+            "max_latency_seconds": latencies[-1] if latencies else None,
+        }
+
+    def wait(self, timeout=None):
+        """Block until the queue is drained or timeout seconds passed.
+
+        @return: True if every queued file was uploaded.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue_depth() > 0:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > time.time():
+                    self.condition.wait(
+                        self.pending[0][0] - time.time() if self.pending else None)
+                _, _, name, attempts = heapq.heappop(self.pending)
+                self.in_flight += 1
+            try:
+                if not self._upload(name, attempts):
+                    attempts += 1
+                    if attempts < self.max_retries:
+                        backoff = min(self.backoff_seconds * 2 ** (attempts - 1),
+                                      self.max_backoff_seconds)
+                        print(f"Retrying {name} in {backoff}s")
+                    else:
+                        print(f"Giving up on {name} for now, it stays in {self.queue_dir}")
+                        backoff = self.max_backoff_seconds
+                        attempts = 0
+                    self._schedule(name, time.time() + backoff, attempts)
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    S3_QUEUE_DEPTH.set(self.queue_depth())
+
+    def _upload(self, name, attempts):
+        """Try to upload a queued file once, return whether it is done."""
+        path = os.path.join(self.queue_dir, name)
+        if not os.path.exists(path):
+            return True
+
+        start = time.time()
+        try:
+            self.client.upload_file(
+                path, self.bucket, name, Config=self.transfer_config)
+        except Exception as e:
+            self.failures += 1
+            S3_UPLOADS.inc(result="error")
+            print(
+                f"Error uploading {name} (attempt {attempts + 1}/{self.max_retries}): {e}")
+            return False
+
+        self.last_latency = time.time() - start
+        self.latencies.append(self.last_latency)
+        self.uploaded += 1
+        S3_UPLOADS.inc(result="ok")
+        S3_UPLOAD_SECONDS.observe(self.last_latency)
+        os.remove(path)
+        print(
+            f"Uploaded {name} to {self.bucket} in {self.last_latency:.2f}s, queue depth: {self.queue_depth() - 1}")
+        return True
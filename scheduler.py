@@ -0,0 +1,236 @@
+"""Poll schedule that follows the feed's own refresh cadence.
+
+AdaptiveClock is a drop-in for pipeline.FixedRateClock. After every fetch
+the poller tells it what came back (observe), and after parsing, the
+vehicle timestamps of the snapshot (observe_vehicles). From the refresh
+times, header.timestamp or else the newest vehicle timestamp, it learns:
+
+- the period: the mean gap between refreshes, counting a gap that spans
+  several refreshes (a slow poll missed some) as that many periods, and
+  ignoring gaps much shorter than the rest (a refresh published twice);
+- the phase: the last refresh, plus an offset of how long after its
+  header timestamp a refresh can be fetched. The offset grows when a
+  fetch at the expected time finds the old snapshot, and is probed lower,
+  by a quarter, after every PROBE_AFTER on-time fetches, so it tracks the
+  feed's publishing delay without drifting up.
+
+Each fetch is then timed for just after the next expected refresh. An
+unchanged feed is retried after a doubling delay, errors back off
+exponentially, and fetches always stay between min_interval and
+max_interval apart. Until enough refreshes are seen, the clock polls at
+its initial interval.
+
+Freshness, the age of the newest vehicle report at fetch time, is exported
+as a metric and part of stats().
+"""
+import collections
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from schema import MAX_CLOCK_SKEW_SECONDS
+
+NEW = "new"
+UNCHANGED = "unchanged"
+ERROR = "error"
+
+# Default bounds on the seconds between two fetches of a feed.
+DEFAULT_MIN_INTERVAL = 2
+DEFAULT_MAX_INTERVAL = 120
+
+# Refreshes seen before the period is trusted.
+MIN_REFRESHES = 3
+
+# On-time fetches before trying an earlier offset.
+PROBE_AFTER = 3
+
+FEED_PERIOD_SECONDS = metrics.Gauge(
+    "scheduler_feed_period_seconds", "Learned refresh period of a feed.", ["feed"])
+FEED_OFFSET_SECONDS = metrics.Gauge(
+    "scheduler_fetch_offset_seconds", "How long after a refresh's header timestamp it is fetched.",
+    ["feed"])
+FRESHNESS_SECONDS = metrics.Histogram(
+    "scheduler_freshness_seconds", "Age of the newest vehicle report at fetch time.",
+    ["feed"])
+FETCH_OUTCOMES = metrics.Counter(
+    "scheduler_fetches_total", "Fetches made on the adaptive schedule, by outcome.",
+    ["feed", "outcome"])
+
+
+def newest_vehicle_timestamp(timestamps, fetched_at):
+    """The newest of timestamps that is not after fetched_at (plus skew),
+    or None."""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    timestamps = timestamps[timestamps <= fetched_at + MAX_CLOCK_SKEW_SECONDS]
+    return int(timestamps.max()) if len(timestamps) else None
+
+
+def estimate_period(refreshes):
+    """Mean gap between refresh times, each gap counted as a multiple of
+    the shortest plausible one, or None if there are too few."""
+    gaps = np.diff(np.asarray(sorted(set(refreshes)), dtype=np.float64))
+    if len(gaps) < MIN_REFRESHES - 1:
+        return None
+    shortest = gaps[gaps >= np.median(gaps) / 2].min()
+    gaps = gaps[gaps >= shortest / 2]
+    return float(gaps.sum() / np.round(gaps / shortest).sum())
+
+
+class AdaptiveClock:
+    """Times fetches for just after the feed is expected to refresh.
+
+    @param name: Feed name, for metrics and logs.
+    @param interval: Seconds between fetches until the period is learned.
+    @param min_interval, max_interval: Bounds on the time between two
+        fetches, whatever the schedule.
+    @param step: Seconds the fetch offset moves by, and the first retry
+        delay after an unchanged feed.
+    """
+
+    def __init__(self, name, interval, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, step=1.0, history=20):
+        self.name = name
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.step = step
+        self.lock = threading.Lock()
+        self.refreshes = collections.deque(maxlen=history)
+        self.period = None
+        self.offset = None
+        self.next_tick = time.time()
+        self.fired = None
+        self.fetched_at = None
+        # Whether the fetch in flight was timed off the learned schedule.
+        self.on_schedule = False
+        self.on_time = 0
+        self.errors = 0
+        self.unchanged = 0
+        self.missed_ticks = 0
+        self.outcomes = collections.Counter()
+        self.freshness = collections.deque(maxlen=1000)
+
+    def wait(self):
+        """Sleep until the next fetch and return its scheduled time."""
+        while True:
+            with self.lock:
+                scheduled = self.next_tick
+            now = time.time()
+            if scheduled <= now:
+                break
+            # Woken up now and then, observe_vehicles may move the tick.
+            time.sleep(min(scheduled - now, 1.0))
+        with self.lock:
+            self.fired = now
+            # Until observe() plans the next fetch, e.g. if the fetch
+            # raises, poll at the initial interval.
+            self.next_tick = self._clamp(now + self.interval)
+        return scheduled
+
+    def _clamp(self, tick):
+        if self.fired is None:
+            return tick
+        return min(max(tick, self.fired + self.min_interval),
+                   self.fired + self.max_interval)
+
+    def observe(self, outcome, refreshed_at=None, fetched_at=None):
+        """Plan the next fetch after one that came back with outcome NEW,
+        UNCHANGED or ERROR. refreshed_at is the feed's header timestamp,
+        if it has one."""
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        FETCH_OUTCOMES.inc(feed=self.name, outcome=outcome)
+        with self.lock:
+            self.outcomes[outcome] += 1
+            self.fetched_at = fetched_at
+            if outcome == ERROR:
+                self.errors += 1
+                self.next_tick = self._clamp(
+                    fetched_at + self.min_interval * 2 ** self.errors)
+                return
+            self.errors = 0
+            if outcome == UNCHANGED:
+                self.unchanged += 1
+                if self.on_schedule and self.unchanged == 1 \
+                        and self.offset is not None:
+                    # Expected a refresh, it is published later than that.
+                    self.offset += self.step
+                self.next_tick = self._clamp(
+                    fetched_at + self.step * 2 ** (self.unchanged - 1))
+                return
+            if self.on_schedule and self.offset is not None:
+                if self.unchanged == 0:
+                    self.on_time += 1
+                    if self.on_time % PROBE_AFTER == 0:
+                        self.offset = max(0.0, self.offset - max(
+                            self.step, self.offset / 4))
+                elif refreshed_at:
+                    # It was not out at the last retry, but was by this one.
+                    self.offset = max(self.offset, self.fired - refreshed_at)
+            self.unchanged = 0
+            if refreshed_at:
+                self._refreshed(refreshed_at, fetched_at)
+            self._plan(fetched_at)
+
+    def observe_vehicles(self, timestamps):
+        """Record the vehicle timestamps of the last new snapshot: its
+        freshness, and its refresh time if the feed has no header
+        timestamp."""
+        with self.lock:
+            fetched_at = self.fetched_at or time.time()
+            newest = newest_vehicle_timestamp(timestamps, fetched_at)
+            if newest is None:
+                return
+            freshness = fetched_at - newest
+            self.freshness.append(freshness)
+            FRESHNESS_SECONDS.observe(freshness, feed=self.name)
+            if not self.refreshes or self.refreshes[-1][1] == "vehicles":
+                self._refreshed(newest, fetched_at, source="vehicles")
+                self._plan(fetched_at)
+        metrics.log(
+            f"{self.name} data is {freshness:.1f}s old at fetch, period "
+            f"{self.period and round(self.period, 2)}s, offset "
+            f"{self.offset and round(self.offset, 2)}s",
+            event="freshness", feed=self.name, freshness=freshness,
+            period=self.period, offset=self.offset)
+
+    def _refreshed(self, refreshed_at, fetched_at, source="header"):
+        if self.refreshes and refreshed_at <= self.refreshes[-1][0]:
+            return
+        self.refreshes.append((refreshed_at, source))
+        self.period = estimate_period([t for t, _ in self.refreshes])
+        if self.period is not None:
+            FEED_PERIOD_SECONDS.set(self.period, feed=self.name)
+        delay = (self.fired or fetched_at) - refreshed_at
+        if self.offset is None or (not self.on_schedule and delay < self.offset):
+            # Off schedule, fetches land anywhere in the period, and the
+            # earliest one after a refresh bounds the publishing delay.
+            self.offset = max(0.0, delay)
+        FEED_OFFSET_SECONDS.set(self.offset, feed=self.name)
+
+    def _plan(self, now):
+        self.on_schedule = False
+        if self.period is None or self.offset is None:
+            self.next_tick = self._clamp((self.fired or now) + self.interval)
+            return
+        if self.period < self.min_interval:
+            # Every fetch is new, poll as fast as allowed.
+            self.next_tick = self._clamp(now)
+            return
+        last = self.refreshes[-1][0]
+        # The first refresh after the one just fetched.
+        periods = max(1, int((now - self.offset - last) // self.period) + 1)
+        self.next_tick = self._clamp(last + periods * self.period + self.offset)
+        self.on_schedule = True
+
+    def stats(self):
+        with self.lock:
+            freshness = sorted(self.freshness)
+            return {
+                "period_seconds": self.period and round(self.period, 3),
+                "offset_seconds": self.offset and round(self.offset, 3),
+                "fetches": dict(self.outcomes),
+                "p50_freshness_seconds": freshness[len(freshness) // 2] if freshness else None,
+                "p95_freshness_seconds": freshness[int(len(freshness) * 0.95)] if freshness else None,
+            }
@@ -0,0 +1,168 @@
+"""Storage layouts for vehicle position documents.
+
+legacy: the records from parse_gtfs as is, with timestamp as a formatted
+    "HH:MM:SS dd-mm-YYYY (epoch)" string and a unique index on
+    (vehicle_id, timestamp).
+compact: {ts, epoch, lat, lon, meta}, where ts is a BSON date, epoch the
+    integer unix time and meta holds the vehicle, route and trip fields.
+    Stored in a regular collection with a unique (meta.vehicle_id, ts)
+    index.
+timeseries: the compact document, stored in a MongoDB time-series
+    collection with ts as its timeField and meta as its metaField.
+    Time-series collections do not support unique indexes, so duplicates
+    are filtered before the insert instead (see --db-mode insert-new and
+    stored_reports).
+
+FIELDS maps the logical fields reports need onto each layout.
+"""
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+LEGACY = "legacy"
+COMPACT = "compact"
+TIMESERIES = "timeseries"
+SCHEMAS = [LEGACY, COMPACT, TIMESERIES]
+
+# Positions stamped more than this far past the time they were received
+# come from bogus vehicle clocks (the feed has reports dated 2099).
+MAX_CLOCK_SKEW_SECONDS = 60
+
+# Record fields kept in meta by the typed layouts.
+META_FIELDS = ["vehicle_id", "route_id", "trip_id", "vehicle_label",
+               "trip_start_time", "trip_start_date", "entity_wrapper_id",
+               "source"]
+
+# Vehicles looked up per query by stored_reports.
+STORED_REPORTS_BATCH = 500
+
+FIELDS = {
+    LEGACY: {"vehicle_id": "vehicle_id", "route_id": "route_id",
+             "epoch": "raw_timestamp", "time": "raw_timestamp",
+             "latitude": "latitude", "longitude": "longitude"},
+    COMPACT: {"vehicle_id": "meta.vehicle_id", "route_id": "meta.route_id",
+              "epoch": "epoch", "time": "ts",
+              "latitude": "lat", "longitude": "lon"},
+}
+FIELDS[TIMESERIES] = FIELDS[COMPACT]
+
+
+def latest_plausible_epoch(timestamps):
+    """The latest raw_timestamp a report of a batch with these timestamps
+    can plausibly carry: MAX_CLOCK_SKEW_SECONDS past the batch's median or
+    now, whichever is later."""
+    median = int(np.median(timestamps)) if len(timestamps) else 0
+    return max(median, int(time.time())) + MAX_CLOCK_SKEW_SECONDS
+
+
+def record_epoch(record):
+    """Unix time of a legacy record, also for ones without raw_timestamp."""
+    if record.get("raw_timestamp") is not None:
+        return int(record["raw_timestamp"])
+    # Extract Unix timestamp from parentheses
+    return int(record["timestamp"].split('(')[1].rstrip(')'))
+
+
+def to_document(record, schema):
+    """Convert a parse_gtfs record (or legacy document) to schema."""
+    if schema == LEGACY:
+        return record
+    epoch = record_epoch(record)
+    return {
+        "ts": datetime.fromtimestamp(epoch, timezone.utc),
+        "epoch": epoch,
+        "lat": record["latitude"],
+        "lon": record["longitude"],
+        "meta": {k: record[k] for k in META_FIELDS if k in record},
+    }
+
+
+def to_time(epoch, schema):
+    """The value to compare FIELDS[schema]["time"] with in queries."""
+    if schema == LEGACY:
+        return epoch
+    return datetime.fromtimestamp(epoch, timezone.utc)
+
+
+def time_query(schema, gt=None, gte=None, lte=None, lt=None):
+    """Range query on the layout's indexed time field, bounds in unix time."""
+    bounds = {}
+    for op, epoch in (("$gt", gt), ("$gte", gte), ("$lte", lte), ("$lt", lt)):
+        if epoch is not None:
+            bounds[op] = to_time(epoch, schema)
+    time_field = FIELDS[schema]["time"]
+    return {time_field: bounds} if bounds else {time_field: {"$ne": None}}
+
+
+def get_field(document, path):
+    """Look up a dotted FIELDS path in a document returned by Mongo."""
+    for part in path.split("."):
+        document = document[part]
+    return document
+
+
+def stored_reports(collection, keys, schema):
+    """The (vehicle_id, epoch) keys already in the collection, looked up on
+    its (vehicle_id, time) index.
+
+    Only the exact keys are queried, one $in of times per vehicle and
+    STORED_REPORTS_BATCH vehicles per query, as keys can be spread over
+    days (e.g. after a restart) and a time range would fetch everything
+    in between."""
+    fields = FIELDS[schema]
+    epochs = {}
+    for vehicle_id, epoch in keys:
+        epochs.setdefault(vehicle_id, []).append(epoch)
+    vehicle_ids = list(epochs)
+    projection = {fields["vehicle_id"]: 1, fields["epoch"]: 1, "_id": 0}
+    stored = set()
+    for i in range(0, len(vehicle_ids), STORED_REPORTS_BATCH):
+        query = {"$or": [
+            {fields["vehicle_id"]: vehicle_id,
+             fields["time"]: {"$in": [to_time(epoch, schema)
+                                      for epoch in epochs[vehicle_id]]}}
+            for vehicle_id in vehicle_ids[i:i + STORED_REPORTS_BATCH]]}
+        stored |= {(get_field(doc, fields["vehicle_id"]), get_field(doc, fields["epoch"]))
+                   for doc in collection.find(query, projection)}
+    return stored & set(keys)
+
+
+def ensure_collection(db, collection_name, schema):
+    """Create the collection and indexes schema needs, if missing."""
+    if schema == LEGACY:
+        collection = db[collection_name]
+        # Check if compound index exists before creating
+        index_exists = False
+        for index in collection.list_indexes():
+            if "vehicle_id_1_timestamp_1" in str(index["name"]):
+                index_exists = True
+                break
+        if not index_exists:
+            print("Creating compound index on vehicle_id and timestamp")
+            collection.create_index(
+                [("vehicle_id", 1), ("timestamp", 1)], unique=True)
+        # The typed layouts' (vehicle, time) and time indexes, for reports.
+        collection.create_index([("vehicle_id", 1), ("raw_timestamp", 1)])
+        collection.create_index([("raw_timestamp", 1)])
+        return collection
+
+    if collection_name not in db.list_collection_names():
+        if schema == TIMESERIES:
+            print(f"Creating time-series collection {collection_name}")
+            db.create_collection(collection_name, timeseries={
+                "timeField": "ts", "metaField": "meta",
+                "granularity": "seconds"})
+        else:
+            db.create_collection(collection_name)
+
+    collection = db[collection_name]
+    if schema == TIMESERIES:
+        collection.create_index([("meta.vehicle_id", 1), ("ts", 1)])
+        collection.create_index([("meta.route_id", 1), ("ts", 1)])
+    else:
+        collection.create_index(
+            [("meta.vehicle_id", 1), ("ts", 1)], unique=True)
+        collection.create_index([("ts", 1)])
+        collection.create_index([("meta.route_id", 1), ("ts", 1)])
+    return collection
@@ -0,0 +1,440 @@
+"""Incremental Parquet snapshots of the vehicles collection.
+
+Every run exports only the documents inserted since the previous one into
+a directory of Parquet files, partitioned by the UTC date of each position:
+
+    snapshots/date=2025-03-18/part-<first _id of the run>.parquet
+    snapshots/date=2025-03-18/part-<first _id of the run>-1.parquet
+    snapshots/_watermark.json
+
+A run writes more than one file to a date when positions for it arrive
+after the date was finished, see PartitionWriter.
+
+report.py and mongo_to_excel.py read these with --snapshot-dir, without a
+running mongod, so reports no longer need a copy of the live dbPath.
+
+Columns are compact whatever the collection's layout: vehicle and route
+ids dictionary encoded (pandas categoricals), latitude/longitude float32
+(under a meter of error), raw_timestamp int64 epochs, plus the other trip
+fields and the document's _id. Positions stamped more than
+MAX_CLOCK_SKEW_SECONDS past their document's insertion (bogus vehicle
+clocks) are left out, instead of opening date partitions decades ahead.
+
+Runs are safe next to the poller. The watermark is the last exported _id,
+and a run only exports documents whose _id is older than settle_seconds,
+as an unordered insert_many can make a document visible after others
+with later _ids. Files are written under temporary names and the
+watermark is only advanced once they are all in place. A run that dies
+before that is redone by the next one, which writes the same file names.
+
+    $ python3 snapshot.py --snapshot-dir snapshots   # e.g. hourly from cron
+"""
+import argparse
+import fcntl
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pymongo
+from bson import ObjectId
+
+from schema import LEGACY, MAX_CLOCK_SKEW_SECONDS, META_FIELDS, SCHEMAS, record_epoch
+
+WATERMARK_FILE = "_watermark.json"
+LOCK_FILE = "_snapshot.lock"
+
+# Documents younger than this are left for the next run, see above.
+DEFAULT_SETTLE_SECONDS = 120
+
+# Documents fetched from Mongo per round trip, and rows per row group.
+BATCH_SIZE = 10000
+ROW_GROUP_SIZE = 100000
+
+# Rows buffered across all dates before the largest buffer is written out.
+MAX_BUFFERED_ROWS = 4 * ROW_GROUP_SIZE
+
+# Positions read back at a time by read_chunks. Files are written in _id,
+# so roughly in time order, and row group statistics skip the rest.
+CHUNK_SECONDS = 3600
+
+STRING_FIELDS = [name for name in META_FIELDS
+                 if name not in ("vehicle_id", "route_id")]
+
+SCHEMA = pa.schema(
+    [("_id", pa.string()),
+     ("vehicle_id", pa.dictionary(pa.int32(), pa.string())),
+     ("route_id", pa.dictionary(pa.int32(), pa.string()))] +
+    [(name, pa.string()) for name in STRING_FIELDS] +
+    [("latitude", pa.float32()), ("longitude", pa.float32()),
+     ("raw_timestamp", pa.int64())])
+
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]),
+                               flavor="hive")
+
+
+def partition_date(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+
+def load_watermark(directory):
+    path = os.path.join(directory, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermark(directory, watermark):
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(watermark, f)
+    os.replace(path + ".tmp", path)
+
+
+def snapshot_row(doc, schema):
+    """The snapshot columns of a document of the schema.py layout, or None
+    if its position is stamped too far past the document's insertion."""
+    if schema == LEGACY:
+        row = {name: doc.get(name) for name in META_FIELDS}
+        row["latitude"] = doc.get("latitude")
+        row["longitude"] = doc.get("longitude")
+        row["raw_timestamp"] = record_epoch(doc)
+    else:
+        meta = doc.get("meta", {})
+        row = {name: meta.get(name) for name in META_FIELDS}
+        row["latitude"] = doc.get("lat")
+        row["longitude"] = doc.get("lon")
+        row["raw_timestamp"] = doc["epoch"]
+    inserted = doc["_id"].generation_time.timestamp()
+    if row["raw_timestamp"] > inserted + MAX_CLOCK_SKEW_SECONDS:
+        return None
+    row["_id"] = str(doc["_id"])
+    return row
+
+
+class PartitionWriter:
+    """Buffers rows per date partition, writing each to its own file.
+
+    Rows come in _id order, so roughly in time order: a date's file is
+    finished once positions more than a day later arrive, and a date
+    seen again after that (a lagging vehicle clock) gets another file.
+    At most MAX_BUFFERED_ROWS rows are buffered across dates. Finished
+    files keep their temporary names until close.
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.buffers = {}
+        self.writers = {}
+        # Files written per date, and the (temporary, final) paths of
+        # the finished ones.
+        self.parts = {}
+        self.finished = []
+        self.cutoff = None
+        self.buffered = 0
+        self.rows = 0
+
+    def write(self, row):
+        date = partition_date(row["raw_timestamp"])
+        rows = self.buffers.setdefault(date, [])
+        rows.append(row)
+        self.buffered += 1
+        self.rows += 1
+        cutoff = partition_date(row["raw_timestamp"] - 86400)
+        if self.cutoff is None or cutoff > self.cutoff:
+            self.cutoff = cutoff
+            for old in [old for old in self.writers if old < cutoff]:
+                self._finish(old)
+        if len(rows) < ROW_GROUP_SIZE:
+            if self.buffered < MAX_BUFFERED_ROWS:
+                return
+            date = max(self.buffers, key=lambda d: len(self.buffers[d]))
+        if date < self.cutoff:
+            # Late rows of a finished date, don't keep its file open.
+            self._finish(date)
+        else:
+            self._flush(date)
+
+    def _path(self, date, part=0, tmp=False):
+        # Readers skip dot files, so never see a file being written.
+        name = self.name
+        if part:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}-{part}{ext}"
+        if tmp:
+            name = f".{name}.tmp"
+        return os.path.join(self.directory, f"date={date}", name)
+
+    def _flush(self, date):
+        rows = self.buffers.pop(date, [])
+        if not rows:
+            return
+        self.buffered -= len(rows)
+        writer = self.writers.get(date)
+        if writer is None:
+            os.makedirs(os.path.dirname(self._path(date)), exist_ok=True)
+            writer = self.writers[date] = pq.ParquetWriter(
+                self._path(date, self.parts.get(date, 0), tmp=True), SCHEMA,
+                compression="zstd")
+        writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+
+    def _finish(self, date):
+        self._flush(date)
+        writer = self.writers.pop(date, None)
+        if writer is None:
+            return
+        writer.close()
+        part = self.parts.get(date, 0)
+        self.finished.append((self._path(date, part, tmp=True),
+                              self._path(date, part)))
+        self.parts[date] = part + 1
+
+    def close(self):
+        """Finish every file and move it into place, return their paths."""
+        for date in list(self.buffers) + list(self.writers):
+            self._finish(date)
+        paths = []
+        for tmp, path in self.finished:
+            os.replace(tmp, path)
+            paths.append(path)
+        # A run redone after a crash may split a date into fewer files
+        # than the one that died, leave none of those behind.
+        stem, ext = os.path.splitext(self.name)
+        for date, count in self.parts.items():
+            folder = os.path.dirname(self._path(date))
+            for name in os.listdir(folder):
+                part = name[len(stem) + 1:-len(ext)]
+                if name.startswith(stem + "-") and part.isdigit() and \
+                        int(part) >= count:
+                    os.remove(os.path.join(folder, name))
+        return paths
+
+
+def snapshot(collection, directory, schema=LEGACY,
+             settle_seconds=DEFAULT_SETTLE_SECONDS, batch_size=BATCH_SIZE):
+    """Export the documents inserted since the last run, return the files
+    written."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"Another snapshot of {directory} is running")
+        return _snapshot(collection, directory, schema, settle_seconds,
+                         batch_size)
+
+
+def _snapshot(collection, directory, schema, settle_seconds, batch_size):
+    watermark = load_watermark(directory)
+    source = {"collection": collection.full_name, "schema": schema}
+    if watermark and watermark["source"] != source:
+        raise ValueError(
+            f"{directory} holds snapshots of {watermark['source']}, not {source}")
+
+    settled = ObjectId.from_datetime(
+        datetime.now(timezone.utc) - timedelta(seconds=settle_seconds))
+    query = {"_id": {"$lt": settled}}
+    if watermark:
+        query["_id"]["$gt"] = ObjectId(watermark["last_id"])
+    cursor = collection.find(query, batch_size=batch_size).sort("_id", 1)
+
+    writer = None
+    last_id = None
+    skipped = 0
+    for doc in cursor:
+        if writer is None:
+            # Named after the run's first _id, so a run redone after a
+            # crash overwrites the files of the one that died.
+            writer = PartitionWriter(directory, f"part-{doc['_id']}.parquet")
+        row = snapshot_row(doc, schema)
+        if row is None:
+            skipped += 1
+        else:
+            writer.write(row)
+        last_id = doc["_id"]
+
+    if writer is None:
+        print(f"No documents newer than {watermark and watermark['last_id']}")
+        return []
+    if skipped:
+        print(f"Left out {skipped} documents stamped more than {MAX_CLOCK_SKEW_SECONDS}s after their insertion")
+    paths = writer.close()
+    save_watermark(directory, {"source": source, "last_id": str(last_id),
+                               "updated_at": int(time.time())})
+    print(f"Snapshot of {writer.rows} documents up to {last_id} written to {len(paths)} files")
+    return paths
+
+
+def open_snapshot(directory):
+    return ds.dataset(directory, format="parquet", partitioning=PARTITIONING,
+                      ignore_prefixes=[".", "_"])
+
+
+def snapshot_filter(start=None, end=None, routes=None):
+    """Dataset filter on positions at or after start and at or before end
+    (unix seconds), on any of routes. The date bounds prune partitions."""
+    conditions = []
+    if start is not None:
+        conditions += [ds.field("date") >= partition_date(start),
+                       ds.field("raw_timestamp") >= start]
+    if end is not None:
+        conditions += [ds.field("date") <= partition_date(end),
+                       ds.field("raw_timestamp") <= end]
+    if routes:
+        conditions.append(pc.is_in(ds.field("route_id").cast(pa.string()),
+                                   pa.array(routes, pa.string())))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def snapshot_dates(directory, start=None, end=None, paths=None):
+    """The partition dates in directory, or of the files in paths, from
+    start to end, in order."""
+    if paths is None:
+        entries = os.listdir(directory)
+    else:
+        entries = {os.path.basename(os.path.dirname(path)) for path in paths}
+    dates = sorted(entry[len("date="):] for entry in entries
+                   if entry.startswith("date="))
+    return [date for date in dates
+            if (start is None or date >= partition_date(start)) and
+            (end is None or date <= partition_date(end))]
+
+
+def snapshot_files(directory, after_id=None, upto_id=None):
+    """The files written by the runs that exported the _ids after after_id
+    up to upto_id, both the last_id of some run's watermark. Files are
+    named after their run's first _id (see _snapshot)."""
+    paths = []
+    for entry in os.listdir(directory):
+        if not entry.startswith("date="):
+            continue
+        for name in os.listdir(os.path.join(directory, entry)):
+            if not name.startswith("part-"):
+                continue
+            # part-<first _id>.parquet, or part-<first _id>-<n>.parquet
+            first_id = name[len("part-"):-len(".parquet")].split("-")[0]
+            if (after_id is None or first_id > after_id) and \
+                    (upto_id is None or first_id <= upto_id):
+                paths.append(os.path.join(directory, entry, name))
+    return sorted(paths)
+
+
+def read_batches(directory, start=None, end=None, routes=None, columns=None,
+                 batch_size=BATCH_SIZE):
+    """Stream the matching positions as record batches, in no particular
+    order."""
+    dataset = open_snapshot(directory)
+    return dataset.to_batches(columns=columns, batch_size=batch_size,
+                              filter=snapshot_filter(start, end, routes))
+
+
+def read_chunks(directory, start=None, end=None, columns=None,
+                after_id=None, upto_id=None):
+    """The matching positions as tables of CHUNK_SECONDS each, in time
+    order, so each vehicle's points are seen in order across chunks.
+
+    @param after_id, upto_id: Only read the positions exported after and
+        up to these watermark _ids (see snapshot_files), e.g. those new
+        since a report's checkpoint.
+    """
+    if after_id is None and upto_id is None:
+        dataset = open_snapshot(directory)
+        dates = snapshot_dates(directory, start, end)
+    else:
+        paths = snapshot_files(directory, after_id, upto_id)
+        if not paths:
+            return
+        dataset = ds.dataset(paths, format="parquet",
+                             partitioning=PARTITIONING,
+                             partition_base_dir=directory)
+        dates = snapshot_dates(directory, start, end, paths)
+    id_filter = ds.scalar(True)
+    if after_id is not None:
+        id_filter = id_filter & (ds.field("_id") > after_id)
+    if upto_id is not None:
+        id_filter = id_filter & (ds.field("_id") <= upto_id)
+    for date in dates:
+        day = int(datetime.strptime(date, '%Y-%m-%d').replace(
+            tzinfo=timezone.utc).timestamp())
+        for chunk_start in range(day, day + 86400, CHUNK_SECONDS):
+            low = max(chunk_start, start) if start is not None else chunk_start
+            high = chunk_start + CHUNK_SECONDS - 1
+            if end is not None:
+                high = min(high, end)
+            if low > high:
+                continue
+            table = dataset.to_table(columns=columns, filter=(
+                (ds.field("date") == date) &
+                (ds.field("raw_timestamp") >= low) &
+                (ds.field("raw_timestamp") <= high) & id_filter))
+            if table.num_rows:
+                yield table
+
+
+def read_rows(directory, start=None, end=None, routes=None,
+              batch_size=BATCH_SIZE):
+    """Stream the matching positions as dicts of plain Python values, with
+    the coordinates as the shortest decimals that round to their float32."""
+    for batch in read_batches(directory, start, end, routes, SCHEMA.names,
+                              batch_size):
+        values = []
+        for column in batch.columns:
+            if pa.types.is_float32(column.type):
+                values.append(column.to_numpy(zero_copy_only=False)
+                              .astype(str).astype(np.float64).tolist())
+            else:
+                values.append(column.to_pylist())
+        yield from (dict(zip(batch.schema.names, row)) for row in zip(*values))
+
+
+def time_bounds(directory, start=None, end=None):
+    """(first, last) raw_timestamp of the matching positions, or None."""
+    table = open_snapshot(directory).to_table(
+        columns=["raw_timestamp"], filter=snapshot_filter(start, end))
+    if not table.num_rows:
+        return None
+    bounds = pc.min_max(table["raw_timestamp"])
+    return bounds["min"].as_py(), bounds["max"].as_py()
+
+
+def to_numpy(column):
+    """A snapshot column as a numpy array, dictionary ids as str objects."""
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    if pa.types.is_dictionary(column.type):
+        return column.dictionary.to_numpy(zero_copy_only=False)[
+            column.indices.to_numpy(zero_copy_only=False)]
+    if pa.types.is_floating(column.type):
+        return column.to_numpy(zero_copy_only=False).astype(np.float64)
+    return column.to_numpy(zero_copy_only=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the documents inserted since the last run to date-partitioned Parquet files.")
+    parser.add_argument("--mongo-uri", required=False,
+                        help="MongoDB connection URI", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", required=False,
+                        help="MongoDB database name", default="gearchange")
+    parser.add_argument("--collection-name", required=False,
+                        help="MongoDB collection name", default="vehicles")
+    parser.add_argument("--schema", required=False, choices=SCHEMAS, default=LEGACY,
+                        help="Layout of the collection's documents, see schema.py.")
+    parser.add_argument("--snapshot-dir", required=False, default="snapshots",
+                        help="Directory of the Parquet files and the watermark.")
+    parser.add_argument("--settle-seconds", type=int, required=False, default=DEFAULT_SETTLE_SECONDS,
+                        help="Leave documents inserted less than this long ago for the next run.")
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    snapshot(client[args.db_name][args.collection_name], args.snapshot_dir,
+             args.schema, args.settle_seconds)
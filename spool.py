@@ -0,0 +1,360 @@
+"""Durable local spool in front of the db sink.
+
+Each poll's VehicleBatch is appended to a local spool and acknowledged as
+soon as it is on disk, so a slow or restarting mongod never blocks the
+poll loop, and a poller restarted meanwhile loses nothing. A committer
+thread drains the spool into the db sink in groups of several polls, once
+commit_records are waiting or the oldest waiting one is commit_seconds
+old, so every insert_many covers many polls instead of one. A failed
+group is retried, with a doubling delay, until it goes through.
+
+The spool directory holds segment files named after their first sequence
+number (<sequence>.spool) and a COMMITTED_FILE with the sequence of the
+last batch written to the db. A segment is a run of frames:
+
+    sequence (uint64), appended_at (float64 unix seconds), rows (uint32),
+    length (uint32), crc32 (uint32), then length bytes of Arrow IPC stream
+
+On start the frames after the committed sequence are queued again, and a
+torn frame left by a crash mid-append is cut off. A crash between a db
+write and the update of COMMITTED_FILE writes that group again on the next
+start: the unique indexes of the legacy and compact layouts drop the
+repeated points, and for a time-series collection insert_new_to_db looks
+them up before inserting.
+
+    $ python3 gtfs_rt_fetcher.py --feed DTS:DTS_API_KEY:30 --db-mode insert-new --spool-dir spool
+"""
+import collections
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import metrics
+from vehicle_batch import STRING_COLUMNS, VehicleBatch, intern_strings
+
+FRAME_HEADER = struct.Struct("<QdIII")
+COMMITTED_FILE = "_committed.json"
+SEGMENT_SUFFIX = ".spool"
+
+# A group is committed once this many records wait, or the oldest of them
+# waited this long.
+DEFAULT_COMMIT_RECORDS = 20000
+DEFAULT_COMMIT_SECONDS = 30
+
+# Records written to the db at most in one group, e.g. draining a backlog
+# after an outage.
+MAX_GROUP_RECORDS = 200000
+
+# A new segment is started once the current one is this large.
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Seconds close waits for the db on shutdown, e.g. within supervisord's
+# stopwaitsecs.
+CLOSE_SECONDS = 8
+
+# Seconds between updates of spool_lag_seconds while records wait.
+LAG_UPDATE_SECONDS = 5
+
+# Delay before retrying a failed group, doubled up to the maximum.
+RETRY_SECONDS = 1
+MAX_RETRY_SECONDS = 60
+
+SPOOL_PENDING_RECORDS = metrics.Gauge(
+    "spool_pending_records", "Records spooled but not yet written to the db.")
+SPOOL_BYTES = metrics.Gauge(
+    "spool_bytes", "Size of the spool segments on disk.")
+SPOOL_LAG_SECONDS = metrics.Gauge(
+    "spool_lag_seconds", "Age of the oldest record not yet written to the db.")
+SPOOL_APPEND_SECONDS = metrics.Histogram(
+    "spool_append_seconds", "Time to append and sync one poll's records.")
+SPOOL_COMMIT_SECONDS = metrics.Histogram(
+    "spool_commit_seconds", "Time to write one group of spooled records to the db.")
+SPOOL_GROUP_RECORDS = metrics.Histogram(
+    "spool_group_records", "Records written to the db per group.",
+    buckets=metrics.COUNT_BUCKETS)
+SPOOL_COMMITS = metrics.Counter(
+    "spool_commits_total", "Groups written to the db, by result.", ["result"])
+
+# A spooled batch: its frame's location and what the committer needs to
+# know without reading it.
+Entry = collections.namedtuple(
+    "Entry", ["sequence", "appended_at", "rows", "path", "offset", "length"])
+
+
+def serialize(batch):
+    import pyarrow as pa
+    table = pa.table({name: pa.array(values)
+                      for name, values in batch.columns.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize(data):
+    import pyarrow as pa
+    table = pa.ipc.open_stream(data).read_all()
+    columns = {}
+    for name in table.column_names:
+        values = table[name].to_numpy(zero_copy_only=False)
+        if name in STRING_COLUMNS or name == "source":
+            values = intern_strings(values)
+        columns[name] = values
+    return VehicleBatch(columns)
+
+
+def read_frames(path):
+    """Yield (Entry, end offset) for every intact frame of a segment, in
+    order, stopping at the first torn or corrupt one."""
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            sequence, appended_at, rows, length, crc = FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            end = offset + FRAME_HEADER.size + length
+            yield Entry(sequence, appended_at, rows, path,
+                        offset + FRAME_HEADER.size, length), end
+            offset = end
+
+
+class Spool:
+    """Spools batches to directory and writes them with write, a sink
+    taking one VehicleBatch, from a committer thread.
+
+    @param fsync: Sync every append to disk before acknowledging it. Without
+        it, a power loss (not a crash of the poller) can lose the last
+        appends.
+    """
+
+    def __init__(self, directory, write,
+                 commit_records=DEFAULT_COMMIT_RECORDS,
+                 commit_seconds=DEFAULT_COMMIT_SECONDS,
+                 max_group_records=MAX_GROUP_RECORDS,
+                 segment_bytes=SEGMENT_BYTES, fsync=True):
+        self.directory = directory
+        self.write = write
+        self.commit_records = commit_records
+        self.commit_seconds = commit_seconds
+        self.max_group_records = max_group_records
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.pending_rows = 0
+        self.committed = 0
+        self.commits = 0
+        self.committed_rows = 0
+        self.failures = 0
+        self.closing = False
+        # path -> sequence of its last frame, for the segments on disk.
+        self.segments = {}
+        self.segment = None
+        self.bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self.thread = threading.Thread(
+            target=self._run, name="spool-committer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _recover(self):
+        path = os.path.join(self.directory, COMMITTED_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.committed = json.load(f)["sequence"]
+        self.sequence = self.committed
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            end = 0
+            last = None
+            for entry, end in read_frames(path):
+                last = entry.sequence
+                if entry.sequence > self.committed:
+                    self.pending.append(entry)
+                    self.pending_rows += entry.rows
+            if end < os.path.getsize(path):
+                print(f"Cutting a torn frame off the end of spool segment {path}")
+                os.truncate(path, end)
+            if last is None:
+                os.remove(path)
+                continue
+            self.segments[path] = last
+            self.sequence = max(self.sequence, last)
+            self.bytes += end
+        self._drop_committed_segments()
+        if self.pending:
+            print(f"Resuming {self.pending_rows} spooled records of {len(self.pending)} polls from {self.directory}")
+        self._update_metrics()
+
+    def append(self, batch):
+        """Spool one batch, return once it is on disk."""
+        if not len(batch):
+            return
+        with SPOOL_APPEND_SECONDS.time():
+            payload = serialize(batch)
+            with self.condition:
+                if self.segment is None or self.segment.tell() >= self.segment_bytes:
+                    self._open_segment()
+                self.sequence += 1
+                appended_at = time.time()
+                offset = self.segment.tell()
+                self.segment.write(FRAME_HEADER.pack(
+                    self.sequence, appended_at, len(batch), len(payload),
+                    zlib.crc32(payload)))
+                self.segment.write(payload)
+                self.segment.flush()
+                if self.fsync:
+                    os.fsync(self.segment.fileno())
+                self.segments[self.segment.name] = self.sequence
+                self.bytes += FRAME_HEADER.size + len(payload)
+                self.pending.append(Entry(
+                    self.sequence, appended_at, len(batch), self.segment.name,
+                    offset + FRAME_HEADER.size, len(payload)))
+                self.pending_rows += len(batch)
+                self._update_metrics()
+                self.condition.notify()
+
+    # The spool is used as a sink, like the ones of db_sink and file_sink.
+    __call__ = append
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        path = os.path.join(self.directory,
+                            "%020d%s" % (self.sequence + 1, SEGMENT_SUFFIX))
+        self.segment = open(path, "ab")
+
+    def _due(self):
+        if self.closing or self.pending_rows >= self.commit_records:
+            return True
+        return time.time() - self.pending[0].appended_at >= self.commit_seconds
+
+    def _run(self):
+        retry = RETRY_SECONDS
+        while True:
+            with self.condition:
+                while not self.pending or not self._due():
+                    if self.closing:
+                        return
+                    timeout = None
+                    if self.pending:
+                        # Also woken up now and then to keep the lag
+                        # metric current.
+                        timeout = min(self.pending[0].appended_at +
+                                      self.commit_seconds - time.time(),
+                                      LAG_UPDATE_SECONDS)
+                    self.condition.wait(timeout)
+                    self._update_metrics()
+                group = []
+                rows = 0
+                for entry in self.pending:
+                    if group and rows + entry.rows > self.max_group_records:
+                        break
+                    group.append(entry)
+                    rows += entry.rows
+            if self._commit(group, rows):
+                retry = RETRY_SECONDS
+                continue
+            with self.condition:
+                if self.closing:
+                    return
+                self.condition.wait(retry)
+            retry = min(retry * 2, MAX_RETRY_SECONDS)
+
+    def _commit(self, group, rows):
+        """Write a group to the db and mark it committed, return whether
+        that worked."""
+        try:
+            batches = []
+            for entry in group:
+                with open(entry.path, "rb") as f:
+                    f.seek(entry.offset)
+                    batches.append(deserialize(f.read(entry.length)))
+            with SPOOL_COMMIT_SECONDS.time():
+                self.write(VehicleBatch.concat(batches))
+        except Exception as e:
+            self.failures += 1
+            SPOOL_COMMITS.inc(result="error")
+            print(f"Error writing {rows} spooled records to the db, keeping them spooled: {e}")
+            return False
+
+        last = group[-1].sequence
+        self._save_committed(last)
+        with self.condition:
+            self.committed = last
+            for _ in group:
+                self.pending.popleft()
+            self.pending_rows -= rows
+            self.commits += 1
+            self.committed_rows += rows
+            self._drop_committed_segments()
+            self._update_metrics()
+        SPOOL_COMMITS.inc(result="ok")
+        SPOOL_GROUP_RECORDS.observe(rows)
+        metrics.log(
+            f"Wrote {rows} spooled records of {len(group)} polls to the db, "
+            f"{self.pending_rows} still spooled",
+            event="spool_commit", records=rows, polls=len(group),
+            pending=self.pending_rows)
+        return True
+
+    def _save_committed(self, sequence):
+        path = os.path.join(self.directory, COMMITTED_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"sequence": sequence}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _drop_committed_segments(self):
+        current = self.segment.name if self.segment is not None else None
+        for path, last in list(self.segments.items()):
+            if last <= self.committed and path != current:
+                self.bytes -= os.path.getsize(path)
+                os.remove(path)
+                del self.segments[path]
+
+    def _update_metrics(self):
+        SPOOL_PENDING_RECORDS.set(self.pending_rows)
+        SPOOL_BYTES.set(self.bytes)
+        SPOOL_LAG_SECONDS.set(
+            time.time() - self.pending[0].appended_at if self.pending else 0)
+
+    def close(self, timeout=CLOSE_SECONDS):
+        """Commit what is spooled, waiting at most timeout seconds for the
+        db. Whatever is left is written on the next start."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        with self.condition:
+            if self.segment is not None and not self.thread.is_alive():
+                self.segment.close()
+        print(f"Spool stats: {self.stats()}")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending_records": self.pending_rows,
+                "pending_polls": len(self.pending),
+                "lag_seconds": time.time() - self.pending[0].appended_at
+                if self.pending else 0,
+                "bytes": self.bytes,
+                "commits": self.commits,
+                "committed_records": self.committed_rows,
+                "failures": self.failures,
+            }
@@ -0,0 +1,62 @@
+"""LiveStore queries against a brute-force reference."""
+import time
+
+import numpy as np
+import pytest
+
+from distance_engine import haversine_km
+from live_store import LiveStore
+from vehicle_batch import RECORD_COLUMNS, VehicleBatch
+
+VEHICLES = 4000
+
+
+def records(count, seed=0):
+    """Vehicles scattered around Delhi, reporting now."""
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(28.4, 28.9, count)
+    lons = rng.uniform(76.9, 77.4, count)
+    now = int(time.time())
+    rows = []
+    for i in range(count):
+        row = dict.fromkeys(RECORD_COLUMNS, "")
+        row.update(vehicle_id=f"DL1PC{i:04d}", route_id=str(i % 50),
+                   latitude=float(lats[i]), longitude=float(lons[i]),
+                   raw_timestamp=now)
+        rows.append(row)
+    return rows
+
+
+@pytest.fixture(scope="module")
+def store():
+    store = LiveStore()
+    store.update(VehicleBatch.from_records(records(VEHICLES)))
+    return store
+
+
+def brute_force(store, lat, lon, k):
+    positions = list(store.vehicles.values())
+    distances = haversine_km(lat, lon,
+                             np.array([p["latitude"] for p in positions]),
+                             np.array([p["longitude"] for p in positions]))
+    return [positions[i]["vehicle_id"] for i in np.argsort(distances)[:k]]
+
+
+@pytest.mark.parametrize("lat, lon", [(28.6, 77.2), (28.95, 77.45),
+                                      (20.0, 77.0), (0.0, 0.0),
+                                      (-45.0, -120.0)])
+def test_nearest_matches_brute_force(store, lat, lon):
+    start = time.perf_counter()
+    found = store.nearest(lat, lon, k=5)
+    seconds = time.perf_counter() - start
+    assert [p["vehicle_id"] for p in found] == brute_force(store, lat, lon, 5)
+    # Points far from every vehicle must not walk thousands of empty rings
+    # while holding the lock update() needs.
+    assert seconds < 0.5
+
+
+def test_nearest_outside_the_data_with_max_km(store):
+    assert store.nearest(0.0, 0.0, k=5, max_km=100) == []
+    found = store.nearest(28.6, 77.2, k=3, max_km=100)
+    assert len(found) == 3
+    assert all(p["distance_km"] <= 100 for p in found)
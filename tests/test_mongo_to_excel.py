@@ -0,0 +1,68 @@
+"""PartWriter keeps every column of the layout, whichever document comes first."""
+import csv
+from datetime import datetime, timezone
+
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+import mongo_to_excel
+from mongo_to_excel import PartWriter, export_columns, flatten
+from schema import COMPACT, LEGACY
+
+
+def legacy_docs():
+    first = {"_id": "a", "vehicle_id": "V1", "route_id": "534",
+             "latitude": 28.6, "longitude": 77.2, "raw_timestamp": 1742250000}
+    # Written after user-006, with the field the first one lacks.
+    second = dict(first, _id="b", source="dts", trip_id="T9",
+                  raw_timestamp=1742250030)
+    return [first, second]
+
+
+def test_csv_and_xlsx_keep_fields_missing_from_the_first_row(tmp_path):
+    columns = export_columns(LEGACY)
+    for output_format in ("csv", "xlsx"):
+        output = str(tmp_path / f"db.{output_format}")
+        writer = PartWriter(output, output_format, columns)
+        for doc in legacy_docs():
+            writer.write(doc)
+        writer.close()
+        if output_format == "csv":
+            with open(output, newline="") as f:
+                rows = list(csv.DictReader(f))
+            header = list(rows[0])
+        else:
+            sheet = load_workbook(output).active
+            values = list(sheet.values)
+            header = list(values[0])
+            rows = [dict(zip(header, row)) for row in values[1:]]
+        assert header == columns
+        assert rows[1]["source"] == "dts"
+        assert rows[1]["trip_id"] == "T9"
+
+
+def test_parquet_column_empty_in_the_first_row_group(tmp_path, monkeypatch):
+    monkeypatch.setattr(mongo_to_excel, "PARQUET_ROW_GROUP", 1)
+    output = str(tmp_path / "db.parquet")
+    writer = PartWriter(output, "parquet", export_columns(LEGACY))
+    for doc in legacy_docs():
+        writer.write(doc)
+    writer.close()
+    table = pq.read_table(output)
+    assert table.column_names == export_columns(LEGACY)
+    assert table["source"].to_pylist() == [None, "dts"]
+    assert table["latitude"].type == "double"
+
+
+def test_parquet_compact_documents(tmp_path):
+    output = str(tmp_path / "db.parquet")
+    writer = PartWriter(output, "parquet", export_columns(COMPACT))
+    writer.write(flatten({
+        "_id": "a", "ts": datetime(2025, 3, 18, tzinfo=timezone.utc),
+        "epoch": 1742256000, "lat": 28.6, "lon": 77.2,
+        "meta": {"vehicle_id": "V1", "route_id": "534"}}, COMPACT))
+    writer.close()
+    row = pq.read_table(output).to_pylist()[0]
+    assert row["vehicle_id"] == "V1"
+    assert row["epoch"] == 1742256000
+    assert row["trip_id"] is None
@@ -0,0 +1,68 @@
+"""update_checkpoint picks up where its watermark left off."""
+import time
+
+import mongomock
+
+import report
+from schema import LEGACY, TIMESERIES, ensure_collection, to_document
+
+
+def records(vehicles, epochs):
+    return [{"vehicle_id": f"V{v}", "route_id": "534",
+             "latitude": 28.6 + i * 0.001, "longitude": 77.2,
+             "timestamp": f"00:00:00 01-01-2025 ({epoch})",
+             "raw_timestamp": epoch}
+            for v in range(vehicles) for i, epoch in enumerate(epochs)]
+
+
+def folded(checkpoint):
+    return sum(state["count"] for state in checkpoint["vehicles"].values())
+
+
+def test_timeseries_watermark_is_the_time_folded_up_to():
+    # A plain collection stands in for the time-series one, which
+    # mongomock cannot create; update_checkpoint only reads it.
+    collection = mongomock.MongoClient().db.vehicles
+    now = int(time.time())
+    collection.insert_many([to_document(r, TIMESERIES) for r in records(
+        3, [now - 3600, now - 1800, now - 600])])
+    checkpoint = report.new_checkpoint(
+        120, False, "vehicles", TIMESERIES,
+        report.watermark_field(TIMESERIES))
+    assert checkpoint["params"]["watermark"] == "time"
+
+    report.update_checkpoint(collection, checkpoint, settle_seconds=120)
+    assert folded(checkpoint) == 9
+    assert now - 120 <= checkpoint["watermark"] <= int(time.time()) - 120
+
+    # Newer than the watermark but not settled, then settled.
+    collection.insert_many([to_document(r, TIMESERIES) for r in records(
+        3, [now - 60])])
+    report.update_checkpoint(collection, checkpoint, settle_seconds=120)
+    assert folded(checkpoint) == 9
+    report.update_checkpoint(collection, checkpoint, settle_seconds=0)
+    assert folded(checkpoint) == 12
+    assert sum(checkpoint["time_buckets"].values()) == 12
+
+
+def test_legacy_watermark_is_the_last_id():
+    db = mongomock.MongoClient().db
+    collection = ensure_collection(db, "vehicles", LEGACY)
+    names = {index["name"] for index in collection.list_indexes()}
+    assert {"vehicle_id_1_timestamp_1", "vehicle_id_1_raw_timestamp_1",
+            "raw_timestamp_1"} <= names
+
+    now = int(time.time())
+    collection.insert_many(records(2, [now - 600, now - 300]))
+    # ObjectIds have whole seconds, those of this second are not settled.
+    time.sleep(1)
+    checkpoint = report.new_checkpoint(120, False)
+    report.update_checkpoint(collection, checkpoint, settle_seconds=0)
+    assert folded(checkpoint) == 4
+    # A late report, stamped before everything folded in so far.
+    collection.insert_many(records(1, [now - 7200]))
+    time.sleep(1)
+    report.update_checkpoint(collection, checkpoint, settle_seconds=0)
+    assert folded(checkpoint) == 5
+    assert checkpoint["watermark"] == str(
+        collection.find_one(sort=[("_id", -1)])["_id"])
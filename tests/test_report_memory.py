@@ -0,0 +1,83 @@
+"""report.py's memory is bounded by the number of vehicles, not points.
+
+Positions come from a fake collection that generates them as they are
+read, sorted like a mongod's cursor would return them, so the memory
+measured is the report's own. benchmarks/bench_report_memory.py measures
+the same against a real mongod.
+"""
+import random
+import tracemalloc
+
+import pytest
+
+import report
+from schema import LEGACY, time_query
+
+VEHICLES = 20
+BATCH_SIZE = 100
+
+# What folding may keep: the state of VEHICLES vehicles and one batch of
+# BATCH_SIZE positions, with room to spare. Measured at 45-65KB from 1000
+# to 64000 points, loading 16000 of them takes 5MB.
+BOUND_BYTES = 128 * 1024
+
+
+class GeneratedCursor:
+    def __init__(self, points, vehicles, seed):
+        self.points = points
+        self.vehicles = vehicles
+        self.seed = seed
+
+    def sort(self, keys):
+        assert [key for key, _ in keys] == ["vehicle_id", "raw_timestamp"]
+        return self
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        per_vehicle = self.points // self.vehicles
+        for v in range(self.vehicles):
+            lat, lon = rng.uniform(28.4, 28.9), rng.uniform(76.9, 77.4)
+            for i in range(per_vehicle):
+                lat += rng.gauss(0, 0.0008)
+                lon += rng.gauss(0, 0.0008)
+                yield {"vehicle_id": f"DL1PC{v:04d}",
+                       "raw_timestamp": 1742250000 + i * 30,
+                       "latitude": lat, "longitude": lon}
+
+
+class GeneratedPositions:
+    """A legacy layout collection of random-walk positions, made on read."""
+
+    def __init__(self, points, vehicles=VEHICLES, seed=0):
+        self.points = points
+        self.vehicles = vehicles
+        self.seed = seed
+
+    def find(self, query, projection=None, **kwargs):
+        return GeneratedCursor(self.points, self.vehicles, self.seed)
+
+
+def peak_bytes(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("points", [1000, 16000])
+def test_stream_positions_memory_does_not_grow_with_points(points):
+    state = {}
+    peak = peak_bytes(lambda: report.stream_positions(
+        GeneratedPositions(points), state, time_query(LEGACY), BATCH_SIZE))
+    assert len(state) == VEHICLES
+    assert sum(s["count"] for s in state.values()) == points
+    assert peak < BOUND_BYTES
+
+
+def test_bound_catches_loading_every_position():
+    collection = GeneratedPositions(16000)
+    peak = peak_bytes(lambda: list(collection.find(time_query(LEGACY)).sort(
+        [("vehicle_id", 1), ("raw_timestamp", 1)])))
+    assert peak > BOUND_BYTES
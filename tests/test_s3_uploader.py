@@ -0,0 +1,79 @@
+"""S3Uploader against moto's in-process S3."""
+import os
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import s3_uploader
+from s3_uploader import S3Uploader
+
+BUCKET = "gearchange-test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "test"),
+                        ("AWS_SECRET_ACCESS_KEY", "test"),
+                        ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def write_file(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def stored(client, name):
+    return client.get_object(Bucket=BUCKET, Key=name)["Body"].read()
+
+
+def test_uploads_queued_and_leftover_files(s3, tmp_path):
+    queue_dir = tmp_path / "queue"
+    queue_dir.mkdir()
+    # Left behind by an earlier uploader.
+    write_file(queue_dir, "vehicles_0.xlsx", b"left over")
+    uploader = S3Uploader(BUCKET, str(queue_dir)).start()
+    uploader.enqueue(write_file(tmp_path, "vehicles_1.xlsx", b"rotated"))
+
+    assert uploader.wait(timeout=10)
+    assert stored(s3, "vehicles_0.xlsx") == b"left over"
+    assert stored(s3, "vehicles_1.xlsx") == b"rotated"
+    assert os.listdir(queue_dir) == []
+    assert uploader.stats()["uploaded"] == 2
+    assert s3_uploader.S3_QUEUE_DEPTH.values[()] == 0
+
+
+def test_failing_file_does_not_hold_up_the_others(s3, tmp_path):
+    uploader = S3Uploader(BUCKET, str(tmp_path / "queue"), max_retries=2,
+                          backoff_seconds=0.01, max_backoff_seconds=60)
+    upload_file = uploader.client.upload_file
+
+    def fail_bad_file(path, bucket, key, **kwargs):
+        if key == "bad.xlsx":
+            raise OSError("connection reset")
+        return upload_file(path, bucket, key, **kwargs)
+
+    uploader.client.upload_file = fail_bad_file
+    uploader.start()
+    uploader.enqueue(write_file(tmp_path, "bad.xlsx", b"bad"))
+    time.sleep(0.5)
+    # bad.xlsx has used up its retries and waits max_backoff_seconds.
+    for i in range(3):
+        uploader.enqueue(write_file(tmp_path, f"good_{i}.xlsx", b"good"))
+
+    assert not uploader.wait(timeout=5)
+    for i in range(3):
+        assert stored(s3, f"good_{i}.xlsx") == b"good"
+    assert uploader.queue_depth() == 1
+    assert s3_uploader.S3_QUEUE_DEPTH.values[()] == 1
+    assert uploader.stats()["failures"] == 2
+    assert os.path.exists(tmp_path / "queue" / "bad.xlsx")
@@ -0,0 +1,51 @@
+"""stored_reports looks up only the exact keys it is given."""
+import mongomock
+
+import schema
+from schema import COMPACT, LEGACY, stored_reports, to_document
+
+
+class CountingCollection:
+    """Counts the documents find returns."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.fetched = 0
+        self.queries = 0
+
+    def find(self, *args, **kwargs):
+        docs = list(self.collection.find(*args, **kwargs))
+        self.fetched += len(docs)
+        self.queries += 1
+        return docs
+
+
+def make_collection(layout, epochs, vehicles=("V1", "V2")):
+    collection = mongomock.MongoClient().db.vehicles
+    collection.insert_many([to_document(
+        {"vehicle_id": vehicle_id, "route_id": "534", "latitude": 28.6,
+         "longitude": 77.2, "raw_timestamp": epoch}, layout)
+        for vehicle_id in vehicles for epoch in epochs])
+    return CountingCollection(collection)
+
+
+def test_spread_epochs_fetch_only_their_keys():
+    # A day of positions every 30s, and keys from its two ends, as after
+    # a restart that found reports from both.
+    epochs = range(1742256000, 1742256000 + 86400, 30)
+    for layout in (LEGACY, COMPACT):
+        collection = make_collection(layout, epochs)
+        keys = [("V1", epochs[0]), ("V1", epochs[-1]), ("V2", epochs[1]),
+                ("V2", 1742256001), ("V3", epochs[5])]
+        assert stored_reports(collection, keys, layout) == set(keys[:3])
+        assert collection.fetched == 3
+
+
+def test_vehicles_batched(monkeypatch):
+    monkeypatch.setattr(schema, "STORED_REPORTS_BATCH", 2)
+    vehicles = [f"V{i}" for i in range(5)]
+    collection = make_collection(COMPACT, [1742256000, 1742300000], vehicles)
+    keys = [(vehicle_id, 1742300000) for vehicle_id in vehicles]
+    assert stored_reports(collection, keys, COMPACT) == set(keys)
+    assert collection.queries == 3
+    assert collection.fetched == 5
@@ -0,0 +1,68 @@
+"""PartitionWriter bounds its buffers and open files over many dates."""
+import os
+
+import snapshot
+from snapshot import PartitionWriter, read_rows, snapshot_files
+
+DAY = 86400
+START = 1742256000  # 2025-03-18 00:00 UTC
+NAME = "part-67d8b5000000000000000000.parquet"
+
+
+def make_row(i, epoch):
+    row = dict.fromkeys(snapshot.SCHEMA.names)
+    row.update(_id=f"{i:024x}", vehicle_id=f"V{i % 7}", route_id="534",
+               latitude=28.6, longitude=77.2, raw_timestamp=epoch)
+    return row
+
+
+def rows_over_days(days, per_day):
+    rows = []
+    for day in range(days):
+        for i in range(per_day):
+            epoch = START + day * DAY + i * DAY // per_day
+            rows.append(make_row(len(rows), epoch))
+            if day >= 2 and i % 10 == 0:
+                # A vehicle whose clock lags two days behind.
+                rows.append(make_row(len(rows), epoch - 2 * DAY))
+    return rows
+
+
+def test_buffers_and_open_files_stay_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "ROW_GROUP_SIZE", 50)
+    monkeypatch.setattr(snapshot, "MAX_BUFFERED_ROWS", 120)
+    rows = rows_over_days(10, 100)
+    writer = PartitionWriter(str(tmp_path), NAME)
+    for row in rows:
+        writer.write(row)
+        assert writer.buffered <= 120
+        assert len(writer.writers) <= 2
+    paths = writer.close()
+
+    assert not [name for _, _, names in os.walk(tmp_path)
+                for name in names if name.endswith(".tmp")]
+    assert sorted(paths) == snapshot_files(str(tmp_path))
+    # Late positions landed in second files of dates already finished.
+    assert any(path.endswith("-1.parquet") for path in paths)
+    read = sorted(row["_id"] for row in read_rows(str(tmp_path)))
+    assert read == sorted(row["_id"] for row in rows)
+    assert snapshot_files(str(tmp_path), after_id="67d8b4", upto_id=NAME[5:29]) \
+        == sorted(paths)
+
+
+def test_redone_run_leaves_no_extra_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "ROW_GROUP_SIZE", 50)
+    monkeypatch.setattr(snapshot, "MAX_BUFFERED_ROWS", 120)
+    first = PartitionWriter(str(tmp_path), NAME)
+    for row in rows_over_days(5, 100):
+        first.write(row)
+    first.close()
+
+    # The redone run gets the same dates without the late positions.
+    redone = PartitionWriter(str(tmp_path), NAME)
+    for i in range(500):
+        redone.write(make_row(i, START + i * DAY // 100))
+    paths = redone.close()
+    assert len(paths) == 5
+    for path in paths:
+        assert os.listdir(os.path.dirname(path)) == [NAME]
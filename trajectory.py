@@ -0,0 +1,215 @@
+"""Online per-vehicle trajectory compression for the ingest path.
+
+TrajectoryCompressor keeps, per vehicle, the last stored point (the anchor)
+and the points reported since. A new point is only stored once the
+straight segment from the anchor to the newest point no longer passes
+within tolerance_m of every point in between (an opening window variant of
+Douglas-Peucker), in which case the previous point is stored and becomes
+the new anchor. A parked bus reporting the same position falls inside the
+tolerance of its anchor and is not stored again until keepalive_seconds
+after the anchor, so every vehicle still has a stored point at least that
+often.
+
+Points between the anchor and the newest point must also progress along
+the segment, moving back by at most tolerance_m, so a bus doubling back
+on itself is not flattened into a straight line.
+
+Error bounds, for tolerance t:
+- every dropped point lies within t meters of the stored trajectory
+  (the segment between the stored points around it);
+- the stored trajectory is never longer than the reported one, and at
+  most 4t shorter per dropped point (2t across and 2t back along the
+  segment), in practice far less: GPS jitter of parked buses is most of
+  what is removed;
+- on shutdown, at most the points since each vehicle's anchor are lost,
+  i.e. under keepalive_seconds of movement, unless flush() is called.
+
+Reports from a clock ahead of the feed (see latest_plausible_epoch) are
+dropped before they reach a vehicle's state, as every later report would
+otherwise look older than them and be dropped as a repeat.
+"""
+import math
+
+import numpy as np
+
+import metrics
+from schema import latest_plausible_epoch
+from vehicle_batch import VehicleBatch
+
+EARTH_RADIUS_M = 6371008.8
+
+DEFAULT_TOLERANCE_M = 15.0
+DEFAULT_KEEPALIVE_SECONDS = 300
+
+TRAJECTORY_POINTS = metrics.Counter(
+    "trajectory_points_total", "Position reports seen by the trajectory compressor, by outcome.",
+    ["result"])
+
+
+def segment_offsets_m(anchor, end, point):
+    """(across, along) meters of point relative to the segment anchor-end,
+    each a (lat, lon) pair, on a local flat projection around anchor.
+    across is the distance to the nearest point of the segment, along how
+    far that point is from anchor."""
+    scale = math.cos(math.radians(anchor[0]))
+    ex = math.radians(end[1] - anchor[1]) * scale * EARTH_RADIUS_M
+    ey = math.radians(end[0] - anchor[0]) * EARTH_RADIUS_M
+    px = math.radians(point[1] - anchor[1]) * scale * EARTH_RADIUS_M
+    py = math.radians(point[0] - anchor[0]) * EARTH_RADIUS_M
+    length2 = ex * ex + ey * ey
+    t = 0.0 if length2 == 0 else max(0.0, min(1.0, (px * ex + py * ey) / length2))
+    return math.hypot(px - t * ex, py - t * ey), t * math.sqrt(length2)
+
+
+class TrajectoryCompressor:
+    """Drops position reports that do not change a vehicle's trajectory.
+
+    @param tolerance_m: Largest distance, in meters, a dropped point may be
+        from the stored trajectory.
+    @param keepalive_seconds: Longest time, in feed time, between two
+        stored points of a vehicle that keeps reporting.
+    """
+
+    def __init__(self, tolerance_m=DEFAULT_TOLERANCE_M,
+                 keepalive_seconds=DEFAULT_KEEPALIVE_SECONDS):
+        self.tolerance_m = tolerance_m
+        self.keepalive_seconds = keepalive_seconds
+        # Per reporting vehicle_id: {"anchor": (lat, lon, ts), "window": [(lat, lon)],
+        # "pending": (batch, row, lat, lon, ts) or None, "seen": feed time
+        # of its last report}
+        self.vehicles = {}
+        self.points_in = 0
+        self.points_stored = 0
+        self.duplicates = 0
+        self.future = 0
+        self.max_deviation_m = 0.0
+
+    def compress(self, batch):
+        """Return the batch of points to store, given the latest one.
+
+        Points stored may be from an earlier batch, as a point is only
+        known to matter once a later one bends the trajectory.
+        """
+        lats = batch.columns["latitude"].tolist()
+        lons = batch.columns["longitude"].tolist()
+        timestamps = batch.columns["raw_timestamp"].tolist()
+        # Feeds carry the odd vehicle clock decades off, so the feed's time
+        # is the batch's median, as in LiveStore.
+        now = int(np.median(timestamps)) if timestamps else None
+        latest_plausible = latest_plausible_epoch(timestamps)
+        # Rows to store, per batch they come from.
+        stored = {id(batch): (batch, [])}
+        future = 0
+
+        def store(source, row):
+            stored.setdefault(id(source), (source, []))[1].append(row)
+            self.points_stored += 1
+
+        for row, vehicle_id in enumerate(batch.columns["vehicle_id"]):
+            lat, lon, ts = lats[row], lons[row], timestamps[row]
+            self.points_in += 1
+            if ts > latest_plausible:
+                future += 1
+                continue
+            state = self.vehicles.get(vehicle_id)
+            if state is None:
+                self.vehicles[vehicle_id] = {
+                    "anchor": (lat, lon, ts), "window": [], "pending": None,
+                    "seen": now}
+                store(batch, row)
+                continue
+            state["seen"] = now
+
+            pending = state["pending"]
+            last_ts = pending[4] if pending else state["anchor"][2]
+            if ts <= last_ts:
+                self.duplicates += 1
+                continue
+
+            anchor = state["anchor"]
+            deviation = self.deviation_m(anchor, (lat, lon), state["window"])
+            if deviation > self.tolerance_m:
+                # The pending point bends the trajectory, keep it.
+                store(pending[0], pending[1])
+                anchor = state["anchor"] = pending[2:]
+                state["window"] = []
+            else:
+                self.max_deviation_m = max(self.max_deviation_m, deviation)
+
+            if ts - anchor[2] >= self.keepalive_seconds:
+                store(batch, row)
+                state["anchor"] = (lat, lon, ts)
+                state["window"] = []
+                state["pending"] = None
+            else:
+                state["window"].append((lat, lon))
+                state["pending"] = (batch, row, lat, lon, ts)
+
+        if now is not None:
+            self._expire(now, store)
+        TRAJECTORY_POINTS.inc(len(batch), result="seen")
+        TRAJECTORY_POINTS.inc(future, result="future")
+        self.future += future
+        return self._collect(stored.values())
+
+    def deviation_m(self, anchor, end, window):
+        """How far the window points stray from the segment anchor-end:
+        the largest distance across it, or infinity if they move back
+        along it by more than tolerance_m."""
+        deviation, furthest = 0.0, 0.0
+        for point in window:
+            across, along = segment_offsets_m(anchor, end, point)
+            if along < furthest - self.tolerance_m:
+                return math.inf
+            deviation = max(deviation, across)
+            furthest = max(furthest, along)
+        return deviation
+
+    def _expire(self, now, store):
+        """Store the pending point of, and forget, vehicles that have not
+        reported for keepalive_seconds of feed time, so their state (and
+        the batch their pending point is in) is not held forever."""
+        oldest = now - self.keepalive_seconds
+        for vehicle_id, state in list(self.vehicles.items()):
+            if state["seen"] >= oldest:
+                continue
+            pending = state["pending"]
+            if pending:
+                store(pending[0], pending[1])
+            del self.vehicles[vehicle_id]
+
+    def flush(self):
+        """Return a batch of every vehicle's pending point, e.g. before
+        shutting down, so the trajectories end where the vehicles are."""
+        stored = {}
+        for state in self.vehicles.values():
+            pending = state["pending"]
+            if pending:
+                stored.setdefault(id(pending[0]), (pending[0], []))[1].append(
+                    pending[1])
+                self.points_stored += 1
+                state["anchor"] = pending[2:]
+                state["window"] = []
+                state["pending"] = None
+        return self._collect(stored.values())
+
+    def _collect(self, stored):
+        parts = [source.take(sorted(rows)) for source, rows in stored if rows]
+        TRAJECTORY_POINTS.inc(sum(len(part) for part in parts), result="stored")
+        return VehicleBatch.concat(parts)
+
+    def stats(self):
+        return {
+            "points_in": self.points_in,
+            "points_stored": self.points_stored,
+            "duplicates": self.duplicates,
+            "future": self.future,
+            # Repeated reports are not counted, insert-new drops them anyway.
+            "compression_ratio": round(
+                (self.points_in - self.duplicates - self.future) /
+                self.points_stored, 2)
+            if self.points_stored else None,
+            "tolerance_m": self.tolerance_m,
+            "max_dropped_deviation_m": round(self.max_deviation_m, 2),
+            "keepalive_seconds": self.keepalive_seconds,
+        }
@@ -0,0 +1,215 @@
+"""Columnar form of the vehicle positions in one feed snapshot.
+
+decode_feed pulls the fields of every vehicle entity straight into one
+array per column, instead of building a dict per vehicle:
+
+- string columns are object arrays of shared str objects, so the same
+  route or trip id seen poll after poll is one object;
+- latitude/longitude are float64 arrays and raw_timestamp an int64 array;
+- the "HH:MM:SS dd-mm-YYYY (epoch)" display timestamp is only formatted
+  when a sink asks for it, once per distinct epoch rather than per row.
+
+Sinks take a VehicleBatch and convert it to whatever they write, pandas,
+arrow or Mongo documents, directly from the columns. records() returns the
+dicts parse_gtfs has always returned, for code that wants those.
+"""
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from schema import LEGACY, META_FIELDS
+
+STRING_COLUMNS = ["entity_wrapper_id", "vehicle_id", "route_id",
+                  "vehicle_label", "trip_id", "trip_start_time",
+                  "trip_start_date"]
+
+# Key order of the records parse_gtfs returns.
+RECORD_COLUMNS = STRING_COLUMNS + ["latitude", "longitude", "timestamp",
+                                   "raw_timestamp"]
+
+# Strings seen in recent feeds, see intern_strings.
+_strings = {}
+MAX_INTERNED_STRINGS = 200000
+
+
+def intern_strings(values):
+    """Return values as an object array, with every string replaced by the
+    copy seen first, so repeated ids across polls share one object."""
+    if len(_strings) > MAX_INTERNED_STRINGS:
+        # Trip ids change daily, start over rather than grow forever.
+        _strings.clear()
+    intern = _strings.setdefault
+    array = np.empty(len(values), dtype=object)
+    array[:] = [intern(value, value) for value in values]
+    return array
+
+
+def format_timestamp(epoch):
+    return "%s (%s)" % (time.strftime(
+        '%H:%M:%S %d-%m-%Y', time.localtime(epoch)), epoch)
+
+
+def _per_epoch(raw_timestamps, fn):
+    """Apply fn to each distinct epoch once and spread the results."""
+    epochs, inverse = np.unique(raw_timestamps, return_inverse=True)
+    values = np.empty(len(epochs), dtype=object)
+    values[:] = [fn(epoch) for epoch in epochs.tolist()]
+    return values[inverse]
+
+
+class VehicleBatch:
+    """The vehicle positions of one snapshot, one array per column.
+
+    @param columns: Dict of column name to equally long numpy arrays, with
+        at least the STRING_COLUMNS, latitude, longitude and raw_timestamp.
+        A source column is added by with_source.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._timestamp = None
+
+    def __len__(self):
+        return len(self.columns["raw_timestamp"])
+
+    @property
+    def timestamp(self):
+        """The display timestamp column, formatted on first use."""
+        if self._timestamp is None:
+            self._timestamp = _per_epoch(
+                self.columns["raw_timestamp"], format_timestamp)
+        return self._timestamp
+
+    def column_names(self):
+        names = list(RECORD_COLUMNS)
+        names += [name for name in self.columns if name not in names]
+        return names
+
+    def column(self, name):
+        if name == "timestamp":
+            return self.timestamp
+        return self.columns[name]
+
+    def take(self, indices):
+        """A new batch with only the rows at indices."""
+        indices = np.asarray(indices, dtype=np.intp)
+        batch = VehicleBatch({name: values[indices]
+                              for name, values in self.columns.items()})
+        if self._timestamp is not None:
+            batch._timestamp = self._timestamp[indices]
+        return batch
+
+    def with_source(self, source):
+        """A copy of this batch with a constant source column."""
+        columns = dict(self.columns)
+        columns["source"] = np.full(len(self), source, dtype=object)
+        batch = VehicleBatch(columns)
+        batch._timestamp = self._timestamp
+        return batch
+
+    def records(self, indices=None):
+        """The rows as the dicts parse_gtfs returns."""
+        batch = self if indices is None else self.take(indices)
+        names = batch.column_names()
+        # tolist() turns numpy scalars into the Python types pymongo and
+        # openpyxl expect.
+        values = [batch.column(name).tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def documents(self, schema, indices=None):
+        """The rows as new documents in the schema.py layout."""
+        if schema == LEGACY:
+            return self.records(indices)
+        batch = self if indices is None else self.take(indices)
+        meta_names = [name for name in META_FIELDS if name in batch.columns]
+        meta = zip(*[batch.columns[name].tolist() for name in meta_names])
+        epochs = batch.columns["raw_timestamp"]
+        times = _per_epoch(
+            epochs, lambda epoch: datetime.fromtimestamp(epoch, timezone.utc))
+        return [{"ts": ts, "epoch": epoch, "lat": lat, "lon": lon,
+                 "meta": dict(zip(meta_names, meta_values))}
+                for ts, epoch, lat, lon, meta_values in zip(
+                    times.tolist(), epochs.tolist(),
+                    batch.columns["latitude"].tolist(),
+                    batch.columns["longitude"].tolist(), meta)]
+
+    def to_pandas(self):
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name)
+                             for name in self.column_names()})
+
+    def to_arrow(self):
+        import pyarrow as pa
+        names = self.column_names()
+        return pa.table([pa.array(self.column(name)) for name in names],
+                        names=names)
+
+    @classmethod
+    def concat(cls, batches):
+        """One batch with the rows of batches, in order."""
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.from_records([])
+        if len(batches) == 1:
+            return batches[0]
+        return cls({name: np.concatenate([batch.columns[name]
+                                          for batch in batches])
+                    for name in batches[0].columns})
+
+    @classmethod
+    def from_records(cls, records):
+        """Build a batch from parse_gtfs style dicts."""
+        names = [name for name in RECORD_COLUMNS if name != "timestamp"]
+        if records and "source" in records[0]:
+            names.append("source")
+        columns = {}
+        for name in names:
+            values = [record[name] for record in records]
+            if name == "latitude" or name == "longitude":
+                columns[name] = np.array(values, dtype=np.float64)
+            elif name == "raw_timestamp":
+                columns[name] = np.array(values, dtype=np.int64)
+            else:
+                columns[name] = intern_strings(values)
+        return cls(columns)
+
+
+def as_batch(data):
+    """Return data, a VehicleBatch or a list of records, as a batch."""
+    if isinstance(data, VehicleBatch):
+        return data
+    return VehicleBatch.from_records(data)
+
+
+def decode_feed(feed):
+    """Decode the vehicle entities of a parsed FeedMessage into a batch."""
+    strings = {name: [] for name in STRING_COLUMNS}
+    entity_ids, vehicle_ids, route_ids, labels, trip_ids, start_times, \
+        start_dates = [strings[name].append for name in STRING_COLUMNS]
+    latitudes, longitudes, timestamps = [], [], []
+
+    for entity in feed.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        vehicle = entity.vehicle
+        descriptor = vehicle.vehicle
+        trip = vehicle.trip
+        position = vehicle.position
+        entity_ids(entity.id)
+        vehicle_ids(descriptor.id)
+        labels(descriptor.label)
+        route_ids(trip.route_id)
+        trip_ids(trip.trip_id)
+        start_times(trip.start_time)
+        start_dates(trip.start_date)
+        latitudes.append(position.latitude)
+        longitudes.append(position.longitude)
+        timestamps.append(vehicle.timestamp)
+
+    columns = {name: intern_strings(values)
+               for name, values in strings.items()}
+    columns["latitude"] = np.array(latitudes, dtype=np.float64)
+    columns["longitude"] = np.array(longitudes, dtype=np.float64)
+    columns["raw_timestamp"] = np.array(timestamps, dtype=np.int64)
+    return VehicleBatch(columns)